@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''End-to-end latency benchmark for pollen against a local mock TheHive
+
+Starts bench/mockhive.py in-process, points a throwaway .pollen_config at it and times the common
+pollen operations (listing cases and tasks, status, one-shot --log directly and through a pollen
+agent, the shell's cross-case task view) over a number of iterations, reporting min/median/p95
+latency and requests per operation. Nothing touches a real TheHive or the .pollen_config in your
+working directory.
+
+Usage: python3 bench/e2e.py [--cases 5000] [--tasks 50] [--latency-ms 20] [--iterations 10]
+                            [--output results.jsonl]
+'''
+
+# standard imports
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# local imports
+import mockhive
+
+def percentile(samples, pct):
+    '''Nearest-rank percentile of a list of samples'''
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))]
+
+def time_operation(name, operation, iterations, hive, setup=None):
+    """Run an operation repeatedly with its output suppressed
+    :param name: Label for the report
+    :type name: string
+    :param operation: Callable to time
+    :param iterations: Number of timed runs
+    :type iterations: int
+    :param hive: The MockHive serving the run, for request counts
+    :param setup: Optional callable run (untimed) before every iteration
+    :return: result row for the report
+    :rtype: dict
+    """
+    samples = []
+    errors = 0
+    requests_before = hive.requests
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                operation()
+        # Injected errors are expected when --error-rate is set; count them and carry on
+        except (Exception, SystemExit):
+            errors += 1
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return {'operation': name, 'iterations': iterations, 'errors': errors,
+            'min_ms': min(samples), 'median_ms': statistics.median(samples), 'p95_ms': percentile(samples, 95),
+            'requests_per_op': (hive.requests - requests_before) / float(iterations)}
+
+def main():
+    '''Main Function'''
+    parser = argparse.ArgumentParser(description="pollen end-to-end latency benchmark")
+    parser.add_argument("--cases", type=int, default=2000, help="Cases on the mock server")
+    parser.add_argument("--tasks", type=int, default=20, help="Tasks per case on the mock server")
+    parser.add_argument("--latency-ms", type=float, default=5, help="Latency added per request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random +/- latency per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered 429/5xx")
+    parser.add_argument("--iterations", type=int, default=5, help="Timed runs per operation")
+    parser.add_argument("--output", help="Append the results as JSON lines to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    server, hive, url = mockhive.start(cases=args.cases, tasks=args.tasks, latency_ms=args.latency_ms,
+                                       jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    workdir = tempfile.mkdtemp(prefix='pollen-e2e-')
+    os.chdir(workdir)
+    with open('.pollen_config', 'w') as configfile:
+        configfile.write("[TheHive]\nserver_url = {0}\nserver_api = benchmark\ncase_name = Case 0\n"
+                         "case_id = case-0\ntask_name = Task 0\ntask_id = task-0-0\n".format(url))
+
+    import pollen
+    from cells import config, shell
+
+    def uncached():
+        config.USE_CACHE = False
+
+    def cold_cache():
+        config.USE_CACHE = True
+        config.refresh_cache()
+
+    def warm_cache():
+        config.USE_CACHE = True
+
+    agent_process = []
+
+    def start_agent():
+        # One resident agent for every run of the agent row, started (and warmed up) outside the timing
+        if not agent_process:
+            agent_process.append(subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, 'pollen.py'),
+                                                   '--agent', 'run'], stdout=subprocess.PIPE,
+                                                  stderr=subprocess.DEVNULL, universal_newlines=True))
+            agent_process[0].stdout.readline()
+
+    def log_process():
+        subprocess.run([sys.executable, os.path.join(REPO_ROOT, 'pollen.py'), '-l', 'benchmark'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+    case_shell = shell.PollenCaseCmd('case> ', 'case-0', 'Case 0')
+    operations = [
+        ('get_cases (no cache)', lambda: config.get_cases(output_format="name_list", case_id=True), uncached),
+        ('get_cases (cold cache)', lambda: config.get_cases(output_format="name_list", case_id=True), cold_cache),
+        ('get_cases (warm cache)', lambda: config.get_cases(output_format="name_list", case_id=True), warm_cache),
+        ('get_tasks (no cache)', lambda: config.get_tasks('case-0', output_format="name_list"), uncached),
+        ('get_case_stats', config.get_case_stats, None),
+        ('cli_entry --log', lambda: pollen.cli_entry(['benchmark', 'entry']), None),
+        ('shell: case tasks', lambda: case_shell.onecmd('tasks'), warm_cache),
+        ('shell: config status', lambda: shell.PollenConfigCmd('config> ', True).onecmd('status'), warm_cache),
+        ('shell: tasks (all open cases)', lambda: shell.PollenCmd().onecmd('tasks'), warm_cache),
+        ('pollen.py --log (new process)', log_process, None),
+        ('pollen.py --log (via agent)', log_process, start_agent),
+    ]
+
+    results = []
+    print("mockhive: {0} cases x {1} tasks, {2} ms latency, {3:.0%} errors; {4} iterations".format(
+        args.cases, args.tasks, args.latency_ms, args.error_rate, args.iterations))
+    print("{0:32} {1:>10} {2:>10} {3:>10} {4:>9} {5:>7}".format(
+        'operation', 'min ms', 'median ms', 'p95 ms', 'req/op', 'errors'))
+    for name, operation, setup in operations:
+        row = time_operation(name, operation, args.iterations, hive, setup)
+        results.append(row)
+        print("{operation:32} {min_ms:10.1f} {median_ms:10.1f} {p95_ms:10.1f} {requests_per_op:9.1f} "
+              "{errors:7}".format(**row))
+    for process in agent_process:
+        process.terminate()
+        process.wait()
+    server.shutdown()
+
+    if output:
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        settings = {'cases': args.cases, 'tasks': args.tasks, 'latency_ms': args.latency_ms,
+                    'jitter_ms': args.jitter_ms, 'error_rate': args.error_rate}
+        with open(output, 'a') as results_file:
+            for row in results:
+                row.update(settings, timestamp=stamp)
+                results_file.write(json.dumps(row) + '\n')
+        print("Results appended to {0}".format(output))
+
+if __name__ == "__main__":
+    main()
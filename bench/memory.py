@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Memory benchmark for pollen's case and task listings against a local mock TheHive
+
+Runs bench/mockhive.py in a child process (so only pollen's own allocations are traced), then
+measures the peak memory while fetching a listing and the memory the finished listing keeps,
+using tracemalloc. The listings are fetched the way pollen does now (streamed decoding into compact
+records) and the way it used to (whole response decoded, then trimmed into dicts and lists).
+
+Usage: python3 bench/memory.py [--cases 50000] [--tasks 20000] [--output results.jsonl]
+'''
+
+# standard imports
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+def measure(name, operation):
+    """Trace one run of an operation
+    :param name: Label for the report
+    :type name: string
+    :param operation: Callable returning the listing
+    :return: result row for the report
+    :rtype: dict
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    listing = operation()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'operation': name, 'records': len(listing), 'peak_mib': peak / 1048576.0,
+            'retained_mib': retained / 1048576.0, 'seconds': elapsed}
+
+def main():
+    '''Main Function'''
+    parser = argparse.ArgumentParser(description="pollen listing memory benchmark")
+    parser.add_argument("--cases", type=int, default=20000, help="Cases on the mock server")
+    parser.add_argument("--tasks", type=int, default=10000, help="Tasks per case on the mock server")
+    parser.add_argument("--output", help="Append the results as JSON lines to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    mock = subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, 'bench', 'mockhive.py'), '--port', '0',
+                             '--cases', str(args.cases), '--tasks', str(args.tasks)],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    url = mock.stdout.readline().split(' at ')[1].split()[0]
+    workdir = tempfile.mkdtemp(prefix='pollen-memory-')
+    os.chdir(workdir)
+    with open('.pollen_config', 'w') as configfile:
+        configfile.write("[TheHive]\nserver_url = {0}\nserver_api = benchmark\n".format(url))
+
+    from thehive4py.query import And, Eq
+    from cells import config
+    config.USE_CACHE = False
+    api = config.get_api()
+
+    def case_dicts_before():
+        # How open cases were listed before: each page decoded whole, then trimmed to dicts
+        cases = []
+        start = 0
+        while True:
+            page = api.find_cases(query=And(Eq('status', 'Open')), sort=['-createdAt'],
+                                  range='{0}-{1}'.format(start, start + config.CASE_PAGE_SIZE)).json()
+            cases.extend({field: case.get(field) for field in config.CASE_FIELDS} for case in page)
+            if len(page) < config.CASE_PAGE_SIZE:
+                break
+            start += config.CASE_PAGE_SIZE
+        return cases
+
+    def cases_before():
+        # get_cases(name_list, case_id=True) then built [title, id] lists while the dicts were still alive
+        return [[case['title'], case['id']] for case in case_dicts_before()]
+
+    def tasks_before():
+        tasks = [{'title': task['title'], 'id': task['id'], 'status': task['status']}
+                 for task in api.get_case_tasks('case-0').json()]
+        return [[task['title'], task['status']] for task in tasks]
+
+    operations = [
+        ('open cases, before', cases_before),
+        ('open cases, now', lambda: config.get_cases(output_format="name_list", case_id=True)),
+        ('open case records, before', case_dicts_before),
+        ('open case records, now', lambda: config.get_cases(output_format="records")),
+        ('tasks of one case, before', tasks_before),
+        ('tasks of one case, now', lambda: config.get_tasks('case-0', output_format="name_list")),
+        ('task records of one case, now', lambda: config.get_tasks('case-0', output_format="records")),
+    ]
+    results = []
+    print("mockhive: {0} cases x {1} tasks".format(args.cases, args.tasks))
+    print("{0:32} {1:>9} {2:>10} {3:>13} {4:>9}".format('operation', 'records', 'peak MiB', 'retained MiB', 'seconds'))
+    try:
+        for name, operation in operations:
+            row = measure(name, operation)
+            results.append(row)
+            print("{operation:32} {records:9} {peak_mib:10.1f} {retained_mib:13.1f} {seconds:9.2f}".format(**row))
+    finally:
+        mock.terminate()
+
+    if output:
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with open(output, 'a') as results_file:
+            for row in results:
+                row.update(cases=args.cases, tasks=args.tasks, timestamp=stamp)
+                results_file.write(json.dumps(row) + '\n')
+        print("Results appended to {0}".format(output))
+
+if __name__ == "__main__":
+    main()
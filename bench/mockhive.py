@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Self-contained stand-in for the parts of TheHive's API that pollen talks to
+
+Serves cases, tasks, task logs and observables from an in-memory dataset, with configurable dataset size,
+per-request latency and error injection, so pollen can be exercised and benchmarked offline.
+Tasks are generated on demand per case, so large datasets (e.g. 50k cases x 500 tasks) stay cheap.
+
+Usage: python3 bench/mockhive.py [--port 9000] [--cases 50000] [--tasks 500] [--latency-ms 50]
+                                 [--jitter-ms 10] [--error-rate 0.01] [--no-stream]
+Then point pollen at http://127.0.0.1:9000 with any API key.
+'''
+
+# standard imports
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CASE_STATUSES = ('Open', 'Resolved', 'Open', 'Open', 'Deleted')
+TASK_STATUSES = ('Waiting', 'InProgress', 'Completed', 'Cancel')
+# Bodies larger than this are drained rather than read into memory
+DRAIN_THRESHOLD = 1024 * 1024
+EPOCH_MS = 1546300800000
+# Longest an audit stream read is held open when nothing happens (TheHive itself waits much longer)
+STREAM_WAIT = 1.0
+
+class MockHive(object):
+    '''In-memory TheHive dataset and request dispatcher'''
+    def __init__(self, cases=1000, tasks=10, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=1, stream=True):
+        '''Class initialization'''
+        self.tasks_per_case = tasks
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cases = [self.make_case(index) for index in range(cases)]
+        # Only the generated cases get generated tasks; cases created through the API start empty
+        self.generated_cases = cases
+        self.next_id = itertools.count(1)
+        self.case_index = {case['id']: index for index, case in enumerate(self.cases)}
+        # Tasks and logs created through the API, on top of the generated ones
+        self.created_tasks = {}
+        self.logs = {}
+        # Observables by case ID
+        self.observables = {}
+        # Attachment contents by datastore ID; uploads are drained, so each stands in with a small file
+        self.attachments = {}
+        # Field changes to generated tasks, by task ID
+        self.task_updates = {}
+        # Audit events for /api/stream, and where each stream has read up to; stream=False answers 404
+        self.stream = stream
+        self.audit = []
+        self.audit_changed = threading.Condition(self.lock)
+        self.streams = {}
+        self.requests = 0
+        self.errors = 0
+        self.bytes_in = 0
+
+    @staticmethod
+    def make_case(index):
+        '''Build a realistically sized case document'''
+        created = EPOCH_MS + index * 60000
+        return {'id': 'case-{0}'.format(index), '_id': 'case-{0}'.format(index), '_type': 'case',
+                'caseId': index + 1, 'title': 'Case {0}'.format(index),
+                'description': 'Synthetic case {0} generated by mockhive. '.format(index) * 8,
+                'status': CASE_STATUSES[index % len(CASE_STATUSES)], 'severity': 2, 'tlp': 2, 'pap': 2,
+                'owner': 'analyst{0}'.format(index % 5), 'flag': False, 'tags': ['mock', 'batch-{0}'.format(index % 50)],
+                'startDate': created, 'createdAt': created, 'createdBy': 'mock', 'updatedAt': None,
+                'metrics': {'hours': index % 40}, 'customFields': {'client': {'string': 'client-{0}'.format(index % 7)}}}
+
+    def make_task(self, case_index, task_index):
+        '''Build a task document for a generated case'''
+        return {'id': 'task-{0}-{1}'.format(case_index, task_index), '_type': 'case_task',
+                '_parent': 'case-{0}'.format(case_index), 'title': 'Task {0}'.format(task_index),
+                'description': 'Synthetic task {0} of case {1}.'.format(task_index, case_index),
+                'status': TASK_STATUSES[(case_index + task_index) % len(TASK_STATUSES)],
+                'owner': 'analyst{0}'.format(task_index % 5), 'flag': False, 'group': 'default',
+                'order': task_index, 'createdAt': EPOCH_MS + case_index * 60000 + task_index, 'updatedAt': None}
+
+    def tasks_for(self, case_id):
+        '''Every task of a case, generated plus created'''
+        tasks = []
+        if case_id in self.case_index and self.case_index[case_id] < self.generated_cases:
+            index = self.case_index[case_id]
+            tasks = [self.make_task(index, task_index) for task_index in range(self.tasks_per_case)]
+            tasks = [dict(task, **self.task_updates.get(task['id'], {})) for task in tasks]
+        return tasks + self.created_tasks.get(case_id, [])
+
+    def all_tasks(self):
+        '''Every task of every case; only used for queries that are not scoped to a case'''
+        for case in self.cases:
+            for task in self.tasks_for(case['id']):
+                yield task
+
+    def match(self, query, doc):
+        '''Evaluate a thehive4py query against a document'''
+        if not query:
+            return True
+        if '_and' in query:
+            return all(self.match(criterion, doc) for criterion in query['_and'])
+        if '_or' in query:
+            return any(self.match(criterion, doc) for criterion in query['_or'])
+        if '_not' in query:
+            return not self.match(query['_not'], doc)
+        if '_id' in query:
+            return doc.get('id') == query['_id']
+        if '_field' in query:
+            return doc.get(query['_field']) == query['_value']
+        if '_in' in query:
+            return doc.get(query['_in']['_field']) in query['_in']['_values']
+        for operator, compare in (('_gt', lambda a, b: a > b), ('_gte', lambda a, b: a >= b),
+                                  ('_lt', lambda a, b: a < b), ('_lte', lambda a, b: a <= b)):
+            if operator in query:
+                field, value = list(query[operator].items())[0]
+                return doc.get(field) is not None and compare(doc.get(field), value)
+        if '_like' in query or '_wildcard' in query:
+            details = query.get('_like') or query.get('_wildcard')
+            return details['_value'].strip('*').lower() in str(doc.get(details['_field'], '')).lower()
+        if '_parent' in query:
+            parent = self.parent_doc(doc)
+            if '_id' in query['_parent']:
+                return parent is not None and parent.get('id') == query['_parent']['_id']
+            return parent is not None and self.match(query['_parent'].get('_query'), parent)
+        # Anything else (e.g. _string) is treated as matching
+        return True
+
+    def parent_doc(self, doc):
+        '''Parent case of a task, or parent task of a log'''
+        parent_id = doc.get('_parent')
+        if parent_id in self.case_index:
+            return self.cases[self.case_index[parent_id]]
+        if parent_id and parent_id.startswith('task-'):
+            return self.find_task(parent_id)
+        return None
+
+    def find_task(self, task_id):
+        '''Task document by ID, generated or created'''
+        match = re.match(r'^task-(\d+)-(\d+)$', task_id)
+        if match:
+            case_index, task_index = int(match.group(1)), int(match.group(2))
+            if case_index >= self.generated_cases or task_index >= self.tasks_per_case:
+                return None
+            return dict(self.make_task(case_index, task_index), **self.task_updates.get(task_id, {}))
+        for tasks in self.created_tasks.values():
+            for task in tasks:
+                if task['id'] == task_id:
+                    return task
+        return None
+
+    def record_audit(self, operation, doc, root_id, details=None):
+        '''Queue an audit event for stream readers; called with self.lock held'''
+        self.audit.append({'base': {'operation': operation, 'objectType': doc['_type'], 'objectId': doc['id'],
+                                    'rootId': root_id, 'details': details or {}, 'object': dict(doc),
+                                    'startDate': int(time.time() * 1000)},
+                           'summary': {doc['_type']: {operation: 1}}, 'count': 1})
+        self.audit_changed.notify_all()
+
+    def read_stream(self, stream_id):
+        '''Audit events a stream has not seen yet, waiting up to STREAM_WAIT for some to arrive'''
+        with self.lock:
+            if stream_id not in self.streams:
+                return None
+            self.audit_changed.wait_for(lambda: len(self.audit) > self.streams[stream_id], STREAM_WAIT)
+            events = self.audit[self.streams[stream_id]:]
+            self.streams[stream_id] = len(self.audit)
+            return events
+
+    @staticmethod
+    def scoped_parent(query, parent_type):
+        '''Pull a parent id out of a query scoped to one case or task, so it can be served directly'''
+        criteria = query.get('_and', [query]) if query else []
+        for criterion in criteria:
+            parent = criterion.get('_parent', {}) if isinstance(criterion, dict) else {}
+            if parent.get('_type') == parent_type:
+                if '_id' in parent:
+                    return parent['_id']
+                if isinstance(parent.get('_query'), dict) and '_id' in parent['_query']:
+                    return parent['_query']['_id']
+        return None
+
+    @staticmethod
+    def page(docs, params):
+        '''Apply sort and range parameters'''
+        for sort in reversed(params.get('sort', [])):
+            field = sort.lstrip('+-')
+            docs = sorted(docs, key=lambda doc: (doc.get(field) is None, doc.get(field) or 0),
+                          reverse=sort.startswith('-'))
+        span = params.get('range', ['all'])[0]
+        if span != 'all':
+            start, end = [int(bound) for bound in span.split('-')]
+            docs = docs[start:end]
+        return list(docs)
+
+    def case_stats(self, body):
+        '''Case aggregation, as used by config.get_case_stats'''
+        cases = [case for case in self.cases if self.match(body.get('query'), case)]
+        result = {'count': len(cases)}
+        for stat in body.get('stats', []):
+            if stat.get('_agg') == 'field':
+                groups = {}
+                for case in cases:
+                    value = str(case.get(stat['_field']))
+                    groups.setdefault(value, {'count': 0})['count'] += 1
+                result[stat['_field']] = groups
+        return result
+
+    def add_log(self, task_id, message, attachment=None):
+        '''Store a task log'''
+        log = {'id': 'log-{0}'.format(next(self.next_id)), '_type': 'case_task_log', '_parent': task_id,
+               'message': message, 'startDate': int(time.time() * 1000), 'createdBy': 'analyst0',
+               'createdAt': int(time.time() * 1000), 'owner': 'analyst0', 'status': 'Ok'}
+        if attachment:
+            log['attachment'] = attachment
+        task = self.find_task(task_id)
+        with self.lock:
+            self.logs.setdefault(task_id, []).append(log)
+            self.record_audit('Creation', log, task['_parent'] if task else None)
+        return log
+
+    def add_observables(self, case_id, details):
+        """Create one observable, or one per value when data is a list, as TheHive 3 does. Values
+        already in the case are refused with a ConflictError; a list gets a 207 with both outcomes
+        :return: status code and response
+        :rtype: tuple
+        """
+        values = details.get('data')
+        many = isinstance(values, list)
+        success, failure = [], []
+        now = int(time.time() * 1000)
+        with self.lock:
+            existing = set((observable['dataType'], observable['data'])
+                           for observable in self.observables.get(case_id, []) if observable['status'] == 'Ok')
+            for value in values if many else [values]:
+                observable = {'id': 'observable-{0}'.format(next(self.next_id)), '_type': 'case_artifact',
+                              '_parent': case_id, 'dataType': details.get('dataType'), 'data': value,
+                              'message': details.get('message', ''), 'tlp': details.get('tlp', 2),
+                              'ioc': details.get('ioc', False), 'tags': details.get('tags', []),
+                              'status': 'Ok', 'startDate': now, 'createdAt': now, 'createdBy': 'analyst0',
+                              'updatedAt': None}
+                if (observable['dataType'], value) in existing:
+                    failure.append({'type': 'ConflictError', 'message': 'Artifact already exists',
+                                    'object': observable})
+                    continue
+                existing.add((observable['dataType'], value))
+                self.observables.setdefault(case_id, []).append(observable)
+                self.record_audit('Creation', observable, case_id)
+                success.append(observable)
+        if not many:
+            return (201, success[0]) if success else (400, failure[0])
+        if failure:
+            return 207, {'success': success, 'failure': failure}
+        return 201, success
+
+    def dispatch(self, method, path, params, headers, body):
+        """Route one request
+        :return: status code and JSON-serialisable response
+        :rtype: tuple
+        """
+        if method == 'GET' and path == '/api/user/current':
+            return 200, {'id': 'analyst0', 'name': 'Mock Analyst', 'roles': ['read', 'write']}
+        if method == 'GET' and path == '/api/health':
+            return 200, {'status': 'OK'}
+        if method == 'GET' and path.startswith('/api/datastore/'):
+            content = self.attachments.get(path[len('/api/datastore/'):])
+            if content is None:
+                return 404, {'type': 'NotFound', 'message': 'attachment not found'}
+            return 200, content
+        if method == 'GET' and path.startswith('/api/stream/') and self.stream:
+            events = self.read_stream(path[len('/api/stream/'):])
+            if events is None:
+                return 404, {'type': 'NotFound', 'message': 'stream not found'}
+            return 200, events
+        match = re.match(r'^/api/case/task/([^/]+)$', path)
+        if method == 'PATCH' and match:
+            task = self.find_task(match.group(1))
+            if task is None:
+                return 404, {'type': 'NotFound', 'message': 'task not found'}
+            changes = self.json_body(body)
+            changes['updatedAt'] = int(time.time() * 1000)
+            with self.lock:
+                # Generated tasks are rebuilt on every read, so their changes are kept on the side
+                if re.match(r'^task-\d+-\d+$', task['id']):
+                    self.task_updates.setdefault(task['id'], {}).update(changes)
+                task.update(changes)
+                self.record_audit('Update', task, task['_parent'], changes)
+            return 200, task
+        if method != 'POST':
+            return 404, {'type': 'NotFound', 'message': '{0} {1}'.format(method, path)}
+        if path == '/api/stream' and self.stream:
+            with self.lock:
+                stream_id = 'stream-{0}'.format(next(self.next_id))
+                self.streams[stream_id] = len(self.audit)
+            return 200, stream_id
+        if path == '/api/case/_search':
+            query = self.json_body(body).get('query')
+            return 200, self.page([case for case in self.cases if self.match(query, case)], params)
+        if path == '/api/case/_stats':
+            return 200, self.case_stats(self.json_body(body))
+        if path == '/api/case/task/_search':
+            query = self.json_body(body).get('query')
+            case_id = self.scoped_parent(query, 'case')
+            tasks = self.tasks_for(case_id) if case_id else self.all_tasks()
+            return 200, self.page([task for task in tasks if self.match(query, task)], params)
+        if path == '/api/case/task/log/_search':
+            query = self.json_body(body).get('query')
+            task_id = self.scoped_parent(query, 'case_task')
+            logs = self.logs.get(task_id, []) if task_id else [log for logs in self.logs.values() for log in logs]
+            return 200, self.page([log for log in logs if self.match(query, log)], params)
+        if path == '/api/case/artifact/_search':
+            query = self.json_body(body).get('query')
+            case_id = self.scoped_parent(query, 'case')
+            observables = (self.observables.get(case_id, []) if case_id else
+                           [observable for observables in self.observables.values() for observable in observables])
+            return 200, self.page([observable for observable in observables if self.match(query, observable)], params)
+        if path == '/api/case':
+            case = self.make_case(len(self.cases))
+            case.update(self.json_body(body), status='Open')
+            with self.lock:
+                self.case_index[case['id']] = len(self.cases)
+                self.cases.append(case)
+            return 201, case
+        match = re.match(r'^/api/case/([^/]+)/task$', path)
+        if match:
+            if match.group(1) not in self.case_index:
+                return 404, {'type': 'NotFound', 'message': 'case not found'}
+            task = {'id': 'task-new-{0}'.format(next(self.next_id)), '_type': 'case_task', '_parent': match.group(1),
+                    'status': 'Waiting', 'createdAt': int(time.time() * 1000), 'updatedAt': None}
+            task.update(self.json_body(body))
+            with self.lock:
+                self.created_tasks.setdefault(match.group(1), []).append(task)
+                self.record_audit('Creation', task, match.group(1))
+            return 201, task
+        match = re.match(r'^/api/case/([^/]+)/artifact$', path)
+        if match:
+            if match.group(1) not in self.case_index:
+                return 404, {'type': 'NotFound', 'message': 'case not found'}
+            return self.add_observables(match.group(1), self.json_body(body))
+        match = re.match(r'^/api/case/task/([^/]+)/log$', path)
+        if match:
+            if self.find_task(match.group(1)) is None:
+                return 404, {'type': 'NotFound', 'message': 'task not found'}
+            content_type = headers.get('Content-Type', '')
+            if content_type.startswith('multipart/form-data'):
+                message = re.search(rb'name="_json"\r\n\r\n(.*?)\r\n', body)
+                message = json.loads(message.group(1).decode('utf-8')).get('message') if message else ''
+                filename = re.search(rb'filename="([^"]*)"', body)
+                filename = filename.group(1).decode('utf-8') if filename else 'attachment'
+                # The same file name always maps to the same content, so duplicate uploads share a hash
+                content = 'mock attachment {0}\n'.format(filename).encode('utf-8') * 64
+                attachment = {'id': 'att-{0}'.format(next(self.next_id)), 'name': filename, 'size': len(content),
+                              'contentType': 'application/octet-stream',
+                              'hashes': [hashlib.sha256(content).hexdigest(), hashlib.sha1(content).hexdigest(),
+                                         hashlib.md5(content).hexdigest()]}
+                with self.lock:
+                    self.attachments[attachment['id']] = content
+                return 201, self.add_log(match.group(1), message, attachment)
+            return 201, self.add_log(match.group(1), self.json_body(body).get('message'))
+        return 404, {'type': 'NotFound', 'message': '{0} {1}'.format(method, path)}
+
+    @staticmethod
+    def json_body(body):
+        '''Decode a JSON request body, tolerating an empty one'''
+        return json.loads(body.decode('utf-8')) if body else {}
+
+def handler_for(hive):
+    '''Build a request handler class bound to a MockHive'''
+    class MockHiveHandler(BaseHTTPRequestHandler):
+        '''HTTP/1.1 keep-alive handler'''
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out as separate writes; without this, Nagle plus delayed ACKs add ~40ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, *_):
+            pass
+
+        def read_body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            hive.bytes_in += length
+            if length <= DRAIN_THRESHOLD:
+                return self.rfile.read(length)
+            # Large uploads: keep the first chunk (the form fields) and discard the rest
+            head = self.rfile.read(65536)
+            remaining = length - len(head)
+            while remaining:
+                remaining -= len(self.rfile.read(min(remaining, 65536)))
+            return head
+
+        def respond(self, status, payload, extra_headers=None):
+            binary = isinstance(payload, bytes)
+            data = payload if binary else json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream' if binary else 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def handle_any(self):
+            body = self.read_body()
+            with hive.lock:
+                hive.requests += 1
+            delay = hive.latency_ms + hive.random.uniform(-hive.jitter_ms, hive.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000.0)
+            if hive.error_rate and hive.random.random() < hive.error_rate:
+                with hive.lock:
+                    hive.errors += 1
+                status = hive.random.choice((429, 500, 503))
+                self.respond(status, {'type': 'Injected', 'message': 'mockhive injected error'},
+                             {'Retry-After': '1'} if status in (429, 503) else None)
+                return
+            url = urlparse(self.path)
+            try:
+                status, payload = hive.dispatch(self.command, url.path, parse_qs(url.query), self.headers, body)
+            except (ValueError, KeyError) as err:
+                status, payload = 400, {'type': 'BadRequest', 'message': str(err)}
+            self.respond(status, payload)
+
+        do_GET = handle_any
+        do_POST = handle_any
+        do_PATCH = handle_any
+        do_DELETE = handle_any
+    return MockHiveHandler
+
+def start(host='127.0.0.1', port=0, **options):
+    """Start a mock TheHive in a background thread
+    :param options: MockHive options (cases, tasks, latency_ms, jitter_ms, error_rate, seed)
+    :return: the server, its MockHive and its base URL
+    :rtype: tuple
+    """
+    hive = MockHive(**options)
+    server = ThreadingHTTPServer((host, port), handler_for(hive))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, hive, 'http://{0}:{1}'.format(host, server.server_address[1])
+
+def main():
+    '''Main Function'''
+    parser = argparse.ArgumentParser(description="Mock TheHive server for pollen testing and benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--cases", type=int, default=1000, help="Number of cases")
+    parser.add_argument("--tasks", type=int, default=10, help="Tasks per case")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random +/- latency per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered 429/5xx")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-stream", help="Answer /api/stream with 404, as servers without it do",
+                        action="store_true")
+    args = parser.parse_args()
+    server, _, url = start(args.host, args.port, cases=args.cases, tasks=args.tasks, latency_ms=args.latency_ms,
+                           jitter_ms=args.jitter_ms, error_rate=args.error_rate, seed=args.seed,
+                           stream=not args.no_stream)
+    print("mockhive serving {0} cases x {1} tasks at {2} (Ctrl+C to stop)".format(args.cases, args.tasks, url), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Startup-time benchmark for the pollen.py --log fast path
+
+Runs `python -X importtime -c "import pollen"` a few times from the repository root and reports the
+cumulative import time of pollen and its slowest imports. It exits non-zero if any module that the
+--log path should never load gets imported, or if the best run is over the (optional) time budget,
+so it can be used to guard against startup regressions.
+
+Usage: python3 bench/startup.py [--runs N] [--budget-ms MS]
+'''
+
+# standard imports
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules only the interactive shell or bulk mode should load
+FORBIDDEN = ('cells.shell', 'cells.bulk', 'cmd', 'thehive4py.api', 'thehive4py.models', 'magic')
+
+def import_times():
+    """Import pollen once in a fresh interpreter
+    :return: cumulative import time in microseconds, keyed by module
+    :rtype: dict
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import pollen'],
+                          cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(cumulative)
+    return times
+
+def main():
+    '''Main Function'''
+    parser = argparse.ArgumentParser(description="pollen --log startup benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Interpreter launches to take the best of")
+    parser.add_argument("--budget-ms", type=float, help="Fail if importing pollen takes longer than this")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    best = min(runs, key=lambda times: times['pollen'])
+    print("pollen import: best {0:.1f} ms, worst {1:.1f} ms over {2} runs".format(
+        best['pollen'] / 1000.0, max(times['pollen'] for times in runs) / 1000.0, args.runs))
+    print("Slowest imports (cumulative):")
+    for module, cumulative in sorted(best.items(), key=lambda item: -item[1])[1:args.top + 1]:
+        print("\t{0:8.1f} ms  {1}".format(cumulative / 1000.0, module))
+
+    failed = False
+    loaded = [module for module in FORBIDDEN if module in best]
+    if loaded:
+        print("FAIL: the --log path imports {0}".format(', '.join(loaded)))
+        failed = True
+    if args.budget_ms is not None and best['pollen'] / 1000.0 > args.budget_ms:
+        print("FAIL: over the {0:.1f} ms budget".format(args.budget_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the resident pollen agent and the thin client that talks to it
+
+The agent is a long-lived pollen process that keeps the parsed config, a warm keep-alive session to
+TheHive and the case/task listings in memory, and takes requests over a Unix domain socket next to
+.pollen_config. A --log run then only has to start Python, read the config and hand its entry over,
+rather than importing the HTTP stack and connecting to TheHive from scratch.
+
+Requests and replies are JSON objects, one per line, and a connection may carry as many requests
+as it likes; they are answered in order. Every request has an op:
+
+    ping                                        is the agent alive, and how busy has it been
+    log      task_id, message[, file, queue]    add a task log entry (queue: spool it and return);
+                                                compress and force apply to the file as with --logfile
+    logs     task_id, entries                   add many entries at once, posted side by side
+    cases                                       open cases, as [title, id] pairs
+    tasks    case_id                            tasks of a case, as [title, status, id] triples
+    newcase  title[, description]               create a case
+    newtask  case_id, title[, description]      create a task within a case
+    stop                                        shut the agent down
+
+Any request may also name the server profile to use. Replies always carry ok, and error when ok
+is false.
+'''
+
+# standard imports; only what the thin client needs, the agent's own imports are made in serve()
+import json
+import os
+import socket
+
+# Socket the agent listens on, next to .pollen_config
+SOCKET_FILE = '.pollen_agent.sock'
+# A running agent accepts straight away; anything slower is treated as no agent at all
+CONNECT_TIMEOUT = 0.5
+# Longest the client waits for an answer; an attachment upload can take a while
+REPLY_TIMEOUT = 600
+
+def request(message, timeout=REPLY_TIMEOUT, path=SOCKET_FILE):
+    """Send one request to the agent and wait for its reply
+    :param message: Request, with at least an op
+    :type message: dict
+    :param timeout: Seconds to wait for the reply
+    :type timeout: float
+    :param path: Agent socket
+    :type path: string
+    :return: the agent's reply, or None if no agent is running. Once a request has been handed
+        over it is never reported as None, so the caller cannot end up sending it twice
+    :rtype: dict
+    """
+    if not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(CONNECT_TIMEOUT)
+    try:
+        client.connect(path)
+    except OSError:
+        # Left behind by an agent that died; nobody is listening
+        client.close()
+        return None
+    with client:
+        client.settimeout(timeout)
+        try:
+            client.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        except OSError:
+            # The agent only acts on a complete line, so a failed send was never acted on
+            return None
+        try:
+            reply = client.makefile('rb').readline()
+        except OSError as err:
+            return {'ok': False, 'error': "no answer from the pollen agent ({0})".format(err)}
+    if not reply:
+        return {'ok': False, 'error': "the pollen agent closed the connection before answering"}
+    return json.loads(reply.decode('utf-8'))
+
+def serve(path=SOCKET_FILE):
+    """Run the agent in the foreground until it is stopped, Ctrl+C or SIGTERM
+    :param path: Socket to listen on
+    :type path: string
+    :return: requests answered, by op
+    :rtype: dict
+    """
+    import signal
+    import socketserver
+    import sys
+    import threading
+    import time
+
+    from cells import bulk
+    from cells import config
+    from cells import hive
+    from cells import spool
+
+    stats = {}
+    stats_lock = threading.Lock()
+    started = time.time()
+
+    def api_for(message):
+        return config.profile_api(message.get('profile'))
+
+    def upload_options(message):
+        return {name: True for name in ('compress', 'force') if message.get(name)}
+
+    def do_ping(message):
+        with stats_lock:
+            counts = dict(stats)
+        return {'ok': True, 'pid': os.getpid(), 'uptime': time.time() - started, 'requests': counts,
+                'clients': hive.client_stats(), 'queued': len(spool.pending())}
+
+    def do_log(message):
+        task_id = message['task_id']
+        # Queued entries keep the client's profile, so the flusher sends them to the right server
+        if message.get('queue'):
+            spool.append(task_id, message['message'], message.get('file'), profile=message.get('profile'),
+                         **upload_options(message))
+            # The agent's flusher sends queued entries in batches, a task at a time
+            spool.start_flusher().wake()
+            return {'ok': True, 'queued': True}
+        failure = bulk.post_entry(api_for(message), task_id, message)
+        if failure and failure.kind == bulk.RETRY:
+            # Don't lose the entry; the flusher keeps retrying it
+            spool.append(task_id, message['message'], message.get('file'), profile=message.get('profile'),
+                         **upload_options(message))
+            spool.start_flusher()
+            return {'ok': False, 'queued': True, 'error': failure}
+        if failure:
+            # Refused, or possibly written already; queueing it would block the task or add it twice
+            return {'ok': False, 'queued': False, 'error': failure}
+        return {'ok': True}
+
+    def do_logs(message):
+        summary = bulk.ingest(api_for(message), message['task_id'], message['entries'])
+        return dict(summary, ok=not summary['failed'])
+
+    def do_cases(message):
+        # Listings are cached per server; answer from the profile the client was using
+        return {'ok': True, 'cases': config.get_cases(output_format="name_list", case_id=True,
+                                                      api=api_for(message))}
+
+    def do_tasks(message):
+        tasks = config.get_tasks(message['case_id'], output_format="records", api=api_for(message))
+        return {'ok': True, 'tasks': [[task['title'], task['status'], task['id']] for task in tasks]}
+
+    def do_newcase(message):
+        from thehive4py.models import Case
+        api = api_for(message)
+        resp = api.create_case(Case(title=message['title'], description=message.get('description', '')))
+        if resp.status_code != 201:
+            return {'ok': False, 'error': "HTTP {0}".format(resp.status_code)}
+        config.get_cache().expire(config.listing_key(server=api.url))
+        return {'ok': True, 'id': resp.json().get('id')}
+
+    def do_newtask(message):
+        from thehive4py.models import CaseTask
+        api = api_for(message)
+        resp = api.create_case_task(message['case_id'], CaseTask(
+            title=message['title'], description=message.get('description', '')))
+        if resp.status_code != 201:
+            return {'ok': False, 'error': "HTTP {0}".format(resp.status_code)}
+        config.get_cache().expire(config.listing_key(message['case_id'], server=api.url))
+        return {'ok': True, 'id': resp.json().get('id')}
+
+    def do_stop(message):
+        # shutdown() waits for serve_forever(), so it cannot be called from a request thread directly
+        threading.Thread(target=server.shutdown, daemon=True).start()
+        return {'ok': True}
+
+    operations = {'ping': do_ping, 'log': do_log, 'logs': do_logs, 'cases': do_cases, 'tasks': do_tasks,
+                  'newcase': do_newcase, 'newtask': do_newtask, 'stop': do_stop}
+
+    def answer(line):
+        try:
+            message = json.loads(line.decode('utf-8'))
+            operation = operations[message['op']]
+        except (ValueError, KeyError, TypeError):
+            return {'ok': False, 'error': "not a pollen agent request: {0!r}".format(line[:80])}
+        with stats_lock:
+            stats[message['op']] = stats.get(message['op'], 0) + 1
+        try:
+            return operation(message)
+        except KeyError as err:
+            return {'ok': False, 'error': "{0} needs {1}".format(message['op'], err)}
+        # One bad request must never take the agent down
+        except Exception as err:
+            return {'ok': False, 'error': str(err)}
+
+    class AgentHandler(socketserver.StreamRequestHandler):
+        '''Answers the requests of one connection, in order'''
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                self.wfile.write(json.dumps(answer(line)).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+    if request({'op': 'ping'}, timeout=CONNECT_TIMEOUT, path=path) is not None:
+        config.sneeze(error_message="Start a pollen agent while one is already running here.",
+                      error_fix="Use the running agent, or stop it first with pollen --agent stop.")
+        return stats
+    if os.path.exists(path):
+        os.unlink(path)
+    # Only the owner may talk to the agent; it holds their API key
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, AgentHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    # Warm up before the first client arrives: connect to TheHive and load the open cases
+    api = config.get_api()
+    try:
+        api.get_current_user()
+        config.get_cases(output_format="name_list", case_id=True)
+    except Exception as err:
+        print("**** Could not reach TheHive yet ({0}); carrying on ****".format(err))
+    spool.start_flusher().wake()
+    print("Bzz Bzz Bzz...pollen agent {0} listening on {1}. Press Ctrl+C to stop.".format(
+        os.getpid(), os.path.abspath(path)), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+    print("Bzz Bzz Bzz...pollen agent stopped after {0} requests.".format(sum(stats.values())))
+    return stats
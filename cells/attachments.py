@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain attachment dedup and compression for task log uploads'''
+
+# standard imports
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+from urllib.parse import quote
+
+# local imports
+from cells import config
+from cells import upload
+
+# Files that are already compressed gain nothing from another pass
+COMPRESSED_EXTENSIONS = ('.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.rar', '.jar', '.apk', '.cab',
+                         '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov',
+                         '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.e01', '.aff4')
+# Smaller files are sent as they are
+MIN_COMPRESS_SIZE = 4 * 1024
+# Bytes of the file test-compressed to judge whether compressing all of it is worth it...
+SAMPLE_SIZE = 64 * 1024
+# ...and how small the sample has to get
+WORTHWHILE_RATIO = 0.9
+COMPRESS_LEVEL = 6
+
+def file_digest(path, chunk_size=upload.CHUNK_SIZE):
+    """SHA-256 of a file, read a chunk at a time
+    :param path: File to hash
+    :type path: string
+    :return: hex digest
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as attachment:
+        for chunk in iter(lambda: attachment.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compressible(path):
+    """Whether compressing a file before upload is likely to save much
+    :param path: File to check
+    :type path: string
+    :return: whether to compress it
+    :rtype: boolean
+    """
+    if path.lower().endswith(COMPRESSED_EXTENSIONS) or os.path.getsize(path) < MIN_COMPRESS_SIZE:
+        return False
+    with open(path, 'rb') as attachment:
+        sample = attachment.read(SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) < len(sample) * WORTHWHILE_RATIO
+
+def compress(path, chunk_size=upload.CHUNK_SIZE):
+    """gzip a file into a temporary file, a chunk at a time
+    :param path: File to compress
+    :type path: string
+    :return: path of the compressed copy; the caller removes it
+    :rtype: string
+    """
+    handle, compressed_path = tempfile.mkstemp(prefix='pollen-', suffix='.gz')
+    try:
+        with open(path, 'rb') as source, os.fdopen(handle, 'wb') as target:
+            # No file name or mtime in the header, so the same file always compresses to the same bytes
+            with gzip.GzipFile(filename='', mode='wb', fileobj=target, compresslevel=COMPRESS_LEVEL, mtime=0) as packed:
+                shutil.copyfileobj(source, packed, chunk_size)
+    except BaseException:
+        os.unlink(compressed_path)
+        raise
+    return compressed_path
+
+def compress_setting():
+    '''Whether uploads are compressed, from compress = on/off in the [Uploads] section of the config'''
+    return config.CONFIG.get('Uploads', 'compress', fallback='off').lower() in ('on', 'auto', 'yes', 'true')
+
+def dedup_setting():
+    '''Whether repeat uploads are replaced by references, from dedup = on/off in [Uploads]; on by default'''
+    return config.CONFIG.get('Uploads', 'dedup', fallback='on').lower() in ('on', 'yes', 'true')
+
+def reference_message(api, message, name, size, sha256, earlier, task_id):
+    '''Log message pointing at an earlier upload of the same content, instead of uploading it again'''
+    where = "to this task" if earlier['task_id'] == task_id else "to task {0}".format(earlier['task_id'])
+    link = "{0}/api/datastore/{1}?name={2}".format(api.url, earlier['attachment_id'], quote(earlier['name']))
+    note = "Attachment {0} ({1}, SHA-256 {2}) was already uploaded {3}: [{4}]({5})".format(
+        name, upload.human_size(size), sha256, where, earlier['name'], link)
+    return '{0}\n\n{1}'.format(message, note) if message else note
+
+def attach(api, task_id, message, path, progress=None, compress_upload=None, force=False):
+    """Create a task log with an attachment, unless the same content has been uploaded before. A
+    repeat becomes a plain log entry that links to the earlier upload, and compressible files can
+    be gzipped on the way out
+    :param api: thehive api connector
+    :param task_id: Task to log against
+    :type task_id: string
+    :param message: Log message
+    :type message: string
+    :param path: File to attach
+    :type path: string
+    :param progress: Optional callable taking (bytes sent, total bytes)
+    :param compress_upload: gzip compressible files first; the [Uploads] compress setting by default
+    :type compress_upload: boolean
+    :param force: Upload even if the content has been uploaded before
+    :type force: boolean
+    :return: response from TheHive, and what was done: size, sent (bytes), reference and compressed
+    :rtype: tuple
+    """
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    sha256 = file_digest(path)
+    outcome = {'name': name, 'size': size, 'sent': size, 'reference': None, 'compressed': False}
+    if not force and dedup_setting():
+        earlier = config.get_cache().uploads_of(api.url, sha256)
+        # An earlier upload to this very task is the best reference; any other will do
+        earlier = [upload_row for upload_row in earlier if upload_row['task_id'] == task_id] or earlier
+        if earlier and earlier[0]['attachment_id']:
+            outcome.update(sent=0, reference=earlier[0])
+            return api.add_task_log(task_id, reference_message(api, message, name, size, sha256,
+                                                               earlier[0], task_id)), outcome
+    if compress_upload is None:
+        compress_upload = compress_setting()
+    upload_path = compress(path) if compress_upload and compressible(path) else path
+    try:
+        if upload_path != path:
+            outcome.update(sent=os.path.getsize(upload_path), compressed=True)
+            name += '.gz'
+        resp = api.upload_task_log(task_id, message, upload_path, progress=progress, filename=name)
+    finally:
+        if upload_path != path:
+            os.unlink(upload_path)
+    if resp.status_code == 201:
+        log = resp.json()
+        config.get_cache().record_upload(api.url, sha256, task_id, log.get('id'),
+                                         (log.get('attachment') or {}).get('id'), name, size)
+    return resp, outcome
+
+def describe(outcome):
+    """One line on what an upload saved, if anything
+    :param outcome: What attach did
+    :type outcome: dict
+    :return: description, or None when the file went up as it was
+    :rtype: string
+    """
+    if outcome['reference']:
+        return "{0} was already uploaded, so only a reference was logged (saved {1})".format(
+            outcome['name'], upload.human_size(outcome['size']))
+    if outcome['compressed']:
+        return "{0} compressed from {1} to {2} before upload (saved {3})".format(
+            outcome['name'], upload.human_size(outcome['size']), upload.human_size(outcome['sent']),
+            upload.human_size(outcome['size'] - outcome['sent']))
+    return None
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain background prefetching and completion notices for the shells'''
+
+# standard imports
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# local imports
+from cells import perf
+
+# Listings fetched side by side in the background
+PREFETCH_WORKERS = 2
+# Most notices kept; with no shell draining them (e.g. in the agent) only the latest are held on to
+NOTICE_LIMIT = 50
+
+EXECUTOR = None
+# Prefetches in flight or finished, keyed by listing key
+PENDING = {}
+PENDING_LOCK = threading.Lock()
+# Messages from background work, printed before the next prompt
+NOTICES = collections.deque(maxlen=NOTICE_LIMIT)
+
+def prefetch(key, fetch, label='prefetch'):
+    """Start fetching a listing in the background, unless that listing is already on its way
+    :param key: Listing key, e.g. config.listing_key(case_id)
+    :type key: string
+    :param fetch: Callable that fetches (and caches) the listing
+    :param label: Name the calls are filed under in the perf report
+    :type label: string
+    :return: the prefetch future
+    :rtype: concurrent.futures.Future
+    """
+    global EXECUTOR
+    with PENDING_LOCK:
+        future = PENDING.get(key)
+        if future is not None and not future.done():
+            return future
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+        def run():
+            with perf.background(label):
+                return fetch()
+        future = EXECUTOR.submit(run)
+        PENDING[key] = future
+        return future
+
+def settle(key, timeout=None):
+    """Wait for an in-flight prefetch of a listing, so the caller reads a warm cache rather than
+    fetching the same listing a second time. Errors are left for the caller's own fetch to report.
+    :param key: Listing key
+    :type key: string
+    :param timeout: Longest to wait, in seconds; None waits for as long as it takes
+    :type timeout: float
+    """
+    with PENDING_LOCK:
+        future = PENDING.pop(key, None)
+    if future is None:
+        return
+    try:
+        future.result(timeout=timeout)
+    except Exception:
+        pass
+
+def notify(message):
+    '''Queue a message for the analyst, shown before their next prompt'''
+    NOTICES.append(message)
+
+def drain_notices():
+    """Take every queued notice
+    :return: notices, oldest first
+    :rtype: list
+    """
+    notices = []
+    while NOTICES:
+        notices.append(NOTICES.popleft())
+    return notices
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain batch mode: scripts of pollen commands run in one process and session
+
+A batch script holds one command per line; blank lines and lines starting with # are skipped.
+Cases and tasks are picked by ID or title rather than from a numbered listing, so nothing ever
+waits on input():
+
+    profile     <name>                          switch server profile (waits for earlier steps)
+    case        <case ID or title>              work in an open case
+    newcase     <title> [&& description]        create a case and work in it
+    take        <task ID or title>              work on a task of the current case
+    newtask     <title> [&& description]        create a task in the current case and work on it
+    cmdline                                     make the current case and task the --log defaults
+    log         <message>                       add a task log entry
+    logfile     <file> [message]                add a task log entry with an attachment
+    observables <file> [data type]              add observables to the current case
+    manifest    <file> [name=value ...]         create a manifest's tasks (in the current case if any)
+    tasks       [status] [mine]                 tasks of the current case, or across open cases
+    cases                                       open cases
+    search      <words>                         search the task logs of open cases
+    export      <file> [attachment dir]         export the current case, or every open case
+    flush                                       send queued log entries
+    wait                                        let every earlier step finish before going on
+
+Steps that pick or create the case and task later steps act on run in script order. Everything
+else is handed to a worker pool as soon as it is read: steps against the same task (or case, or
+the spool) still go in script order, but steps against different ones, and read-only steps, run
+side by side. Output is kept per step and printed in script order.
+'''
+
+# standard imports
+import collections
+import io
+import json
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# local imports
+from cells import config
+from cells import perf
+from cells import search
+
+# Steps run side by side
+BATCH_WORKERS = 4
+# Exit codes of a step: done, failed against TheHive, or not runnable as written
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+# Candidates listed when a case or task name is ambiguous
+CANDIDATE_LIMIT = 5
+
+class BatchError(Exception):
+    '''A step that cannot run as written: a missing argument, no case selected, an ambiguous name...'''
+
+class StepOutput(object):
+    '''sys.stdout stand-in that sends whatever a step prints to that step's own buffer'''
+    def __init__(self, stream):
+        '''Class initialization'''
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'buffer', None) or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def read_script(source):
+    """Read the steps of a batch script
+    :param source: Script file, or '-' for stdin
+    :type source: string
+    :return: step dicts with step number, line number, command, verb and argument
+    :rtype: list
+    """
+    handle = sys.stdin if source == '-' else open(source)
+    try:
+        lines = handle.readlines()
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+    steps = []
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        verb, _, arg = line.partition(' ')
+        steps.append({'step': len(steps) + 1, 'line': line_no, 'command': line, 'verb': verb.lower(),
+                      'arg': arg.strip()})
+    return steps
+
+def check_script(steps):
+    """Find the steps of a script that name no batch command, before any of it runs
+    :param steps: Steps from read_script
+    :type steps: list
+    :return: one problem per bad line
+    :rtype: list
+    """
+    return ["line {0}: unknown command '{1}'".format(step['line'], step['verb'])
+            for step in steps if step['verb'] not in COMMANDS]
+
+def resolve(records, key, query, noun):
+    """Pick a case or task without asking: by exact ID or title, or by a piece of its title that no
+    other one shares
+    :param records: Listing records with title and id
+    :type records: list
+    :param key: Listing key the search index is kept under
+    :type key: string
+    :param query: ID or (part of a) title
+    :type query: string
+    :param noun: What is being picked, for errors (e.g. 'open case')
+    :type noun: string
+    :return: the record
+    :rtype: dict
+    """
+    index = search.index_for(key, records)
+    record = index.exact(query)
+    if record:
+        return record
+    # A fuzzy best guess is fine for a person at a prompt, not for a script acting on its own
+    lowered = query.lower()
+    matches = [record for record in records if lowered in record['title'].lower()]
+    if len(matches) == 1:
+        return matches[0]
+    if matches:
+        raise BatchError("'{0}' could be any of {1} {2}s ({3}); use the ID or the full title".format(
+            query, len(matches), noun, ', '.join(record['title'] for record in matches[:CANDIDATE_LIMIT])))
+    closest = index.search(query, limit=CANDIDATE_LIMIT)
+    raise BatchError("no {0} is called '{1}'{2}".format(noun, query, " (closest: {0})".format(
+        ', '.join(record['title'] for record in closest)) if closest else ''))
+
+def need(value, usage):
+    '''Stop a step that is missing its argument or context'''
+    if not value:
+        raise BatchError(usage)
+    return value
+
+def title_and_description(arg, usage):
+    '''Split "title && description" as given to newcase and newtask'''
+    title, _, description = arg.partition('&&')
+    return need(title.strip(), usage), description.strip()
+
+# Steps that pick or create what later steps act on; they run in script order
+def step_profile(context, arg):
+    if not config.use_profile(need(arg, "usage: profile <name>")):
+        raise BatchError("no server profile named {0}".format(arg))
+    context.update(api=config.get_api(), case=None, task=None)
+    print("Bzz Bzz Bzz...now using server profile {0}".format(arg))
+
+def step_case(context, arg):
+    context.update(case=None, task=None)
+    case = resolve(config.get_cases(output_format="records"), config.listing_key(),
+                   need(arg, "usage: case <case ID or title>"), "open case")
+    context['case'] = case
+    print("Bzz Bzz Bzz...working in case {0} ({1})".format(case['title'], case['id']))
+
+def step_newcase(context, arg):
+    from thehive4py.models import Case
+    context.update(case=None, task=None)
+    title, description = title_and_description(arg, "usage: newcase <title> [&& description]")
+    resp = context['api'].create_case(Case(title=title, description=description))
+    if resp.status_code != 201:
+        print("Could not create case {0}: HTTP {1}".format(title, resp.status_code))
+        return False
+    config.get_cache().expire(config.listing_key())
+    context['case'] = {'id': resp.json()['id'], 'title': title}
+    print("Successfully created case {0}!".format(title))
+
+def step_take(context, arg):
+    case = need(context['case'], "take needs a case; start with case <case ID or title>")
+    context['task'] = None
+    task = resolve(config.get_tasks(case['id'], output_format="records"), config.listing_key(case['id']),
+                   need(arg, "usage: take <task ID or title>"), "task")
+    context['task'] = task
+    print("Bzz Bzz Bzz...working on task {0} ({1})".format(task['title'], task['id']))
+
+def step_newtask(context, arg):
+    from thehive4py.models import CaseTask
+    case = need(context['case'], "newtask needs a case; start with case <case ID or title>")
+    context['task'] = None
+    title, description = title_and_description(arg, "usage: newtask <title> [&& description]")
+    resp = context['api'].create_case_task(case['id'], CaseTask(title=title, description=description))
+    if resp.status_code != 201:
+        print("Could not create task {0}: HTTP {1}".format(title, resp.status_code))
+        return False
+    config.get_cache().expire(config.listing_key(case['id']))
+    context['task'] = {'id': resp.json()['id'], 'title': title}
+    print("Successfully created task {0} with the case {1}.".format(title, case['title']))
+
+def step_cmdline(context, arg):
+    case = need(context['case'], "cmdline needs a case; start with case <case ID or title>")
+    task = need(context['task'], "cmdline needs a task; pick one with take <task ID or title>")
+    config.CONFIG.update(config.CONFIG.section, case_name=case['title'], case_id=case['id'],
+                         task_name=task['title'], task_id=task['id'])
+    print("Bzz Bzz Bzz...--log and --logfile now go to {0} > {1}".format(case['title'], task['title']))
+
+def step_manifest(context, arg):
+    from cells import manifest
+    words = need(arg, "usage: manifest <file> [name=value ...]").split()
+    try:
+        entries = manifest.read_manifest(words[0], dict(word.split('=', 1) for word in words[1:]))
+    except (OSError, ValueError) as err:
+        raise BatchError("cannot read manifest {0}: {1}".format(words[0], err))
+    summaries = manifest.apply(context['api'], entries, case_id=context['case']['id'] if context['case'] else None)
+    manifest.report(summaries)
+    config.get_cache().expire(config.listing_key())
+    if context['case']:
+        config.get_cache().expire(config.listing_key(context['case']['id']))
+    return not any(summary['failed'] for summary in summaries)
+
+def step_wait(context, arg):
+    pass
+
+# Steps that act on the current task or case, or only read
+def step_log(context, arg):
+    from cells import bulk
+    task = need(context['task'], "log needs a task; pick one with take <task ID or title>")
+    failure = bulk.post_entry(context['api'], task['id'], {'message': need(arg, "usage: log <message>")},
+                              stop=context['halted'])
+    if failure:
+        print("Could not add the log entry to {0}: {1}".format(task['title'], failure))
+        return False
+    print("Bzz Bzz Bzz...successfully inserted into task log of {0}.".format(task['title']))
+
+def step_logfile(context, arg):
+    from cells import bulk
+    task = need(context['task'], "logfile needs a task; pick one with take <task ID or title>")
+    words = need(arg, "usage: logfile <file> [message]").split(None, 1)
+    failure = bulk.post_entry(context['api'], task['id'], {'message': words[1] if len(words) > 1 else '',
+                                                           'file': words[0]}, stop=context['halted'])
+    if failure:
+        print("Could not attach {0} to {1}: {2}".format(words[0], task['title'], failure))
+        return False
+    print("Bzz Bzz Bzz...{0} attached to the task log of {1}.".format(words[0], task['title']))
+
+def step_observables(context, arg):
+    from cells import observables
+    case = need(context['case'], "observables needs a case; start with case <case ID or title>")
+    words = need(arg, "usage: observables <file> [data type]").split()
+    summary = observables.import_file(words[0], case['id'], data_type=words[1] if len(words) > 1 else None)
+    if not summary:
+        return False
+    observables.report(summary, case['title'])
+    return not summary['failed']
+
+def step_tasks(context, arg):
+    if not context['case']:
+        words = arg.split()
+        status = [word for word in words if word != 'mine']
+        config.task_overview(status=status[0] if status else None, mine='mine' in words)
+        return
+    tasks = config.get_tasks(context['case']['id'], output_format="name_list")
+    print("{0} tasks in case {1}".format(len(tasks), context['case']['title']))
+    for task in tasks:
+        print("\tTask Title: {0} | Status: {1}".format(task[0], task[1]))
+
+def step_cases(context, arg):
+    cases = config.get_cases(output_format="records")
+    print("{0} open cases".format(len(cases)))
+    for case in cases:
+        print("\t{0} ({1})".format(case['title'], case['id']))
+
+def step_search(context, arg):
+    from cells import logsearch
+    logsearch.report(*logsearch.search(need(arg, "usage: search <words>")))
+
+def step_export(context, arg):
+    from cells import export
+    words = need(arg, "usage: export <file.jsonl|.jsonl.gz|.parquet> [attachment dir]").split()
+    try:
+        summary = export.export_cases(words[0], case_ids=[context['case']['id']] if context['case'] else None,
+                                      attachments=words[1] if len(words) > 1 else None)
+    except ImportError:
+        raise BatchError("Parquet exports need pyarrow (pip3 install pyarrow); try .jsonl or .jsonl.gz instead")
+    export.report(summary, words[0])
+    return not summary['failures'] and not (summary['attachments'] or {}).get('failed')
+
+def step_flush(context, arg):
+    from cells import spool
+    summary = spool.flush()
+    spool.report(summary)
+    return not summary['failed']
+
+# verb: (step, how it is scheduled). 'context' and 'barrier' steps run in script order, 'barrier'
+# ones only once everything before them is done; the others run in the pool, in script order per
+# task, case or spool, and freely when 'read'
+COMMANDS = {'profile': (step_profile, 'barrier'), 'case': (step_case, 'context'),
+            'newcase': (step_newcase, 'context'), 'take': (step_take, 'context'),
+            'newtask': (step_newtask, 'context'), 'cmdline': (step_cmdline, 'context'),
+            'manifest': (step_manifest, 'barrier'), 'wait': (step_wait, 'barrier'),
+            'log': (step_log, 'task'), 'logfile': (step_logfile, 'task'),
+            'observables': (step_observables, 'case'), 'tasks': (step_tasks, 'read'),
+            'cases': (step_cases, 'read'), 'search': (step_search, 'read'), 'export': (step_export, 'read'),
+            'flush': (step_flush, 'spool')}
+
+def ordering_key(kind, context):
+    '''What a pooled step must stay in script order with, if anything'''
+    if kind == 'task' and context['task']:
+        return 'task:' + context['task']['id']
+    if kind == 'case' and context['case']:
+        return 'case:' + context['case']['id']
+    if kind == 'spool':
+        return 'spool'
+    return None
+
+def run(steps, workers=BATCH_WORKERS, keep_going=False, stream=None):
+    """Run the steps of a batch script in this process, over one pooled session to TheHive
+    :param steps: Steps from read_script
+    :type steps: list
+    :param workers: Steps run side by side
+    :type workers: int
+    :param keep_going: Carry on after a step fails, rather than skipping everything not yet started
+    :type keep_going: boolean
+    :param stream: Where step output goes; stdout by default
+    :return: the steps, each with its status, exit code, milliseconds and output; and elapsed seconds
+    :rtype: tuple
+    """
+    stream = stream or sys.stdout
+    output = StepOutput(stream)
+    halted = threading.Event()
+    # Steps already posting see the halt too, so a failure elsewhere stops them before they send again
+    context = {'api': config.get_api(), 'case': None, 'task': None, 'halted': halted}
+    # Last pooled step per ordering key, and every step not yet printed, in script order
+    chains = {}
+    unprinted = collections.deque()
+
+    def execute(step, step_context, after=None):
+        if after is not None:
+            after.result()
+        if halted.is_set():
+            step.update(status='skipped', exit=None, ms=0.0, output='')
+            return step
+        output.local.buffer = io.StringIO()
+        start = time.perf_counter()
+        try:
+            with perf.background('batch: {0}'.format(step['verb'])):
+                exit_code = EXIT_FAILED if COMMANDS[step['verb']][0](step_context, step['arg']) is False else EXIT_OK
+        except BatchError as err:
+            print("Cannot run this step: {0}".format(err))
+            exit_code = EXIT_USAGE
+        # TheHive errors, unreadable files, and anything else; one step must never take the script down
+        except Exception as err:
+            print("Step failed: {0}".format(err))
+            exit_code = EXIT_FAILED
+        step.update(exit=exit_code, status='ok' if exit_code == EXIT_OK else 'failed',
+                    ms=(time.perf_counter() - start) * 1000.0, output=output.local.buffer.getvalue())
+        output.local.buffer = None
+        if exit_code != EXIT_OK and not keep_going:
+            halted.set()
+        return step
+
+    def print_done(block=False):
+        while unprinted and (block or unprinted[0].done()):
+            step = unprinted.popleft().result()
+            stream.write("[{0}] {1}\n{2}".format(step['step'], step['command'], step['output']))
+            if step['status'] != 'ok':
+                stream.write("\t=> {0}{1}\n".format(step['status'],
+                                                    '' if step['exit'] is None else ' (exit {0})'.format(step['exit'])))
+            stream.flush()
+
+    start = time.time()
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for step in steps:
+                kind = COMMANDS[step['verb']][1]
+                if kind == 'barrier':
+                    print_done(block=True)
+                    chains.clear()
+                if kind in ('context', 'barrier'):
+                    done = Future()
+                    done.set_result(execute(step, context))
+                else:
+                    key = ordering_key(kind, context)
+                    done = pool.submit(execute, step, dict(context), chains.get(key))
+                    if key:
+                        chains[key] = done
+                unprinted.append(done)
+                print_done()
+            print_done(block=True)
+    finally:
+        sys.stdout = output.stream
+    return steps, time.time() - start
+
+def report(steps, elapsed, results=None):
+    """Print per-step timings and exit codes, and optionally save them as JSON lines
+    :param steps: Steps returned by run
+    :type steps: list
+    :param elapsed: Seconds the whole script took
+    :type elapsed: float
+    :param results: File to write one JSON line per step to, if any
+    :type results: string
+    :return: exit code for the whole run: the worst of its steps
+    :rtype: int
+    """
+    print("\n\x1b[1m***** Batch Report *****\x1b[0m")
+    print("{0:>5} {1:>5} {2:>8} {3:>10}  {4}".format('Step', 'Line', 'Exit', 'ms', 'Command'))
+    for step in steps:
+        print("{0:>5} {1:>5} {2:>8} {3:>10.1f}  {4}".format(
+            step['step'], step['line'], 'skipped' if step['exit'] is None else step['exit'], step['ms'],
+            step['command'] if len(step['command']) <= 60 else step['command'][:57] + '...'))
+    counts = collections.Counter(step['status'] for step in steps)
+    print("Bzz Bzz Bzz...{0} steps in {1:.2f}s: {2} ok, {3} failed, {4} skipped".format(
+        len(steps), elapsed, counts['ok'], counts['failed'], counts['skipped']))
+    if results:
+        with open(results, 'w') as results_file:
+            for step in steps:
+                results_file.write(json.dumps({name: step[name] for name in
+                                               ('step', 'line', 'command', 'status', 'exit', 'ms')}) + '\n')
+    return max([step['exit'] or EXIT_OK for step in steps] or [EXIT_OK])
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain bulk task log ingestion'''
+
+# standard imports
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+
+# local imports
+from cells import attachments
+from cells import resilience
+
+# Defaults for the --bulk option
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+# What sending a failed entry again would do: go through, maybe duplicate it, or fail the same way
+RETRY = 'retry'
+UNKNOWN = 'unknown'
+REJECTED = 'rejected'
+
+class Failure(str):
+    """Why an entry was not posted, with a kind saying whether it may be sent again:
+    RETRY when it never reached TheHive or was turned away for now, UNKNOWN when TheHive may
+    already have written it (a read timeout, or a 500/502/504), and REJECTED when it would only fail again
+    (a 4xx, or an attachment that cannot be read)
+    """
+    def __new__(cls, text, kind):
+        failure = super(Failure, cls).__new__(cls, text)
+        failure.kind = kind
+        return failure
+
+def read_entries(source):
+    """Read log entries, one per line. A line may be plain text or a JSON object with a message \
+        and, optionally, a task_id and file to attach
+    :param source: Path to read from, or '-' for stdin
+    :type source: string
+    :return: one entry dict at a time
+    :rtype: generator
+    """
+    handle = sys.stdin if source == '-' else open(source)
+    try:
+        for line in handle:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            if line.lstrip().startswith('{'):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    entry = {'message': line}
+            else:
+                entry = {'message': line}
+            yield entry
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+def post_entry(api, task_id, entry, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, stop=None):
+    """Post a single entry. It is only sent again when it never reached TheHive, or TheHive turned
+    it away with a 429/503 and a Retry-After (which is then honoured); anything that may have been
+    written, such as a read timeout, is never posted twice. Gives up straight away while the
+    server's circuit breaker is open
+    :param api: thehive api connector
+    :param task_id: Task to log against, unless the entry names its own
+    :type task_id: string
+    :param entry: Entry with a message and optionally task_id and file (and compress and force for the file)
+    :type entry: dict
+    :param stop: Event that, once set, keeps the entry from being sent (again)
+    :type stop: threading.Event
+    :return: None on success, otherwise a Failure describing what went wrong
+    :rtype: Failure
+    """
+    failure = None
+    retry_after = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(resilience.delay(attempt - 1, backoff, retry_after))
+        if stop is not None and stop.is_set():
+            return Failure("not sent: stopped{0}".format(" after {0}".format(failure) if failure else ''), RETRY)
+        try:
+            if entry.get('file'):
+                resp = attachments.attach(api, entry.get('task_id', task_id), entry.get('message', ''),
+                                          entry['file'], compress_upload=entry.get('compress'),
+                                          force=entry.get('force', False))[0]
+            else:
+                resp = api.add_task_log(entry.get('task_id', task_id), entry.get('message', ''))
+        except resilience.CircuitOpen as err:
+            return Failure(str(err), RETRY)
+        except TheHiveException as err:
+            if not resilience.never_sent(err):
+                return Failure("outcome unknown, not sent again: {0}".format(err), UNKNOWN)
+            failure = Failure(str(err), RETRY)
+            retry_after = None
+            continue
+        # Missing or unreadable attachment; no point retrying
+        except OSError as err:
+            return Failure(str(err), REJECTED)
+        if resp.status_code == 201:
+            return None
+        # Only a 429/503 says the write was turned away; a 500/502/504 may have been applied upstream
+        if resp.status_code in resilience.WRITE_RETRY_STATUS:
+            kind = RETRY
+        elif resp.status_code >= 500:
+            kind = UNKNOWN
+        else:
+            kind = REJECTED
+        failure = Failure("HTTP {0}".format(resp.status_code), kind)
+        if not resilience.write_turned_away(resp):
+            break
+        retry_after = resp.headers.get('Retry-After')
+    return failure
+
+def ingest(api, task_id, entries, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES):
+    """Post entries through a bounded worker pool
+    :param api: thehive api connector
+    :param task_id: Default task to log against
+    :type task_id: string
+    :param entries: Entry dicts, e.g. from read_entries
+    :param workers: Number of concurrent requests
+    :type workers: int
+    :param retries: Retries per entry on throttling or server errors
+    :type retries: int
+    :return: summary with posted and failed counts, elapsed seconds, rate and failures
+    :rtype: dict
+    """
+    summary = {'posted': 0, 'failed': 0, 'failures': []}
+    lock = threading.Lock()
+    # Cap entries in flight, so a huge stdin stream is not read into memory ahead of the workers
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def worker(line_no, entry):
+        try:
+            failure = post_entry(api, task_id, entry, retries=retries)
+        finally:
+            in_flight.release()
+        with lock:
+            if failure:
+                summary['failed'] += 1
+                summary['failures'].append([line_no, failure])
+            else:
+                summary['posted'] += 1
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for line_no, entry in enumerate(entries, 1):
+            in_flight.acquire()
+            pool.submit(worker, line_no, entry)
+    summary['elapsed'] = time.time() - start
+    summary['rate'] = summary['posted'] / summary['elapsed'] if summary['elapsed'] else 0.0
+    return summary
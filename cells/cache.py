@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the on-disk case and task listing cache, and the observable and upload indexes'''
+
+# standard imports
+import sqlite3
+import threading
+import time
+
+# local imports
+from cells import records
+
+# The cache lives right next to .pollen_config
+CACHE_FILE = '.pollen_cache'
+# Defaults, overridable from the [Cache] section of .pollen_config
+DEFAULT_TTL = 300
+DEFAULT_MAX_LISTINGS = 50
+# Tags are stored in a single column; TheHive tags may contain commas but never newlines
+TAG_SEPARATOR = '\n'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (key TEXT PRIMARY KEY, synced_at REAL, accessed_at REAL);
+CREATE TABLE IF NOT EXISTS records (key TEXT, id TEXT, title TEXT, status TEXT, tags TEXT DEFAULT '',
+                                    PRIMARY KEY (key, id));
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS observable_sync (key TEXT PRIMARY KEY, synced_at REAL);
+CREATE TABLE IF NOT EXISTS observables (key TEXT, digest BLOB, PRIMARY KEY (key, digest)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS uploads (server TEXT, sha256 TEXT, task_id TEXT, log_id TEXT, attachment_id TEXT,
+                                    name TEXT, size INTEGER, uploaded_at REAL, PRIMARY KEY (server, sha256, task_id));
+"""
+
+class ListingCache(object):
+    '''SQLite-backed store of case and task listings (title, id, status and tags only)
+
+    Each listing (e.g. the open cases on a server, or the tasks of one case) remembers when it was
+    last synced, so callers can serve it straight from disk while it is fresh and only ask TheHive
+    for records updated since then once it goes stale. Least recently used listings are evicted
+    once there are more than max_listings of them.
+    '''
+    def __init__(self, path=CACHE_FILE, ttl=DEFAULT_TTL, max_listings=DEFAULT_MAX_LISTINGS):
+        '''Class initialization'''
+        self.ttl = ttl
+        self.max_listings = max_listings
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        # Caches written before tags were kept
+        if 'tags' not in [row[1] for row in self.conn.execute("PRAGMA table_info(records)")]:
+            self.conn.execute("ALTER TABLE records ADD COLUMN tags TEXT DEFAULT ''")
+
+    def lookup(self, key):
+        """Fetch a cached listing
+        :param key: Listing key
+        :type key: string
+        :return: records and the time of the last sync, or (None, None) if never synced
+        :rtype: tuple
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT synced_at FROM listings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            self.conn.execute("UPDATE listings SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            listing = [records.ListingRecord(title, record_id, status, tags.split(TAG_SEPARATOR) if tags else ())
+                       for title, record_id, status, tags
+                       in self.conn.execute("SELECT title, id, status, tags FROM records WHERE key = ? "
+                                            "ORDER BY rowid", (key,))]
+            return listing, row[0]
+
+    def is_fresh(self, synced_at):
+        '''Whether a listing synced at synced_at is still inside the TTL'''
+        return synced_at is not None and time.time() - synced_at < self.ttl
+
+    def store(self, key, records, synced_at, replace=True):
+        """Save a listing
+        :param key: Listing key
+        :type key: string
+        :param records: listing records (or dicts) with title, id and status, and optionally tags
+        :type records: list
+        :param synced_at: When the data was fetched from TheHive
+        :type synced_at: float
+        :param replace: Replace the listing outright (full sync) or merge into it (incremental sync)
+        :type replace: boolean
+        """
+        with self.lock:
+            if replace:
+                self.conn.execute("DELETE FROM records WHERE key = ?", (key,))
+            self.conn.executemany("INSERT OR REPLACE INTO records (key, id, title, status, tags) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  [(key, record['id'], record['title'], record['status'],
+                                    TAG_SEPARATOR.join(record.get('tags') or [])) for record in records])
+            self.conn.execute("INSERT OR REPLACE INTO listings (key, synced_at, accessed_at) VALUES (?, ?, ?)",
+                              (key, synced_at, time.time()))
+            self.evict()
+            self.conn.commit()
+
+    def expire(self, key):
+        """Mark a listing as stale (e.g. after pollen created something in it), so the next lookup
+        does an incremental refresh. The sync time is only pushed back, so nothing is missed.
+        :param key: Listing key
+        :type key: string
+        """
+        with self.lock:
+            self.conn.execute("UPDATE listings SET synced_at = synced_at - ? WHERE key = ?", (self.ttl, key))
+            self.conn.commit()
+
+    def evict(self):
+        '''Drop the least recently used listings beyond max_listings (caller holds the lock)'''
+        stale = self.conn.execute("SELECT key FROM listings ORDER BY accessed_at DESC LIMIT -1 OFFSET ?",
+                                  (self.max_listings,)).fetchall()
+        for (key,) in stale:
+            self.conn.execute("DELETE FROM records WHERE key = ?", (key,))
+            self.conn.execute("DELETE FROM listings WHERE key = ?", (key,))
+
+    def observable_index(self, key):
+        """Fetch the digests of a case's known observables
+        :param key: Index key, one per server and case
+        :type key: string
+        :return: set of digests and the time of the last sync, or (None, None) if never synced
+        :rtype: tuple
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT synced_at FROM observable_sync WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            return set(digest for (digest,) in self.conn.execute("SELECT digest FROM observables WHERE key = ?",
+                                                                  (key,))), row[0]
+
+    def store_observables(self, key, digests, synced_at=None, replace=False, removed=()):
+        """Add digests to a case's observable index
+        :param key: Index key
+        :type key: string
+        :param digests: Digests of observables now in the case
+        :type digests: iterable
+        :param synced_at: When they were fetched from TheHive; None leaves the sync time alone
+        :type synced_at: float
+        :param replace: Replace the whole index (full sync) rather than add to it
+        :type replace: boolean
+        :param removed: Digests of observables deleted from the case
+        :type removed: iterable
+        """
+        with self.lock:
+            if replace:
+                self.conn.execute("DELETE FROM observables WHERE key = ?", (key,))
+            self.conn.executemany("DELETE FROM observables WHERE key = ? AND digest = ?",
+                                  [(key, digest) for digest in removed])
+            self.conn.executemany("INSERT OR IGNORE INTO observables (key, digest) VALUES (?, ?)",
+                                  [(key, digest) for digest in digests])
+            if synced_at is not None:
+                self.conn.execute("INSERT OR REPLACE INTO observable_sync (key, synced_at) VALUES (?, ?)",
+                                  (key, synced_at))
+            self.conn.commit()
+
+    def uploads_of(self, server, sha256):
+        """Where an attachment with this content has been uploaded before
+        :param server: Server URL
+        :type server: string
+        :param sha256: SHA-256 of the attachment
+        :type sha256: string
+        :return: dicts with task_id, log_id, attachment_id, name and size, oldest first
+        :rtype: list
+        """
+        with self.lock:
+            return [dict(zip(('task_id', 'log_id', 'attachment_id', 'name', 'size'), row)) for row in
+                    self.conn.execute("SELECT task_id, log_id, attachment_id, name, size FROM uploads "
+                                      "WHERE server = ? AND sha256 = ? ORDER BY uploaded_at", (server, sha256))]
+
+    def record_upload(self, server, sha256, task_id, log_id, attachment_id, name, size):
+        '''Remember an attachment uploaded to a task; kept by clear(), as TheHive cannot be asked for it'''
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO uploads (server, sha256, task_id, log_id, attachment_id, name, "
+                              "size, uploaded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (server, sha256, task_id, log_id, attachment_id, name, size, time.time()))
+            self.conn.commit()
+
+    def count(self, name):
+        '''Bump one of the hit/miss/refresh counters'''
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)", (name,))
+            self.conn.execute("UPDATE stats SET value = value + 1 WHERE name = ?", (name,))
+            self.conn.commit()
+
+    def stats(self):
+        """Cache counters
+        :return: hits, misses and incremental refreshes, plus the number of cached listings
+        :rtype: dict
+        """
+        with self.lock:
+            cache_stats = {'hit': 0, 'miss': 0, 'refresh': 0}
+            cache_stats.update(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            cache_stats['listings'] = self.conn.execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+            return cache_stats
+
+    def clear(self):
+        '''Forget every cached listing and observable index (the counters are kept)'''
+        with self.lock:
+            self.conn.execute("DELETE FROM records")
+            self.conn.execute("DELETE FROM listings")
+            self.conn.execute("DELETE FROM observables")
+            self.conn.execute("DELETE FROM observable_sync")
+            self.conn.commit()
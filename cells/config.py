@@ -2,16 +2,188 @@
 '''Python module to contain configuration functions'''
 
 # standard imports
+import collections
 import configparser
 import os
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # thehive4py imports
-from thehive4py.api import TheHiveApi
 from thehive4py.exceptions import TheHiveException
+from thehive4py.query import And, Eq, Gt, Or
 
-CONFIG = configparser.ConfigParser()
+# local imports; hive and resilience (and with them requests) are imported by the functions that
+# talk to TheHive, so a --log handed to a running pollen agent never has to load them
+from cells import cache
+from cells import records
+
+CONFIG_FILE = '.pollen_config'
+
+# Case listings are fetched from TheHive a page at a time, and only these fields are kept
+CASE_PAGE_SIZE = 100
+CASE_FIELDS = ('title', 'id', 'status', 'tags')
+
+# Cases queried side by side when listing tasks across every open case
+TASK_WORKERS = 8
+
+# Listings are served from the on-disk cache unless this is switched off (e.g. with --no-cache)
+USE_CACHE = True
+LISTING_CACHE = None
+# Incremental refreshes ask for a little more than strictly needed, to ride out clock skew
+SYNC_OVERLAP = 60
+
+# The server in [TheHive]; any others live in [Profile <name>] sections
+DEFAULT_PROFILE = 'default'
+# Seconds a server gets to answer a query sent to every server, unless its profile sets a timeout
+SERVER_TIMEOUT = 30
+# Timeouts, retries and circuit breaker, built from the [Network] section on first use
+NETWORK_POLICY = None
+
+class PollenConfig(object):
+    '''.pollen_config, parsed once and only re-read when the file changes on disk
+
+    Every part of pollen used to re-read and re-parse the file, several times per command. This
+    object keeps the parsed copy, checks the file's mtime/size before handing it out, and writes
+    changes atomically (temp file + rename) so a crash can never leave a half-written config.
+    '''
+    def __init__(self, path=CONFIG_FILE):
+        '''Class initialization'''
+        self.path = path
+        self.parser = configparser.ConfigParser()
+        self.signature = None
+        # Profile the server, key and active case/task are read from; None is [TheHive]
+        self.profile = None
+
+    def load(self):
+        """Return the parsed config, re-reading the file only if it has changed
+        :return: parsed config
+        :rtype: configparser.ConfigParser
+        """
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+        if signature != self.signature:
+            self.parser = configparser.ConfigParser()
+            self.parser.read(self.path)
+            self.signature = signature
+        return self.parser
+
+    def exists(self):
+        '''Whether there is a config file with anything in it'''
+        return bool(self.load().sections())
+
+    def get(self, section, option, fallback=None):
+        '''Fetch a single string setting'''
+        return self.load().get(section, option, fallback=fallback)
+
+    def getint(self, section, option, fallback=None):
+        '''Fetch a single integer setting'''
+        return self.load().getint(section, option, fallback=fallback)
+
+    def getfloat(self, section, option, fallback=None):
+        '''Fetch a single decimal setting'''
+        return self.load().getfloat(section, option, fallback=fallback)
+
+    @staticmethod
+    def profile_section(profile):
+        '''Config section holding a profile'''
+        if profile in (None, DEFAULT_PROFILE):
+            return 'TheHive'
+        return 'Profile {0}'.format(profile)
+
+    @property
+    def section(self):
+        '''Config section of the profile in use'''
+        return self.profile_section(self.profile)
+
+    def profiles(self):
+        """Names of every configured server profile, default first
+        :return: profile names
+        :rtype: list
+        """
+        names = []
+        for section in self.load().sections():
+            if section == 'TheHive':
+                names.insert(0, DEFAULT_PROFILE)
+            elif section.startswith('Profile '):
+                names.append(section[len('Profile '):])
+        return names
+
+    @property
+    def server_url(self):
+        '''TheHive server address'''
+        return self.get(self.section, 'server_url')
+
+    @property
+    def server_api(self):
+        '''TheHive API key'''
+        return self.get(self.section, 'server_api')
+
+    @property
+    def case_name(self):
+        '''Name of the active case for --log, if one is set'''
+        return self.get(self.section, 'case_name')
+
+    @property
+    def case_id(self):
+        '''ID of the active case for --log, if one is set'''
+        return self.get(self.section, 'case_id')
+
+    @property
+    def task_name(self):
+        '''Name of the active task for --log, if one is set'''
+        return self.get(self.section, 'task_name')
+
+    @property
+    def task_id(self):
+        '''ID of the active task for --log, if one is set'''
+        return self.get(self.section, 'task_id')
+
+    @property
+    def colors(self):
+        '''Terminal and label colors, falling back to the terminal default'''
+        return (self.get('Personalization', 'term_color', fallback='\x1b[0m'),
+                self.get('Personalization', 'label_color', fallback='\x1b[0m'))
+
+    def update(self, section, **values):
+        """Set one or more options in a section and save the file
+        :param section: Config section, created if missing
+        :type section: string
+        """
+        parser = self.load()
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for option, value in values.items():
+            parser.set(section, option, str(value))
+        self.save()
+
+    def remove(self, section):
+        '''Drop a whole section and save the file'''
+        if self.load().remove_section(section):
+            self.save()
+
+    def save(self):
+        '''Atomically write the config back to disk'''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(prefix='.pollen_config.', dir=directory)
+        try:
+            with os.fdopen(handle, 'w') as configfile:
+                self.parser.write(configfile)
+                configfile.flush()
+                os.fsync(configfile.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        stat = os.stat(self.path)
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+
+CONFIG = PollenConfig()
 
 # Function to handle and standardize pollen errors. This simple function allows for potential error
 # messages and fixes to declared at the function level, allowing for better handling.
@@ -47,32 +219,25 @@ def prompt_handler(which_prompt=False, **kwargs):
     :type which_prompt: string or boolean
     :return: prompt with coloration
     :rtype: string
-    :raises KeyError: if a color has not been defined (error is handled by function logic)
     """
-    # Read config file and assign terminal_color
-    CONFIG.read('.pollen_config')
-    # Test for personalization first
-    try:
-        if CONFIG['Personalization']:
-            term_color = CONFIG['Personalization']['term_color']
-            label_color = CONFIG['Personalization']['label_color']
-    # If no personalization options have been set, set to default terminal colors
-    except KeyError:
-        term_color = '\x1b[0m'
-        label_color = '\x1b[0m'
+    # Personalized colors, or the terminal defaults if none have been set
+    term_color, label_color = CONFIG.colors
+    # Name the server in the prompt when it is not the default one
+    pollen = 'pollen@{0}'.format(CONFIG.profile) if CONFIG.profile else 'pollen'
     # If which_prompt exists, issue the correct response
     if which_prompt:
         if which_prompt == "config":
-            return '{0}(pollen:{1}config)\x1b[0m '.format(term_color, label_color)
+            return '{0}({2}:{1}config)\x1b[0m '.format(term_color, label_color, pollen)
         if which_prompt == "case":
             case = kwargs.get('case')
-            return '{0}(pollen) {1}case:{0}{2}\x1b[0m '.format(term_color, label_color, case)
+            return '{0}({3}) {1}case:{0}{2}\x1b[0m '.format(term_color, label_color, case, pollen)
         if which_prompt == "task":
             case = kwargs.get('case')
             task = kwargs.get('task')
-            return "{0}(pollen) {1}case:{0}{2} {1}task:{0}{3}\x1b[0m ".format(term_color, label_color, case, task)
+            return "{0}({4}) {1}case:{0}{2} {1}task:{0}{3}\x1b[0m ".format(term_color, label_color, case, task,
+                                                                             pollen)
     # If which_prompt is False, this means it is the default pollen prompt
-    return '{0}(pollen)\x1b[0m '.format(term_color)
+    return '{0}({1})\x1b[0m '.format(term_color, pollen)
 
 def test_api(server, apikey):
     """Test API connectivity to TheHive
@@ -82,15 +247,24 @@ def test_api(server, apikey):
     :rtype: boolean
     """
     # Basic API call; this happens quite frequently throughout the script, and was easier to model here.
-    api_test = TheHiveApi(server, apikey)
+    # Throwaway client with a single retry, so a wrong address is reported quickly; only the
+    # configured server/key pair is kept in the pooled registry
+    from cells import hive, resilience
+    policy = network_policy()
+    api_test = hive.PollenApi(server, apikey, policy=resilience.RetryPolicy(
+        connect_timeout=policy.connect_timeout, read_timeout=policy.read_timeout, retries=1))
     try:
-        api_test.find_first()
-    # TODO: Let's see if we can make this more TheHive exception specific
-    except KeyError:
+        resp = api_test.find_cases(range='0-1')
+    except TheHiveException as err:
+        print("WARNING: Cannot reach hostname provided ({0})\n".format(err))
+        return False
+    finally:
+        api_test.close()
+    if resp.status_code in (401, 403):
         print("WARNING: API Key failed\n")
         return False
-    except TheHiveException:
-        print("WARNING: Cannot reach hostname provided\n")
+    if resp.status_code != 200:
+        print("WARNING: TheHive answered with HTTP {0}\n".format(resp.status_code))
         return False
     return True
 
@@ -115,12 +289,13 @@ def server_config():
         # Move these to a function
         if not (cmdline_choice.lower() == "y" or cmdline_choice.lower() == "n"):
             print("Please enter a valid choice (Y/N)!")
-        if cmdline_choice.lower() == "n":
-            CONFIG['TheHive'] = {'server_url' : hiveserver, 'server_api' : hiveapi}
+        if cmdline_choice.lower() in ("y", "n"):
+            CONFIG.update(CONFIG.section, server_url=hiveserver, server_api=hiveapi)
         if cmdline_choice.lower() == "y":
-            pass
-        with open('.pollen_config', 'a+') as configfile:
-            CONFIG.write(configfile)
+            print("Server saved! Use the \x1b[1mcmdline\x1b[0m command in the config menu to pick the case and task.")
+        # Server details may have changed; drop any pooled sessions to the old server
+        from cells import hive
+        hive.reset_clients()
 
 def color_config():
     """Allow the analyst to set some custom color schemes for pollen"""
@@ -136,7 +311,6 @@ def color_config():
         ["White", "\x1b[1;37;40m"],
         ["Terminal Default", "\x1b[0m"]
     ]
-    CONFIG.read('.pollen_config')
     i = 0
     # The following while statement allows the color selector to repeat if user tries silly input
     while True:
@@ -165,15 +339,9 @@ def color_config():
             return False
         # As long as we have sufficient values, label and term colors are set, and the script restarts itself.
         if color_selection.lower() == "y":
-            # Ignore error if Personalization exists, which means we are simply updating colors
-            try:
-                CONFIG.add_section("Personalization")
-            except configparser.DuplicateSectionError:
-                pass
-            CONFIG.set("Personalization", "term_color", color_list[term_color][1])
-            CONFIG.set("Personalization", "label_color", color_list[label_color][1])
-            with open('.pollen_config', 'w') as configfile:
-                CONFIG.write(configfile)
+            # Personalization is created if needed, otherwise we are simply updating colors
+            CONFIG.update("Personalization", term_color=color_list[term_color][1],
+                          label_color=color_list[label_color][1])
             print("Restarting pollen in 2 seconds...")
             time.sleep(2)
             # Quick reminder that the following does depend on 'chmod +x'
@@ -185,57 +353,300 @@ def get_config(config_format):
     :type cmdline: string
     :return: TheHive configuration details
     :rtype: list
-    :raises KeyError: If TheHive server is reachable/exists (error is handled by function logic)
     """
-    CONFIG.read('.pollen_config')
-    hive_details = CONFIG['TheHive']
     if config_format == "cmdline":
-        try:
-            if CONFIG['TheHive']['case_id']:
-                return str(hive_details['task_id'])
-        except KeyError:
-            return False
+        # A case without a task is not enough for --log
+        if CONFIG.case_id and CONFIG.task_id:
+            return str(CONFIG.task_id)
+        return False
     if config_format == "basic":
-        try:
-            if hive_details['case_name']:
-                return hive_details['server_url'], hive_details['server_api'], hive_details['case_name'], hive_details['task_name']
-        except KeyError:
-            return hive_details['server_url'], hive_details['server_api']
+        if CONFIG.case_name:
+            return CONFIG.server_url, CONFIG.server_api, CONFIG.case_name, CONFIG.task_name
+        return CONFIG.server_url, CONFIG.server_api
+
+def network_policy():
+    """Timeouts, retries and circuit breaker settings, from the [Network] section of the config if present
+    :return: retry policy shared by every client
+    :rtype: resilience.RetryPolicy
+    """
+    global NETWORK_POLICY
+    if NETWORK_POLICY is None:
+        from cells import resilience
+        NETWORK_POLICY = resilience.RetryPolicy(
+            connect_timeout=CONFIG.getfloat('Network', 'connect_timeout', fallback=resilience.DEFAULT_CONNECT_TIMEOUT),
+            read_timeout=CONFIG.getfloat('Network', 'read_timeout', fallback=resilience.DEFAULT_READ_TIMEOUT),
+            retries=CONFIG.getint('Network', 'retries', fallback=resilience.DEFAULT_RETRIES),
+            backoff=CONFIG.getfloat('Network', 'backoff', fallback=resilience.DEFAULT_BACKOFF),
+            max_backoff=CONFIG.getfloat('Network', 'max_backoff', fallback=resilience.MAX_BACKOFF),
+            breaker_threshold=CONFIG.getint('Network', 'breaker_threshold', fallback=resilience.BREAKER_THRESHOLD),
+            breaker_reset=CONFIG.getfloat('Network', 'breaker_reset', fallback=resilience.BREAKER_RESET))
+    return NETWORK_POLICY
 
 def get_api():
-    """Establish API
+    """Establish API. Clients are pooled per server/API key pair, so repeated calls share one
+    keep-alive session rather than paying for a new connection each time
     :return: thehive api connector
-    :rtype: TheHiveApi
+    :rtype: PollenApi
     """
+    from cells import hive
     server_details = get_config(config_format="basic")
-    api = TheHiveApi(server_details[0], server_details[1])
-    return api
+    return hive.get_client(server_details[0], server_details[1], policy=network_policy())
+
+def profile_api(profile):
+    """Pooled API client for a named server profile, with the profile's timeout if it sets one
+    :param profile: Profile name, e.g. 'default'
+    :type profile: string
+    :return: thehive api connector
+    :rtype: PollenApi
+    """
+    from cells import hive
+    section = CONFIG.profile_section(profile)
+    client = hive.get_client(CONFIG.get(section, 'server_url'), CONFIG.get(section, 'server_api'),
+                             policy=network_policy())
+    timeout = CONFIG.get(section, 'timeout')
+    if timeout:
+        client.timeout = float(timeout)
+    return client
+
+def use_profile(profile):
+    """Switch this pollen session to another server profile
+    :param profile: Profile name
+    :type profile: string
+    :return: whether the profile exists
+    :rtype: boolean
+    """
+    if profile not in CONFIG.profiles():
+        return False
+    CONFIG.profile = None if profile == DEFAULT_PROFILE else profile
+    # Pick up the profile's timeout, if any
+    profile_api(profile)
+    return True
+
+def fan_out(work, profiles=None):
+    """Run the same query against several servers at once. Each server only gets its own timeout
+    (the profile's timeout option, or SERVER_TIMEOUT), so one slow instance cannot hold up the rest
+    :param work: Callable taking (profile name, api connector) and returning that server's result
+    :param profiles: Profiles to query; every configured profile by default
+    :type profiles: list
+    :return: profile name to [result, error], in profile order; error is None on success
+    :rtype: collections.OrderedDict
+    """
+    profiles = profiles or CONFIG.profiles()
+    results = collections.OrderedDict((profile, [None, 'timed out']) for profile in profiles)
+    threads = []
+
+    def run(profile, api):
+        try:
+            results[profile] = [work(profile, api), None]
+        except Exception as err:
+            results[profile] = [None, str(err) or err.__class__.__name__]
 
-def get_cases(output_format, case_id=False):
+    start = time.time()
+    for profile in profiles:
+        api = profile_api(profile)
+        # Daemon threads, so a server that never answers cannot keep pollen from exiting either
+        thread = threading.Thread(target=run, args=(profile, api), daemon=True)
+        thread.start()
+        threads.append((profile, thread, api.timeout or SERVER_TIMEOUT))
+    for profile, thread, timeout in threads:
+        thread.join(max(timeout - (time.time() - start), 0))
+    return collections.OrderedDict((profile, list(results[profile])) for profile in profiles)
+
+def all_case_stats(profiles=None):
+    """Case counts per status on every server, plus the combined counts
+    :param profiles: Profiles to query; every configured profile by default
+    :type profiles: list
+    :return: per-profile [stats, error] and the merged stats
+    :rtype: tuple
+    """
+    results = fan_out(lambda profile, api: get_case_stats(api=api), profiles)
+    merged = {}
+    for case_stats, error in results.values():
+        for status, count in (case_stats or {}).items():
+            merged[status] = merged.get(status, 0) + count
+    return results, merged
+
+def all_open_cases(profiles=None):
+    """Open cases of every server, merged into one listing
+    :param profiles: Profiles to query; every configured profile by default
+    :type profiles: list
+    :return: per-profile errors, and case records tagged with the profile they came from
+    :rtype: tuple
+    """
+    results = fan_out(lambda profile, api: open_cases(api=api), profiles)
+    errors = collections.OrderedDict()
+    merged = []
+    for profile, (cases, error) in results.items():
+        if error:
+            errors[profile] = error
+            continue
+        for case in cases:
+            merged.append(dict(case, profile=profile))
+    return errors, merged
+
+def changed_since(since):
+    """Query matching records created or updated after a point in time
+    :param since: Epoch time in milliseconds, as used by TheHive
+    :type since: int
+    :return: thehive query
+    :rtype: dict
+    """
+    return Or(Gt('updatedAt', since), Gt('createdAt', since))
+
+def get_cache():
+    """Open the listing cache, sized from the [Cache] section of the config if present
+    :return: listing cache
+    :rtype: ListingCache
+    """
+    global LISTING_CACHE
+    if LISTING_CACHE is None:
+        LISTING_CACHE = cache.ListingCache(ttl=CONFIG.getint('Cache', 'ttl', fallback=cache.DEFAULT_TTL),
+                                           max_listings=CONFIG.getint('Cache', 'max_listings',
+                                                                      fallback=cache.DEFAULT_MAX_LISTINGS))
+    return LISTING_CACHE
+
+def listing_key(case_id=None, server=None):
+    """Cache key for the open cases on a server, or for the tasks of one case
+    :param case_id: TheHive case ID, if the key is for a task listing
+    :type case_id: string
+    :param server: Server URL; the configured server by default
+    :type server: string
+    :return: listing key
+    :rtype: string
+    """
+    server = server or get_config(config_format="basic")[0]
+    if case_id:
+        return '{0}|tasks|{1}'.format(server, case_id)
+    return '{0}|cases'.format(server)
+
+def refresh_cache():
+    """Throw away every cached listing, so the next lookups go back to TheHive"""
+    get_cache().clear()
+
+def cached_listing(key, full_fetch, delta_fetch):
+    """Serve a listing from the cache, syncing it with TheHive only when it has gone stale
+    :param key: Listing key within the cache
+    :type key: string
+    :param full_fetch: Callable returning every record of the listing
+    :param delta_fetch: Callable returning records changed since a given epoch time in milliseconds
+    :return: records with title, id and status
+    :rtype: list
+    """
+    listing_cache = get_cache()
+    listing, synced_at = listing_cache.lookup(key)
+    if listing_cache.is_fresh(synced_at):
+        listing_cache.count('hit')
+        return listing
+    sync_start = time.time()
+    # Never seen this listing before; fetch all of it
+    if listing is None:
+        listing_cache.count('miss')
+        listing = list(full_fetch())
+        listing_cache.store(key, listing, sync_start)
+        return listing
+    # Stale listing; only ask for what has changed since the last sync
+    listing_cache.count('refresh')
+    listing_cache.store(key, list(delta_fetch(int((synced_at - SYNC_OVERLAP) * 1000))),
+                        sync_start, replace=False)
+    return listing_cache.lookup(key)[0]
+
+def iter_cases(status=None, page_size=CASE_PAGE_SIZE, fields=CASE_FIELDS, since=None, api=None):
+    """Lazily page through cases, letting TheHive do the status filtering
+    :param status: Only return cases with this status (e.g. 'Open'); False/None for every case
+    :type status: string
+    :param page_size: Number of cases requested per round-trip
+    :type page_size: int
+    :param fields: Case fields to keep; None keeps the full case document
+    :type fields: tuple
+    :param since: Only return cases created or updated after this epoch time in milliseconds
+    :type since: int
+    :param api: thehive api connector; the configured server by default
+    :return: one case at a time, trimmed down to the requested fields (a compact ListingRecord for
+        the default CASE_FIELDS)
+    :rtype: generator
+    :raises TheHiveException: If a page could not be fetched
+    """
+    # TheHive 3's search API has no field projection, so each page is decoded a case at a time as it
+    # arrives and only the small records are kept
+    api = api or get_api()
+    criteria = []
+    if status:
+        criteria.append(Eq('status', status))
+    if since is not None:
+        criteria.append(changed_since(since))
+    query = And(*criteria) if criteria else {}
+    start = 0
+    while True:
+        resp = api.find_cases(query=query, sort=['-createdAt'], range='{0}-{1}'.format(start, start + page_size),
+                              stream=bool(fields))
+        if not fields:
+            if resp.status_code != 200:
+                raise TheHiveException("HTTP {0} from TheHive".format(resp.status_code))
+            page = resp.json()
+        elif fields == CASE_FIELDS:
+            page = records.search_records(resp)
+        else:
+            page = [{field: case.get(field) for field in fields} for case in records.iter_search(resp)]
+        for case in page:
+            yield case
+        if len(page) < page_size:
+            return
+        start += page_size
+
+def get_case_stats(api=None):
+    """Count cases per status on the server side, rather than downloading every case
+    :param api: thehive api connector; the configured server by default
+    :return: case counts keyed by status
+    :rtype: dict
+    """
+    api = api or get_api()
+    resp = api.case_stats('status')
+    if resp.status_code == 200:
+        return {status: details.get('count', 0)
+                for status, details in resp.json().get('status', {}).items()}
+    # Older servers without the stats endpoint; fall back to paging through status only
+    case_stats = {}
+    for case in iter_cases(fields=('status',), api=api):
+        case_stats[case['status']] = case_stats.get(case['status'], 0) + 1
+    return case_stats
+
+def open_cases(api=None):
+    """Open cases of a server, from the listing cache unless it is switched off
+    :param api: thehive api connector; the configured server by default
+    :return: open cases with title, id, status and tags
+    :rtype: list
+    """
+    api = api or get_api()
+    if USE_CACHE:
+        # Incremental syncs include cases that have since been closed, so filter here too
+        return [case for case in cached_listing(listing_key(server=api.url),
+                                                lambda: iter_cases(status='Open', api=api),
+                                                lambda since: iter_cases(since=since, api=api))
+                if case['status'] == 'Open']
+    return list(iter_cases(status='Open', api=api))
+
+def get_cases(output_format, case_id=False, api=None):
     """Quick function to grab case names and provide to CLI
     :param output_format: The data format requested
     :type output_format: string
     :param case_id: Whether to include the case_id in the output
     :type case_id: boolean
+    :param api: thehive api connector; the configured server by default
     :return: thehive case list in a specified format
     :rtype: list
     """
-    # TODO: Might rework this to be more config friendly
-    api = get_api()
-    case_list = []
-    cases = api.find_cases().json()
     if output_format == "json_full":
-        return cases
-    if output_format == "name_list":
-        for case in cases:
-            if case['status'] == 'Open':
-                if case_id:
-                    case_list.append([case['title'], case['id']])
-                else:
-                    case_list.append(case['title'])
-        return case_list
-
-def get_tasks(case_id, output_format, task_id=False):
+        return list(iter_cases(fields=None, api=api))
+    if output_format in ("name_list", "records"):
+        cases = open_cases(api)
+        # Title, id, status and tags of each open case, e.g. for the search index
+        if output_format == "records":
+            return cases
+        if case_id:
+            return [(case['title'], case['id']) for case in cases]
+        return [case['title'] for case in cases]
+
+def get_tasks(case_id, output_format, task_id=False, api=None):
     """Quick function to grab task names and return to CLI
     :param case_id: TheHive case ID for the case of interest
     :type case_id: string
@@ -243,19 +654,111 @@ def get_tasks(case_id, output_format, task_id=False):
     :type output_format: string
     :param task_id: Whether to include the case_id in the output
     :type task_id: boolean
+    :param api: thehive api connector; the configured server by default
     :return: thehive task list in a specified format
     :rtype: list
     """
     # TODO: Might rework this to be more config friendly
-    api = get_api()
-    task_list = []
-    tasks = api.get_case_tasks(case_id).json()
+    api = api or get_api()
     if output_format == "json_full":
-        return tasks
-    if output_format == "name_list":
+        return api.get_case_tasks(case_id).json()
+    if output_format in ("name_list", "records"):
+        if USE_CACHE:
+            tasks = cached_listing(listing_key(case_id, server=api.url),
+                                   lambda: task_records(api, case_id),
+                                   lambda since: task_records(api, case_id, query=changed_since(since)))
+        else:
+            tasks = task_records(api, case_id)
+        if output_format == "records":
+            return tasks
+        if task_id:
+            return [(task['title'], task['id']) for task in tasks]
+        return [(task['title'], task['status']) for task in tasks]
+
+def task_records(api, case_id, **attributes):
+    """Fetch the tasks of a case as compact listing records, decoding the response as it arrives
+    :param api: thehive api connector
+    :param case_id: TheHive case ID
+    :type case_id: string
+    :return: tasks with title, id and status only
+    :rtype: list
+    """
+    return records.search_records(api.get_case_tasks(case_id, stream=True, **attributes))
+
+def trim_tasks(tasks):
+    """Keep only the task fields pollen lists
+    :param tasks: Full task documents from TheHive
+    :type tasks: list
+    :return: tasks with title, id and status only
+    :rtype: list
+    """
+    return [records.ListingRecord.from_doc(task) for task in tasks]
+
+def iter_open_tasks(status=None, owner=None, workers=TASK_WORKERS):
+    """Fan task queries out over every open case through a bounded thread pool, handing back each
+    case's tasks as soon as they arrive rather than after the slowest case
+    :param status: Only return tasks with this status (e.g. 'Waiting'), filtered by TheHive
+    :type status: string
+    :param owner: Only return tasks owned by this user login
+    :type owner: string
+    :param workers: Number of concurrent task queries
+    :type workers: int
+    :return: [case title, case id] and that case's tasks, in order of arrival
+    :rtype: generator
+    """
+    api = get_api()
+    criteria = []
+    if status:
+        criteria.append(Eq('status', status))
+    if owner:
+        criteria.append(Eq('owner', owner))
+
+    def case_tasks(case):
+        if criteria:
+            return case, task_records(api, case[1], query=And(*criteria))
+        return case, task_records(api, case[1])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(case_tasks, case) for case in get_cases(output_format="name_list", case_id=True)]
+        for future in as_completed(futures):
+            yield future.result()
+
+def task_overview(status=None, mine=False):
+    """Print tasks across every open case, streaming them to the terminal case by case
+    :param status: Only show tasks with this status
+    :type status: string
+    :param mine: Only show tasks owned by the user the API key belongs to
+    :type mine: boolean
+    """
+    owner = get_api().get_current_user().json().get('id') if mine else None
+    task_count = 0
+    for case, tasks in iter_open_tasks(status=status, owner=owner):
         for task in tasks:
-            if task_id:
-                task_list.append([task['title'], task['id']])
-            else:
-                task_list.append([task['title'], task['status']])
-        return task_list
+            print("\tCase: {0} | Task Title: {1} | Status: {2}".format(case[0], task['title'], task['status']))
+            task_count += 1
+    print("\nThere are currently {0} matching tasks across open cases.".format(task_count))
+
+def server_overview(list_cases=False):
+    """Print case stats (and optionally the open cases) of every configured server, side by side
+    :param list_cases: Also list every open case, labelled with its server
+    :type list_cases: boolean
+    """
+    results, merged = all_case_stats()
+    print("\x1b[1m***** Case Stats Across Servers *****\x1b[0m")
+    for profile, (case_stats, error) in results.items():
+        if error:
+            print("\t{0}: unavailable ({1})".format(profile, error))
+            continue
+        open_case_count = case_stats.get('Open', 0)
+        print("\t{0}: {1} Open Cases, {2} Closed Cases".format(profile, open_case_count,
+                                                             sum(case_stats.values()) - open_case_count))
+    open_case_count = merged.get('Open', 0)
+    print("\tAll servers: {0} Open Cases, {1} Closed Cases".format(open_case_count,
+                                                                sum(merged.values()) - open_case_count))
+    if list_cases:
+        errors, cases = all_open_cases()
+        print("\n\x1b[1m***** Open Cases Across Servers *****\x1b[0m")
+        for case in cases:
+            print("\t[{0}] {1} ({2})".format(case['profile'], case['title'], case['id']))
+        for profile, error in errors.items():
+            print("\t[{0}] unavailable ({1})".format(profile, error))
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain streaming case exports (JSONL, gzipped JSONL or Parquet)'''
+
+# standard imports
+import collections
+import gzip
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+from thehive4py.query import Id, Parent
+
+# local imports
+from cells import config
+from cells import records
+
+# Tasks and task logs are requested this many at a time
+PAGE_SIZE = 500
+# Cases fetched side by side; this also caps how many cases are held in memory at once
+EXPORT_WORKERS = 4
+# Parquet rows buffered before a row group is written
+PARQUET_BATCH = 1000
+
+def pages(find, page_size=PAGE_SIZE, **attributes):
+    """Page through a search, decoding each page as it arrives rather than reading it whole
+    :param find: PollenApi find method, e.g. api.find_tasks
+    :param page_size: Records per request
+    :type page_size: int
+    :return: one record at a time
+    :rtype: generator
+    :raises TheHiveException: If a page could not be fetched
+    :raises ValueError: If a page was cut short
+    """
+    start = 0
+    while True:
+        count = 0
+        for record in records.iter_search(find(range='{0}-{1}'.format(start, start + page_size), stream=True,
+                                               **attributes)):
+            count += 1
+            yield record
+        if count < page_size:
+            return
+        start += page_size
+
+def case_records(api, case):
+    """Every record of one case: the case itself, its tasks and their logs. The logs of all the tasks
+    come from one search, rather than one search per task
+    :param api: thehive api connector
+    :param case: Full case document
+    :type case: dict
+    :return: records tagged with their kind, in export order
+    :rtype: list
+    """
+    # Logs first, so every log found belongs to a task the second search will list
+    logs = {}
+    for log in pages(api.find_task_logs, query=Parent('case_task', Parent('case', Id(case['id']))),
+                     sort=['+createdAt']):
+        logs.setdefault(log.get('_parent'), []).append(log)
+    rows = [dict(case, _kind='case')]
+    for task in pages(api.find_tasks, query=Parent('case', Id(case['id'])), sort=['+order', '+createdAt']):
+        rows.append(dict(task, _kind='task', _case=case['id']))
+        for log in logs.pop(task['id'], []):
+            rows.append(dict(log, _kind='log', _case=case['id'], _task=task['id']))
+    return rows
+
+class JsonlWriter(object):
+    '''One JSON record per line, gzipped if the path ends in .gz'''
+    def __init__(self, path):
+        '''Class initialization'''
+        self.handle = gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')
+
+    def write(self, record):
+        self.handle.write(json.dumps(record) + '\n')
+
+    def close(self):
+        self.handle.close()
+
+class ParquetWriter(object):
+    '''Parquet file with kind, id, case, task and the full JSON record per row, written in row groups
+
+    TheHive records vary too much in shape for a fixed column-per-field schema, so the record itself
+    is kept as a JSON string next to the columns needed to filter and join on.
+    '''
+    def __init__(self, path):
+        '''Class initialization'''
+        # Optional dependency; only needed for Parquet exports
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([('kind', pyarrow.string()), ('id', pyarrow.string()),
+                                      ('case_id', pyarrow.string()), ('task_id', pyarrow.string()),
+                                      ('record', pyarrow.string())])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+        self.rows = []
+
+    def write(self, record):
+        self.rows.append({'kind': record['_kind'], 'id': record.get('id'), 'case_id': record.get('_case'),
+                          'task_id': record.get('_task'), 'record': json.dumps(record)})
+        if len(self.rows) >= PARQUET_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(self.pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def open_writer(path):
+    '''Pick a writer from the file extension (.jsonl, .jsonl.gz or .parquet)'''
+    if path.endswith('.parquet'):
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+class AttachmentFetcher(object):
+    '''Downloads attachments in parallel, each distinct file only once
+
+    Attachments are stored by SHA-256 (as reported by TheHive), so the same file attached to many
+    logs or cases is downloaded and stored once, and files already in the directory from an earlier
+    export are not downloaded again. Each download is checked against its expected hash.
+    '''
+    def __init__(self, api, directory, workers):
+        '''Class initialization'''
+        self.api = api
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = threading.BoundedSemaphore(workers * 2)
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'deduplicated': 0, 'failed': 0, 'bytes': 0, 'failures': []}
+
+    def fetch(self, attachment):
+        """Queue an attachment for download
+        :param attachment: The attachment of a task log
+        :type attachment: dict
+        :return: file name the attachment is stored under, relative to the directory
+        :rtype: string
+        """
+        hashes = attachment.get('hashes') or []
+        name = hashes[0] if hashes else 'id-{0}'.format(attachment['id'])
+        with self.lock:
+            if name in self.seen or os.path.exists(os.path.join(self.directory, name)):
+                self.stats['deduplicated'] += 1
+                return name
+            self.seen.add(name)
+        self.in_flight.acquire()
+        self.pool.submit(self.download, attachment, name, hashes[0] if hashes else None)
+        return name
+
+    def download(self, attachment, name, expected):
+        partial = os.path.join(self.directory, name + '.part')
+        try:
+            digest, size = self.api.download_attachment(attachment['id'], partial)
+            if expected and digest != expected:
+                raise TheHiveException("checksum mismatch")
+            os.replace(partial, os.path.join(self.directory, name))
+            with self.lock:
+                self.stats['downloaded'] += 1
+                self.stats['bytes'] += size
+        except (TheHiveException, OSError) as err:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            with self.lock:
+                self.stats['failed'] += 1
+                self.stats['failures'].append([attachment.get('name', name), str(err)])
+        finally:
+            self.in_flight.release()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+def export(api, path, cases, workers=EXPORT_WORKERS, attachments=None):
+    """Stream cases with their tasks and logs to a file, fetching several cases at once while keeping
+    the output in case order. Only workers * 2 cases are held in memory at any one time.
+    :param api: thehive api connector
+    :param path: Output file; .jsonl, .jsonl.gz or .parquet
+    :type path: string
+    :param cases: Full case documents, e.g. from config.iter_cases(fields=None)
+    :param workers: Number of cases fetched at once
+    :type workers: int
+    :param attachments: Directory to download attachments to; None skips attachments
+    :type attachments: string
+    :return: counts of exported records and attachment statistics
+    :rtype: dict
+    """
+    summary = {'case': 0, 'task': 0, 'log': 0, 'failures': []}
+    start = time.time()
+    writer = open_writer(path)
+    fetcher = AttachmentFetcher(api, attachments, workers) if attachments else None
+    window = collections.deque()
+
+    def write_next():
+        case, future = window.popleft()
+        try:
+            rows = future.result()
+        except (TheHiveException, ValueError) as err:
+            summary['failures'].append([case.get('title'), str(err)])
+            return
+        for record in rows:
+            if fetcher and record['_kind'] == 'log' and record.get('attachment'):
+                record['_attachment_file'] = fetcher.fetch(record['attachment'])
+            writer.write(record)
+            summary[record['_kind']] += 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for case in cases:
+                window.append((case, pool.submit(case_records, api, case)))
+                if len(window) >= workers * 2:
+                    write_next()
+            while window:
+                write_next()
+    finally:
+        writer.close()
+        if fetcher:
+            fetcher.close()
+    summary['elapsed'] = time.time() - start
+    summary['attachments'] = fetcher.stats if fetcher else None
+    return summary
+
+def export_cases(path, case_ids=None, status='Open', workers=EXPORT_WORKERS, attachments=None):
+    """Export the given cases, or every case with a status, from the configured server
+    :param path: Output file; .jsonl, .jsonl.gz or .parquet
+    :type path: string
+    :param case_ids: Case IDs to export; None exports by status
+    :type case_ids: list
+    :param status: Case status to export when no IDs are given; None exports every case
+    :type status: string
+    :return: export summary
+    :rtype: dict
+    """
+    api = config.get_api()
+    if case_ids:
+        cases = (pages(api.find_cases, query=Id(case_id)) for case_id in case_ids)
+        cases = (case for found in cases for case in found)
+    else:
+        cases = config.iter_cases(status=status, fields=None)
+    return export(api, path, cases, workers=workers, attachments=attachments)
+
+def report(summary, path):
+    """Print an export summary
+    :param summary: Summary returned by export
+    :type summary: dict
+    :param path: Where the export was written
+    :type path: string
+    """
+    print("Bzz Bzz Bzz...exported {0} cases, {1} tasks and {2} logs to {3} in {4:.1f}s".format(
+        summary['case'], summary['task'], summary['log'], path, summary['elapsed']))
+    for title, failure in summary['failures']:
+        print("\tCase {0}: {1}".format(title, failure))
+    if summary['attachments']:
+        stats = summary['attachments']
+        print("\tAttachments: {0} downloaded ({1:.1f} MiB), {2} already had, {3} failed".format(
+            stats['downloaded'], stats['bytes'] / 1048576.0, stats['deduplicated'], stats['failed']))
+        for name, failure in stats['failures']:
+            print("\t\t{0}: {1}".format(name, failure))
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the pooled TheHive API client and its registry'''
+
+# standard imports
+import hashlib
+import json
+import threading
+import time
+
+# third-party imports
+import requests
+
+# thehive4py imports; thehive4py.api and .models are deliberately avoided, as they drag in libmagic
+# and slow down every one-shot --log
+from thehive4py.exceptions import TheHiveException, CaseException, CaseObservableException, CaseTaskException
+from thehive4py.query import And, Id, Parent
+
+# local imports
+from cells import perf
+from cells import resilience
+from cells import upload
+
+# One client (and therefore one keep-alive connection pool) per server/API key pair
+REGISTRY = {}
+REGISTRY_LOCK = threading.Lock()
+
+class PollenApi(object):
+    '''Lean TheHive API client that sends every request over a single pooled requests.Session
+
+    thehive4py's TheHiveApi calls requests.get/post directly, which opens a brand new connection
+    (and TLS handshake) for every call. This client covers the calls pollen makes, with the same
+    names and signatures as TheHiveApi, and all of them go through self.session instead. Every call
+    has connect and read timeouts, reads are retried with backoff, and a circuit breaker fails calls
+    fast while the server is down (see cells.resilience).
+    '''
+    def __init__(self, url, principal, pool_size=10, policy=None):
+        '''Class initialization'''
+        self.url = url
+        self.principal = principal
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Authorization'] = 'Bearer {0}'.format(principal)
+        self.request_count = 0
+        # Clients are shared between threads, and += is not atomic
+        self.count_lock = threading.Lock()
+        self.policy = policy or resilience.RetryPolicy()
+        self.breaker = resilience.CircuitBreaker(self.policy.breaker_threshold, self.policy.breaker_reset)
+        # Read timeout for this server (e.g. a profile's timeout option); the policy's otherwise
+        self.timeout = None
+
+    def request(self, method, path, error=TheHiveException, **kwargs):
+        """Send a request to TheHive over the pooled session. Reads are retried on connection errors,
+        timeouts and 429/5xx responses (honouring Retry-After); writes only when they never reached
+        the server, so nothing is ever created twice
+        :param method: HTTP method
+        :type method: string
+        :param path: API path, relative to the server URL
+        :type path: string
+        :param error: thehive4py exception to raise on connection errors
+        :return: response from TheHive
+        :rtype: requests.Response
+        :raises TheHiveException: If the request could not be sent, or the circuit breaker is open
+        """
+        kwargs.setdefault('timeout', (self.policy.connect_timeout, self.timeout or self.policy.read_timeout))
+        retry_reads = resilience.idempotent(method, path)
+        # A streamed upload has been (partly) read by the first attempt and cannot be sent again
+        replayable = not hasattr(kwargs.get('data'), 'read')
+        attempt = 0
+        while True:
+            self.breaker.check(self.url)
+            opened = self.opened_connections()
+            start = time.perf_counter()
+            try:
+                resp = self.session.request(method, self.url + path, **kwargs)
+            except requests.exceptions.RequestException as err:
+                perf.record_call(method, path, start, new_connection=self.opened_connections() > opened,
+                                 error=str(err))
+                self.breaker.failure()
+                if attempt < self.policy.retries and replayable and (retry_reads or resilience.never_sent(err)):
+                    time.sleep(self.policy.delay(attempt))
+                    attempt += 1
+                    continue
+                raise error("Error on {0} {1}: {2}".format(method, path, err)) from err
+            with self.count_lock:
+                self.request_count += 1
+            perf.record_call(method, path, start, resp, new_connection=self.opened_connections() > opened)
+            if resp.status_code in resilience.SERVER_DOWN_STATUS:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            if retry_reads and resp.status_code in resilience.RETRY_STATUS and attempt < self.policy.retries:
+                wait = self.policy.delay(attempt, resp.headers.get('Retry-After'))
+                resp.close()
+                time.sleep(wait)
+                attempt += 1
+                continue
+            return resp
+
+    def get_current_user(self):
+        '''Fetch the user the API key belongs to'''
+        return self.request('GET', "/api/user/current")
+
+    def find_rows(self, path, error=TheHiveException, **attributes):
+        '''Pooled equivalent of thehive4py's private __find_rows; stream=True leaves the body unread'''
+        params = {"range": attributes.get("range", "all"),
+                  "sort": attributes.get("sort", [])}
+        return self.request('POST', path, error=error, params=params, stream=attributes.get("stream", False),
+                            json={"query": attributes.get("query", {})})
+
+    def find_cases(self, **attributes):
+        '''Find cases using sort, pagination and a query'''
+        return self.find_rows("/api/case/_search", error=CaseException, **attributes)
+
+    def find_tasks(self, **attributes):
+        '''Find case tasks using sort, pagination and a query'''
+        return self.find_rows("/api/case/task/_search", error=CaseTaskException, **attributes)
+
+    def find_task_logs(self, **attributes):
+        '''Find task logs using sort, pagination and a query'''
+        return self.find_rows("/api/case/task/log/_search", error=CaseTaskException, **attributes)
+
+    def find_observables(self, **attributes):
+        '''Find case observables using sort, pagination and a query'''
+        return self.find_rows("/api/case/artifact/_search", error=CaseObservableException, **attributes)
+
+    def get_case_observables(self, case_id, **attributes):
+        '''Find observables of a given case identified by its id'''
+        criteria = Parent('case', Id(case_id))
+        if "query" in attributes:
+            criteria = And(criteria, attributes["query"])
+        attributes["query"] = criteria
+        return self.find_observables(**attributes)
+
+    def case_stats(self, field, query=None):
+        """Ask TheHive to aggregate cases by a field, rather than downloading every case
+        :param field: Case field to group by, e.g. status
+        :type field: string
+        :param query: Optional query to narrow the cases counted
+        :type query: dict
+        :return: response from the case stats endpoint
+        :rtype: requests.Response
+        """
+        stats = [{"_agg": "field", "_field": field, "_select": [{"_agg": "count"}]},
+                 {"_agg": "count"}]
+        return self.request('POST', "/api/case/_stats", error=CaseException,
+                            json={"query": query or {}, "stats": stats})
+
+    def get_case_tasks(self, case_id, **attributes):
+        '''Find tasks of a given case identified by its id'''
+        criteria = Parent('case', Id(case_id))
+        if "query" in attributes:
+            criteria = And(criteria, attributes["query"])
+        attributes["query"] = criteria
+        return self.find_tasks(**attributes)
+
+    def create_case(self, case):
+        '''Create a case'''
+        return self.request('POST', "/api/case", error=CaseException,
+                            headers={'Content-Type': 'application/json'},
+                            data=case.jsonify(excludes=['id']))
+
+    def create_case_task(self, case_id, case_task):
+        '''Create a task within a case'''
+        return self.request('POST', "/api/case/{0}/task".format(case_id), error=CaseTaskException,
+                            headers={'Content-Type': 'application/json'},
+                            data=case_task.jsonify(excludes=['id']))
+
+    def create_observables(self, case_id, data_type, values, **details):
+        """Create many observables of one data type in a single call; TheHive makes one observable
+        per value and answers 207 Multi-Status if some of them could not be created
+        :param case_id: Case to add the observables to
+        :type case_id: string
+        :param data_type: TheHive data type, e.g. ip or domain
+        :type data_type: string
+        :param values: Observable values
+        :type values: list
+        :param details: Any of message, tlp, ioc and tags, shared by every value
+        :return: response from TheHive
+        :rtype: requests.Response
+        """
+        body = dict(details, dataType=data_type, data=list(values))
+        return self.request('POST', "/api/case/{0}/artifact".format(case_id), error=CaseObservableException,
+                            headers={'Content-Type': 'application/json'}, data=json.dumps(body))
+
+    def add_task_log(self, task_id, message):
+        """Create a plain task log from a message, without needing a thehive4py CaseTaskLog
+        :param task_id: Task to log against
+        :type task_id: string
+        :param message: Log message
+        :type message: string
+        :return: response from TheHive
+        :rtype: requests.Response
+        """
+        return self.request('POST', "/api/case/task/{0}/log".format(task_id), error=CaseTaskException,
+                            headers={'Content-Type': 'application/json'},
+                            data=json.dumps({'message': message}))
+
+    def upload_task_log(self, task_id, message, file_path, progress=None, filename=None):
+        """Create a task log with an attachment streamed from disk in fixed-size chunks, rather than
+        read into memory the way CaseTaskLog(file=...) does
+        :param task_id: Task to log against
+        :type task_id: string
+        :param message: Log message
+        :type message: string
+        :param file_path: File to attach
+        :type file_path: string
+        :param progress: Optional callable taking (bytes sent, total bytes)
+        :param filename: Name to give the attachment; the file's own name by default
+        :type filename: string
+        :return: response from TheHive
+        :rtype: requests.Response
+        """
+        body = upload.MultipartFile(file_path, {'_json': json.dumps({"message": message})}, progress=progress,
+                                    filename=filename)
+        try:
+            return self.request('POST', "/api/case/task/{0}/log".format(task_id), error=CaseTaskException,
+                                headers={'Content-Type': body.content_type}, data=body)
+        finally:
+            body.close()
+
+    def download_attachment(self, attachment_id, destination, chunk_size=upload.CHUNK_SIZE):
+        """Stream an attachment from TheHive's datastore to disk, a chunk at a time
+        :param attachment_id: Datastore ID of the attachment
+        :type attachment_id: string
+        :param destination: File to write
+        :type destination: string
+        :param chunk_size: Largest piece held in memory at once
+        :type chunk_size: int
+        :return: SHA-256 of the downloaded file and its size in bytes
+        :rtype: tuple
+        :raises TheHiveException: If the download fails
+        """
+        resp = self.request('GET', "/api/datastore/{0}".format(attachment_id), stream=True)
+        with resp:
+            if resp.status_code != 200:
+                raise TheHiveException("HTTP {0} downloading attachment {1}".format(resp.status_code, attachment_id))
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with open(destination, 'wb') as attachment:
+                    for chunk in resp.iter_content(chunk_size):
+                        digest.update(chunk)
+                        attachment.write(chunk)
+                        size += len(chunk)
+            except requests.exceptions.RequestException as err:
+                raise TheHiveException("Error downloading attachment {0}: {1}".format(attachment_id, err))
+        return digest.hexdigest(), size
+
+    def open_stream(self):
+        '''Ask TheHive for a new audit stream; the response body is the stream ID'''
+        return self.request('POST', "/api/stream")
+
+    def read_stream(self, stream_id, timeout):
+        """Wait on an audit stream for the next batch of events. TheHive holds the request open
+        until something happens or its refresh period passes, so this is a long poll
+        :param stream_id: ID from open_stream
+        :type stream_id: string
+        :param timeout: Seconds to wait before giving up on the server
+        :type timeout: float
+        :return: response from TheHive, a JSON list of audit events
+        :rtype: requests.Response
+        """
+        return self.request('GET', "/api/stream/{0}".format(stream_id), timeout=timeout)
+
+    def opened_connections(self):
+        '''Number of connections the pool has opened so far'''
+        opened = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                opened += pools[key].num_connections
+        return opened
+
+    def connection_stats(self):
+        """Report how well the keep-alive pool is doing
+        :return: requests sent, connections opened and reused, and the circuit breaker state
+        :rtype: dict
+        """
+        opened = self.opened_connections()
+        return {'requests': self.request_count,
+                'connections': opened,
+                'reused': max(self.request_count - opened, 0),
+                'breaker': self.breaker.state}
+
+    def close(self):
+        '''Close every pooled connection'''
+        self.session.close()
+
+def get_client(server, apikey, policy=None):
+    """Fetch the pooled client for a server/API key pair, building it on first use
+    :param server: Server IP address or URL
+    :param apikey: API Key to connect to TheHive server
+    :param policy: Timeouts and retries for a new client; the resilience defaults otherwise
+    :type policy: resilience.RetryPolicy
+    :return: pooled thehive api connector
+    :rtype: PollenApi
+    """
+    with REGISTRY_LOCK:
+        client = REGISTRY.get((server, apikey))
+        if client is None:
+            client = PollenApi(server, apikey, policy=policy)
+            REGISTRY[(server, apikey)] = client
+        return client
+
+def reset_clients():
+    '''Drop every pooled client, e.g. after the server config has been changed'''
+    with REGISTRY_LOCK:
+        for client in REGISTRY.values():
+            client.close()
+        REGISTRY.clear()
+
+def client_stats():
+    """Connection reuse counters for every live client
+    :return: server URL and its connection stats
+    :rtype: list
+    """
+    with REGISTRY_LOCK:
+        return [[client.url, client.connection_stats()] for client in REGISTRY.values()]
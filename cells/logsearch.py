@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the local full-text search index over task logs'''
+
+# standard imports
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+from thehive4py.query import And, Id, Parent
+
+# local imports
+from cells import config
+from cells import records
+
+# The index lives right next to .pollen_config, apart from the listing cache as it can grow large
+INDEX_FILE = '.pollen_logs'
+# Seconds a sync stays good for; searches within this window do not touch TheHive at all
+SYNC_INTERVAL = 60
+# Cases synced side by side
+SYNC_WORKERS = 8
+# Hits shown per search
+HIT_LIMIT = 20
+# Words of context either side of a match
+SNIPPET_WORDS = 12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (rowid INTEGER PRIMARY KEY, server TEXT, log_id TEXT, case_id TEXT,
+                                    task_id TEXT, created_at INTEGER, author TEXT, UNIQUE (server, log_id));
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(message, tokenize = 'unicode61');
+CREATE TABLE IF NOT EXISTS titles (server TEXT, id TEXT, title TEXT, PRIMARY KEY (server, id));
+CREATE TABLE IF NOT EXISTS synced (server TEXT, case_id TEXT, synced_at REAL, PRIMARY KEY (server, case_id));
+"""
+
+def fts_query(text):
+    """Turn what the analyst typed into an FTS5 query: every word must appear, a word is matched as
+    a phrase of its tokens (so 10.1.2.3 finds 10.1.2.3 and not 10, 1, 2 and 3 anywhere), and a
+    trailing * matches any word starting with it
+    :param text: Search terms
+    :type text: string
+    :return: FTS5 MATCH expression
+    :rtype: string
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append('"{0}"{1}'.format(word, '*' if prefix else ''))
+    return ' '.join(terms)
+
+class LogIndex(object):
+    '''SQLite FTS5 index of task log messages, with the case and task each one belongs to
+
+    Each case remembers when it was last synced, so after the first full fetch only logs created or
+    changed since then are asked for. Queries run entirely against the local index and come back
+    ranked by relevance (BM25), in a few milliseconds however many cases there are.
+    '''
+    def __init__(self, path=INDEX_FILE):
+        '''Class initialization'''
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def synced_at(self, server):
+        '''Last sync time of every indexed case on a server'''
+        with self.lock:
+            return dict(self.conn.execute("SELECT case_id, synced_at FROM synced WHERE server = ?", (server,)))
+
+    def store(self, server, case_id, logs, titles, synced_at):
+        """Add (or replace) the logs of one case
+        :param server: Server URL
+        :type server: string
+        :param case_id: Case the logs belong to
+        :type case_id: string
+        :param logs: Task log documents; deleted ones are dropped from the index
+        :type logs: list
+        :param titles: Case and task titles by ID
+        :type titles: dict
+        :param synced_at: When the logs were fetched from TheHive
+        :type synced_at: float
+        """
+        with self.lock:
+            for log in logs:
+                row = self.conn.execute("SELECT rowid FROM entries WHERE server = ? AND log_id = ?",
+                                        (server, log['id'])).fetchone()
+                if row:
+                    self.conn.execute("DELETE FROM messages WHERE rowid = ?", row)
+                    self.conn.execute("DELETE FROM entries WHERE rowid = ?", row)
+                if log.get('status', 'Ok') == 'Deleted' or not log.get('message'):
+                    continue
+                rowid = self.conn.execute("INSERT INTO entries (server, log_id, case_id, task_id, created_at, author) "
+                                          "VALUES (?, ?, ?, ?, ?, ?)",
+                                          (server, log['id'], case_id, log.get('_parent'),
+                                           log.get('createdAt') or log.get('startDate'),
+                                           log.get('createdBy') or log.get('owner'))).lastrowid
+                self.conn.execute("INSERT INTO messages (rowid, message) VALUES (?, ?)", (rowid, log['message']))
+            self.conn.executemany("INSERT OR REPLACE INTO titles (server, id, title) VALUES (?, ?, ?)",
+                                  [(server, record_id, title) for record_id, title in titles.items()])
+            self.conn.execute("INSERT OR REPLACE INTO synced (server, case_id, synced_at) VALUES (?, ?, ?)",
+                              (server, case_id, synced_at))
+            self.conn.commit()
+
+    def search(self, server, text, limit=HIT_LIMIT):
+        """Ranked hits for a query
+        :param server: Server URL
+        :type server: string
+        :param text: Search terms
+        :type text: string
+        :param limit: Most hits returned
+        :type limit: int
+        :return: dicts with case, task, created_at, author and a snippet of the message, best first
+        :rtype: list
+        """
+        query = fts_query(text)
+        if not query:
+            return []
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT entries.case_id, case_titles.title, entries.task_id, task_titles.title, entries.created_at, "
+                "entries.author, snippet(messages, 0, '\x1b[1m', '\x1b[0m', '...', ?) FROM messages "
+                "JOIN entries ON entries.rowid = messages.rowid "
+                "LEFT JOIN titles AS case_titles ON case_titles.server = entries.server AND case_titles.id = entries.case_id "
+                "LEFT JOIN titles AS task_titles ON task_titles.server = entries.server AND task_titles.id = entries.task_id "
+                "WHERE messages MATCH ? AND entries.server = ? ORDER BY bm25(messages) LIMIT ?",
+                (SNIPPET_WORDS, query, server, limit)).fetchall()
+        return [dict(zip(('case_id', 'case', 'task_id', 'task', 'created_at', 'author', 'snippet'), row))
+                for row in rows]
+
+    def stats(self, server):
+        '''Indexed cases and log entries for a server'''
+        with self.lock:
+            return {'cases': self.conn.execute("SELECT COUNT(*) FROM synced WHERE server = ?", (server,)).fetchone()[0],
+                    'logs': self.conn.execute("SELECT COUNT(*) FROM entries WHERE server = ?", (server,)).fetchone()[0]}
+
+    def prune(self, server, case_ids):
+        """Forget the cases of a server that are not in a listing, e.g. ones closed since they were synced
+        :param server: Server URL
+        :type server: string
+        :param case_ids: IDs of the cases to keep
+        :type case_ids: set
+        :return: number of cases forgotten
+        :rtype: int
+        """
+        with self.lock:
+            gone = [(server, case_id) for (case_id,) in
+                    self.conn.execute("SELECT case_id FROM synced WHERE server = ?", (server,))
+                    if case_id not in case_ids]
+            if not gone:
+                return 0
+            self.conn.executemany("DELETE FROM messages WHERE rowid IN "
+                                  "(SELECT rowid FROM entries WHERE server = ? AND case_id = ?)", gone)
+            self.conn.executemany("DELETE FROM entries WHERE server = ? AND case_id = ?", gone)
+            self.conn.executemany("DELETE FROM synced WHERE server = ? AND case_id = ?", gone)
+            # Titles of the forgotten cases, and of tasks nothing indexed points to any more
+            self.conn.execute("DELETE FROM titles WHERE server = ? AND id NOT IN (SELECT case_id FROM synced "
+                              "WHERE server = ?) AND id NOT IN (SELECT task_id FROM entries WHERE server = ? "
+                              "AND task_id IS NOT NULL)", (server, server, server))
+            self.conn.commit()
+            return len(gone)
+
+    def clear(self, server):
+        '''Forget everything indexed from a server'''
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE rowid IN (SELECT rowid FROM entries WHERE server = ?)",
+                              (server,))
+            for table in ('entries', 'titles', 'synced'):
+                self.conn.execute("DELETE FROM {0} WHERE server = ?".format(table), (server,))
+            self.conn.commit()
+
+INDEX = None
+
+def get_index():
+    '''Open the task log index once per process'''
+    global INDEX
+    if INDEX is None:
+        INDEX = LogIndex()
+    return INDEX
+
+def fetch_case(api, case, synced_at):
+    """Task logs of one case, all of them or only those changed since the last sync
+    :param api: thehive api connector
+    :param case: Listing record of the case
+    :param synced_at: Last sync of this case, or None
+    :type synced_at: float
+    :return: the case ID, its logs, case and task titles by ID, and when the fetch started
+    :rtype: tuple
+    """
+    fetch_start = time.time()
+    query = Parent('case_task', Parent('case', Id(case['id'])))
+    if synced_at:
+        query = And(query, config.changed_since(int((synced_at - config.SYNC_OVERLAP) * 1000)))
+    logs = list(records.iter_search(api.find_task_logs(query=query, stream=True)))
+    titles = {case['id']: case['title']}
+    titles.update((task['id'], task['title'])
+                  for task in config.get_tasks(case['id'], output_format="records", api=api))
+    return case['id'], logs, titles, fetch_start
+
+def sync(force=False, workers=SYNC_WORKERS):
+    """Bring the index up to date with the open cases, fetching several cases at once. Cases that are
+    no longer open are dropped from the index, so searches only ever hit open cases
+    :param force: Sync even if the last sync was only moments ago
+    :type force: boolean
+    :param workers: Number of cases fetched side by side
+    :type workers: int
+    :return: cases synced, logs fetched, cases dropped, failures and elapsed seconds
+    :rtype: dict
+    """
+    api = config.get_api()
+    index = get_index()
+    now = time.time()
+    open_cases = config.get_cases(output_format="records", api=api)
+    summary = {'cases': 0, 'logs': 0, 'dropped': index.prune(api.url, set(case['id'] for case in open_cases)),
+               'failures': []}
+    known = index.synced_at(api.url)
+    cases = [case for case in open_cases
+             if force or not config.USE_CACHE or now - known.get(case['id'], 0) >= SYNC_INTERVAL]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch_case, api, case, known.get(case['id'])): case for case in cases}
+        for future in as_completed(futures):
+            try:
+                case_id, logs, titles, fetch_start = future.result()
+            except (TheHiveException, ValueError) as err:
+                summary['failures'].append([futures[future]['title'], str(err)])
+                continue
+            # Written from this thread only, so SQLite never sees concurrent writers
+            index.store(api.url, case_id, logs, titles, fetch_start)
+            summary['cases'] += 1
+            summary['logs'] += len(logs)
+    summary['elapsed'] = time.time() - now
+    return summary
+
+def search(text, limit=HIT_LIMIT):
+    """Sync the index if it has gone stale, then search it
+    :param text: Search terms
+    :type text: string
+    :param limit: Most hits returned
+    :type limit: int
+    :return: hits, sync summary and seconds spent on the query itself
+    :rtype: tuple
+    """
+    summary = sync()
+    start = time.time()
+    hits = get_index().search(config.get_api().url, text, limit)
+    return hits, summary, time.time() - start
+
+def report(hits, summary, elapsed):
+    """Print search hits
+    :param hits: Hits returned by search
+    :type hits: list
+    :param summary: Sync summary returned by search
+    :type summary: dict
+    :param elapsed: Seconds spent on the query
+    :type elapsed: float
+    """
+    if summary['cases']:
+        print("Synced {0} new or changed log entries from {1} cases in {2:.2f}s".format(
+            summary['logs'], summary['cases'], summary['elapsed']))
+    for title, failure in summary['failures']:
+        print("\tCould not sync {0}: {1}".format(title, failure))
+    print("{0} hits in {1:.1f} ms".format(len(hits), elapsed * 1000))
+    for hit in hits:
+        when = time.strftime('%Y-%m-%d %H:%M', time.localtime(hit['created_at'] / 1000.0)) if hit['created_at'] else ''
+        print("\n\t{0} > {1} ({2}, {3})".format(hit['case'] or hit['case_id'], hit['task'] or hit['task_id'],
+                                               when, hit['author'] or 'unknown'))
+        print("\t\t{0}".format(re.sub(r'\s+', ' ', hit['snippet'])))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain bulk case and task creation from templates and manifests'''
+
+# standard imports
+import csv
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+from thehive4py.models import Case, CaseTask
+from thehive4py.query import And, Eq
+
+# local imports
+from cells import bulk
+from cells import config
+from cells import resilience
+
+# Case fields a manifest may set; anything else in a case entry is ignored
+CASE_FIELDS = ('title', 'description', 'tags', 'severity', 'tlp', 'pap', 'flag', 'owner', 'customFields')
+TASK_FIELDS = ('title', 'description', 'group', 'owner', 'flag')
+
+def fill(value, variables):
+    '''Substitute {placeholders} in a template value (recursing into lists and dicts)'''
+    if isinstance(value, str):
+        for name, replacement in variables.items():
+            value = value.replace('{' + name + '}', replacement)
+        return value
+    if isinstance(value, list):
+        return [fill(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: fill(item, variables) for key, item in value.items()}
+    return value
+
+def read_manifest(path, variables=None):
+    """Read cases and their tasks from a JSON template/manifest or a CSV manifest
+    JSON: {"case": {...}, "tasks": [{...}, ...]}, or a list of those. CSV: one row per task with
+    case_title, case_description, case_tags (semicolon separated), task_title, task_description
+    and task_group columns; rows with the same case_title make up one case.
+    :param path: Manifest file
+    :type path: string
+    :param variables: Values for {placeholders} in the manifest, e.g. {'client': 'ACME'}
+    :type variables: dict
+    :return: dicts with a case (or None, for tasks only) and its tasks, in manifest order
+    :rtype: list
+    """
+    if path.lower().endswith('.csv'):
+        entries = {}
+        with open(path, newline='') as manifest_file:
+            for row in csv.DictReader(manifest_file):
+                title = (row.get('case_title') or '').strip()
+                if title not in entries:
+                    tags = [tag.strip() for tag in (row.get('case_tags') or '').split(';') if tag.strip()]
+                    case = {'title': title, 'description': row.get('case_description') or title, 'tags': tags}
+                    entries[title] = {'case': case if title else None, 'tasks': []}
+                if (row.get('task_title') or '').strip():
+                    entries[title]['tasks'].append({'title': row['task_title'].strip(),
+                                                    'description': row.get('task_description') or '',
+                                                    'group': row.get('task_group') or 'default'})
+        manifest = list(entries.values())
+    else:
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if isinstance(manifest, dict):
+            manifest = [manifest]
+    manifest = fill(manifest, variables or {})
+    if not isinstance(manifest, list):
+        raise ValueError("{0} should hold an object or a list of objects".format(path))
+    for number, entry in enumerate(manifest, 1):
+        if not isinstance(entry, dict):
+            raise ValueError("entry {0} of {1} is not an object with a case and tasks".format(number, path))
+        entry.setdefault('case', None)
+        entry.setdefault('tasks', [])
+        if entry['case'] is not None and not isinstance(entry['case'], dict):
+            raise ValueError("the case of entry {0} in {1} is not an object".format(number, path))
+        if not isinstance(entry['tasks'], list) or not all(isinstance(task, dict) for task in entry['tasks']):
+            raise ValueError("the tasks of entry {0} in {1} are not a list of objects".format(number, path))
+        if entry['case'] is not None and not entry['case'].get('title'):
+            raise ValueError("Every case in {0} needs a title".format(path))
+        for task in entry['tasks']:
+            if not task.get('title'):
+                raise ValueError("Every task in {0} needs a title".format(path))
+    return manifest
+
+def with_retries(call, retries, backoff=bulk.DEFAULT_BACKOFF, ok_status=(201,)):
+    """Make a create call, sending it again only when it never reached TheHive, or TheHive turned it
+    away with a 429/503 and a Retry-After (which is then honoured). A call that may have been acted
+    on, such as one that timed out waiting for the answer, is never repeated, so a slow server
+    cannot end up with two copies of a case, task or observable
+    :param call: Callable returning a requests.Response
+    :param ok_status: Status codes that count as success
+    :type ok_status: tuple
+    :return: the response on success (201), otherwise a short description of the failure
+    :rtype: requests.Response or string
+    """
+    failure = None
+    retry_after = None
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(resilience.delay(attempt - 1, backoff, retry_after))
+        try:
+            resp = call()
+        except resilience.CircuitOpen as err:
+            return str(err)
+        except TheHiveException as err:
+            if not resilience.never_sent(err):
+                return "outcome unknown, not sent again: {0}".format(err)
+            failure = str(err)
+            retry_after = None
+            continue
+        if resp.status_code in ok_status:
+            return resp
+        failure = "HTTP {0}".format(resp.status_code)
+        if not resilience.write_turned_away(resp):
+            break
+        retry_after = resp.headers.get('Retry-After')
+    return failure
+
+def find_case(api, title):
+    '''Open case with exactly this title, if there is one; raises TheHiveException if TheHive cannot say'''
+    resp = api.find_cases(query=And(Eq('title', title), Eq('status', 'Open')), range='0-10')
+    if resp.status_code != 200:
+        raise TheHiveException("HTTP {0} looking for an open case called {1}".format(resp.status_code, title))
+    matches = [case for case in resp.json() if case.get('title') == title]
+    return matches[0] if matches else None
+
+def task_titles(api, case_id):
+    '''Titles of the tasks a case already has; raises TheHiveException if TheHive cannot say'''
+    resp = api.get_case_tasks(case_id)
+    if resp.status_code != 200:
+        raise TheHiveException("HTTP {0} listing the tasks of case {1}".format(resp.status_code, case_id))
+    return set(task['title'] for task in resp.json())
+
+def create_entry(api, entry, case_id=None, workers=bulk.DEFAULT_WORKERS, retries=bulk.DEFAULT_RETRIES):
+    """Create (or reuse) one case and create its missing tasks concurrently. Cases are matched to open
+    cases and tasks to existing tasks by title, so running a manifest again only fills the gaps
+    :param api: thehive api connector
+    :param entry: Manifest entry with a case and tasks
+    :type entry: dict
+    :param case_id: Add the tasks to this case instead of the entry's case
+    :type case_id: string
+    :param workers: Number of concurrent task creations
+    :type workers: int
+    :param retries: Retries per request on throttling or server errors
+    :type retries: int
+    :return: summary of what was created, skipped and failed
+    :rtype: dict
+    """
+    summary = {'case': entry['case']['title'] if entry['case'] else case_id, 'case_id': case_id,
+               'case_created': False, 'created': 0, 'skipped': 0, 'failed': 0, 'failures': []}
+    if case_id is None and entry['case'] is None:
+        summary.update(case='(none)', failed=1, failures=[['(none)', "no case in the manifest entry"]])
+        return summary
+    if case_id is None:
+        try:
+            existing = find_case(api, entry['case']['title'])
+        except TheHiveException as err:
+            # Creating the case blind could duplicate one that is already there
+            summary.update(failed=1, failures=[[summary['case'], str(err)]])
+            return summary
+        if existing:
+            case_id = existing['id']
+        else:
+            case = Case(**{field: entry['case'][field] for field in CASE_FIELDS if field in entry['case']})
+            resp = with_retries(lambda: api.create_case(case), retries)
+            if isinstance(resp, str):
+                summary['failed'] += 1
+                summary['failures'].append([summary['case'], resp])
+                return summary
+            case_id = resp.json()['id']
+            summary['case_created'] = True
+            config.get_cache().expire(config.listing_key())
+        summary['case_id'] = case_id
+    try:
+        existing_titles = task_titles(api, case_id)
+    except TheHiveException as err:
+        summary['failed'] += 1
+        summary['failures'].append([summary['case'], str(err)])
+        return summary
+    lock = threading.Lock()
+
+    def create_task(order, task):
+        case_task = CaseTask(**{field: task[field] for field in TASK_FIELDS if field in task})
+        # Tasks are created concurrently, so pin the manifest order explicitly
+        case_task.order = order
+        resp = with_retries(lambda: api.create_case_task(case_id, case_task), retries)
+        with lock:
+            if isinstance(resp, str):
+                summary['failed'] += 1
+                summary['failures'].append([task['title'], resp])
+            else:
+                summary['created'] += 1
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for order, task in enumerate(entry['tasks']):
+            if task['title'] in existing_titles:
+                summary['skipped'] += 1
+                continue
+            pool.submit(create_task, order, task)
+    if summary['created']:
+        config.get_cache().expire(config.listing_key(case_id))
+    return summary
+
+def apply(api, manifest, case_id=None, workers=bulk.DEFAULT_WORKERS, retries=bulk.DEFAULT_RETRIES):
+    """Create every case and task of a manifest
+    :param api: thehive api connector
+    :param manifest: Entries from read_manifest
+    :type manifest: list
+    :param case_id: Add every entry's tasks to this existing case instead
+    :type case_id: string
+    :return: one summary per entry
+    :rtype: list
+    """
+    return [create_entry(api, entry, case_id=case_id, workers=workers, retries=retries) for entry in manifest]
+
+def report(summaries):
+    """Print manifest results
+    :param summaries: Summaries returned by apply
+    :type summaries: list
+    """
+    for summary in summaries:
+        print("Bzz Bzz Bzz...case {0}: {1}, {2} tasks created, {3} already there, {4} failed".format(
+            summary['case'], 'created' if summary['case_created'] else 'existing', summary['created'],
+            summary['skipped'], summary['failed']))
+        for title, failure in summary['failures']:
+            print("\t{0}: {1}".format(title, failure))
+    if any(summary['failed'] for summary in summaries):
+        print("Run the same manifest again to retry; cases and tasks that already exist are skipped.")
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain bulk observable (IOC) import with a local dedup index'''
+
+# standard imports
+import csv
+import hashlib
+import ipaddress
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+
+# local imports
+from cells import bulk
+from cells import config
+from cells import manifest
+from cells import records
+
+# Values sent per create call; TheHive makes one observable per value of a list
+BATCH_SIZE = 100
+DEFAULT_TLP = 2
+# Hex digests by length
+HASH_LENGTHS = (32, 40, 64, 128)
+HEX = re.compile(r'^[0-9a-f]+$')
+DOMAIN = re.compile(r'^(?=.{1,253}$)(?:[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,62}$')
+MAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+URL = re.compile(r'^[a-z][a-z0-9+.-]*://\S+$', re.IGNORECASE)
+# Defanged notation often found in reports, e.g. hxxp://evil[.]com
+DEFANGED = ((re.compile(r'^hxxp', re.IGNORECASE), 'http'), (re.compile(r'^fxp', re.IGNORECASE), 'ftp'),
+            (re.compile(r'\[\.\]|\(\.\)|\[dot\]', re.IGNORECASE), '.'), (re.compile(r'\[@\]|\[at\]', re.IGNORECASE), '@'),
+            (re.compile(r'\[:\]'), ':'))
+# Columns a CSV may keep its values, data types, tags and messages in
+VALUE_COLUMNS = ('data', 'value', 'observable', 'ioc', 'indicator')
+TYPE_COLUMNS = ('datatype', 'data_type', 'type')
+TAG_COLUMNS = ('tags', 'tag', 'labels')
+MESSAGE_COLUMNS = ('message', 'description', 'comment')
+# STIX 2 object properties and the TheHive data types they map to
+STIX_TYPES = {('ipv4-addr', 'value'): 'ip', ('ipv6-addr', 'value'): 'ip', ('domain-name', 'value'): 'domain',
+              ('url', 'value'): 'url', ('email-addr', 'value'): 'mail', ('file', 'name'): 'filename',
+              ('file', 'hashes'): 'hash', ('autonomous-system', 'number'): 'autonomous-system',
+              ('windows-registry-key', 'key'): 'registry', ('user-agent', 'value'): 'user-agent'}
+STIX_COMPARISON = re.compile(r"([\w-]+):([\w-]+)(?:\.[\w.'-]+)?\s*=\s*'((?:[^'\\]|\\.)*)'")
+
+def refang(value):
+    '''Undo the usual defanging, e.g. hxxp://evil[.]com becomes http://evil.com'''
+    for pattern, replacement in DEFANGED:
+        value = pattern.sub(replacement, value)
+    return value
+
+def guess_type(value):
+    """Work out the data type of a value from a plain list
+    :param value: Observable value, already refanged
+    :type value: string
+    :return: TheHive data type
+    :rtype: string
+    """
+    try:
+        ipaddress.ip_network(value, strict=False)
+        return 'ip'
+    except ValueError:
+        pass
+    lowered = value.lower()
+    if len(lowered) in HASH_LENGTHS and HEX.match(lowered):
+        return 'hash'
+    if URL.match(value):
+        return 'url'
+    if MAIL.match(value):
+        return 'mail'
+    if DOMAIN.match(lowered.rstrip('.')):
+        return 'domain'
+    return 'other'
+
+def normalise(data_type, value):
+    """Canonical form of an observable, so the same IOC written two ways is only sent once
+    :param data_type: TheHive data type, or None to guess it from the value
+    :type data_type: string
+    :param value: Observable value
+    :type value: string
+    :return: data type and value, or None if the value is empty or not valid for its type
+    :rtype: tuple
+    """
+    value = str(value).strip()
+    if not value:
+        return None
+    if data_type in (None, '', 'ip', 'domain', 'fqdn', 'url', 'mail'):
+        value = refang(value)
+    data_type = data_type or guess_type(value)
+    if data_type == 'ip':
+        try:
+            return data_type, str(ipaddress.ip_network(value, strict=False) if '/' in value
+                                  else ipaddress.ip_address(value))
+        except ValueError:
+            return None
+    if data_type == 'hash':
+        value = value.lower()
+        return (data_type, value) if len(value) in HASH_LENGTHS and HEX.match(value) else None
+    if data_type in ('domain', 'fqdn'):
+        value = value.lower().rstrip('.')
+        return (data_type, value) if DOMAIN.match(value) else None
+    if data_type == 'mail':
+        return (data_type, value.lower()) if MAIL.match(value) else None
+    if data_type == 'url':
+        if not URL.match(value):
+            return None
+        parts = urlsplit(value)
+        # Scheme and host are case-insensitive; the rest of a URL is not
+        return data_type, urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/',
+                                      parts.query, parts.fragment))
+    return data_type, value
+
+def digest(data_type, value):
+    '''Compact key of a normalised observable, as kept in the dedup index'''
+    return hashlib.blake2b('{0}\x00{1}'.format(data_type, value).encode('utf-8'), digest_size=16).digest()
+
+def stix_observables(objects):
+    """Observables from STIX 2 objects: indicators with a STIX pattern, and cyber observables
+    :param objects: STIX objects, e.g. the objects of a bundle
+    :type objects: list
+    :return: one observable dict at a time
+    :rtype: generator
+    """
+    for stix in objects:
+        if not isinstance(stix, dict):
+            continue
+        if stix.get('type') == 'indicator':
+            if stix.get('pattern_type', 'stix') != 'stix':
+                continue
+            for object_type, prop, value in STIX_COMPARISON.findall(stix.get('pattern', '')):
+                data_type = STIX_TYPES.get((object_type, prop))
+                if data_type:
+                    yield {'dataType': data_type, 'data': value.replace("\\'", "'"),
+                           'message': stix.get('name') or stix.get('description'), 'tags': stix.get('labels')}
+            continue
+        for (object_type, prop), data_type in STIX_TYPES.items():
+            if stix.get('type') != object_type or prop not in stix:
+                continue
+            values = stix[prop].values() if isinstance(stix[prop], dict) else [stix[prop]]
+            for value in values:
+                yield {'dataType': data_type, 'data': value}
+
+def read_observables(source, data_type=None):
+    """Read observables from a CSV file, a STIX 2 bundle (.json) or a plain list, one per line
+    :param source: Path to read from, or '-' for a plain list on stdin
+    :type source: string
+    :param data_type: Data type of every value; otherwise taken from the file or guessed
+    :type data_type: string
+    :return: dicts with dataType (None when it is to be guessed) and data, and optionally tags and message
+    :rtype: generator
+    """
+    if source.lower().endswith(('.json', '.stix', '.stix2')):
+        with open(source) as stix_file:
+            document = json.load(stix_file)
+        objects = document.get('objects', [document]) if isinstance(document, dict) else document
+        for observable in stix_observables(objects):
+            if data_type:
+                observable['dataType'] = data_type
+            yield observable
+        return
+    handle = sys.stdin if source == '-' else open(source, newline='')
+    try:
+        if source.lower().endswith('.csv'):
+            reader = csv.reader(handle)
+            first_row = next(reader, [])
+            header = [column.strip().lower() for column in first_row]
+            columns = {}
+            for name, candidates in (('data', VALUE_COLUMNS), ('dataType', TYPE_COLUMNS),
+                                     ('tags', TAG_COLUMNS), ('message', MESSAGE_COLUMNS)):
+                found = [header.index(column) for column in candidates if column in header]
+                if found:
+                    columns[name] = found[0]
+            if 'data' not in columns:
+                # No header; the first column of every row, the first row included, holds the values
+                columns = {'data': 0}
+                reader = itertools.chain([first_row], reader)
+            for row in reader:
+                if len(row) <= columns['data']:
+                    continue
+                observable = {field: row[index].strip() for field, index in columns.items() if index < len(row)}
+                if 'tags' in observable:
+                    observable['tags'] = [tag.strip() for tag in observable['tags'].split(';') if tag.strip()]
+                observable['dataType'] = data_type or observable.get('dataType') or None
+                yield observable
+            return
+        for line in handle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield {'dataType': data_type, 'data': line}
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+def index_key(api, case_id):
+    '''Key of a case's observable index; one per server and case'''
+    return '{0}|observables|{1}'.format(api.url, case_id)
+
+def doc_digest(doc):
+    '''Index digest of an observable document from TheHive, or None for file observables'''
+    if doc.get('data') is None:
+        return None
+    normalised = normalise(doc.get('dataType'), doc['data']) or (doc.get('dataType'), doc['data'])
+    return digest(*normalised)
+
+def sync_index(api, case_id):
+    """Bring the local index of a case's observables up to date: the first time every observable of
+    the case is fetched, after that only those created or changed since the last sync
+    :param api: thehive api connector
+    :param case_id: Case to index
+    :type case_id: string
+    :return: digests of the observables in the case
+    :rtype: set
+    """
+    index, synced_at = config.get_cache().observable_index(index_key(api, case_id)) if config.USE_CACHE else (None, None)
+    sync_start = time.time()
+    if index is None:
+        index = set()
+        for doc in records.iter_search(api.get_case_observables(case_id, stream=True)):
+            if doc.get('status', 'Ok') == 'Ok' and doc_digest(doc):
+                index.add(doc_digest(doc))
+        if config.USE_CACHE:
+            config.get_cache().store_observables(index_key(api, case_id), index, sync_start, replace=True)
+        return index
+    added, removed = set(), set()
+    since = int((synced_at - config.SYNC_OVERLAP) * 1000)
+    for doc in records.iter_search(api.get_case_observables(case_id, query=config.changed_since(since), stream=True)):
+        if doc_digest(doc):
+            (added if doc.get('status', 'Ok') == 'Ok' else removed).add(doc_digest(doc))
+    index = (index - removed) | added
+    config.get_cache().store_observables(index_key(api, case_id), added, sync_start, removed=removed)
+    return index
+
+def import_observables(api, case_id, observables, workers=bulk.DEFAULT_WORKERS, retries=bulk.DEFAULT_RETRIES,
+                       batch_size=BATCH_SIZE, tlp=DEFAULT_TLP, ioc=False, tags=None):
+    """Add observables to a case, skipping any the case already has. Values are normalised and
+    checked against the local index first, so only new ones go over the wire, as batches of up to
+    batch_size values per call with several calls in flight
+    :param api: thehive api connector
+    :param case_id: Case to add the observables to
+    :type case_id: string
+    :param observables: Observable dicts, e.g. from read_observables
+    :param workers: Number of concurrent create calls
+    :type workers: int
+    :param retries: Retries per batch on throttling or server errors
+    :type retries: int
+    :param batch_size: Values per create call
+    :type batch_size: int
+    :param tlp: TLP of the new observables
+    :type tlp: int
+    :param ioc: Flag the new observables as IOCs
+    :type ioc: boolean
+    :param tags: Tags added to every new observable
+    :type tags: list
+    :return: summary with read, created, existing, duplicate, invalid and failed counts, elapsed seconds,
+        rate and failures
+    :rtype: dict
+    """
+    summary = {'read': 0, 'created': 0, 'existing': 0, 'duplicates': 0, 'invalid': 0, 'failed': 0, 'failures': []}
+    start = time.time()
+    index = sync_index(api, case_id)
+    seen = set()
+    lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    created_digests = []
+
+    def send(group, batch):
+        data_type, message, batch_tags = group
+        details = {'tlp': tlp, 'ioc': ioc, 'tags': list(batch_tags)}
+        if message:
+            details['message'] = message
+        try:
+            resp = manifest.with_retries(lambda: api.create_observables(case_id, data_type, batch, **details),
+                                         retries, ok_status=(201, 207))
+        finally:
+            in_flight.release()
+        with lock:
+            if isinstance(resp, str):
+                summary['failed'] += len(batch)
+                summary['failures'].append(["{0} x {1}".format(len(batch), data_type), resp])
+                return
+            if resp.status_code == 201:
+                summary['created'] += len(batch)
+                created_digests.extend(digest(data_type, value) for value in batch)
+                return
+            # 207: some were created, the rest were refused one by one
+            result = resp.json()
+            summary['created'] += len(result.get('success', []))
+            created_digests.extend(doc_digest(doc) for doc in result.get('success', []))
+            for failure in result.get('failure', []):
+                # Added by someone else since the index was synced
+                if failure.get('type') == 'ConflictError':
+                    summary['existing'] += 1
+                    created_digests.append(doc_digest(failure.get('object', {})))
+                else:
+                    summary['failed'] += 1
+                    summary['failures'].append([failure.get('object', {}).get('data'), failure.get('message')])
+
+    groups = {}
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for observable in observables:
+            summary['read'] += 1
+            normalised = normalise(observable.get('dataType'), observable.get('data', ''))
+            if normalised is None:
+                summary['invalid'] += 1
+                continue
+            key = digest(*normalised)
+            if key in seen:
+                summary['duplicates'] += 1
+                continue
+            seen.add(key)
+            if key in index:
+                summary['existing'] += 1
+                continue
+            group = (normalised[0], observable.get('message') or None,
+                     tuple(sorted(set(tags or []) | set(observable.get('tags') or []))))
+            batch = groups.setdefault(group, [])
+            batch.append(normalised[1])
+            if len(batch) >= batch_size:
+                in_flight.acquire()
+                batch = groups.pop(group)
+                futures.append((pool.submit(send, group, batch), group[0], len(batch)))
+        for group, batch in groups.items():
+            in_flight.acquire()
+            futures.append((pool.submit(send, group, batch), group[0], len(batch)))
+    for future, data_type, count in futures:
+        try:
+            future.result()
+        except Exception as err:
+            summary['failed'] += count
+            summary['failures'].append(["{0} x {1}".format(count, data_type), str(err)])
+    if config.USE_CACHE:
+        config.get_cache().store_observables(index_key(api, case_id),
+                                             [created for created in created_digests if created])
+    summary['elapsed'] = time.time() - start
+    summary['rate'] = summary['created'] / summary['elapsed'] if summary['elapsed'] else 0.0
+    return summary
+
+def import_file(source, case_id, data_type=None, workers=bulk.DEFAULT_WORKERS, retries=bulk.DEFAULT_RETRIES,
+                tlp=DEFAULT_TLP, ioc=False, tags=None):
+    """Import the observables of a file into a case through the configured server
+    :param source: CSV, STIX 2 JSON or plain list, or '-' for stdin
+    :type source: string
+    :param case_id: Case to add the observables to
+    :type case_id: string
+    :return: import summary, or None if the file could not be read
+    :rtype: dict
+    """
+    try:
+        return import_observables(config.get_api(), case_id, read_observables(source, data_type),
+                                  workers=workers, retries=retries, tlp=tlp, ioc=ioc, tags=tags)
+    except (OSError, ValueError) as err:
+        config.sneeze(error_message="Import observables from {0} ({1})".format(source, err),
+                      error_fix="Check the file exists and is a CSV, a STIX 2 JSON bundle or a list of values.")
+    except TheHiveException as err:
+        config.sneeze(error_message="Import observables while TheHive is unreachable ({0})".format(err),
+                      error_fix="Check the connection to TheHive and run the same import again; "
+                                "observables already added are skipped.")
+    return None
+
+def report(summary, case_name):
+    """Print an observable import summary
+    :param summary: Summary returned by import_observables
+    :type summary: dict
+    :param case_name: Case the observables went to
+    :type case_name: string
+    """
+    print("Bzz Bzz Bzz...{0} observables added to {1} in {2:.2f}s ({3:.1f} observables/s)".format(
+        summary['created'], case_name, summary['elapsed'], summary['rate']))
+    print("\t{0} read: {1} already in the case, {2} duplicates in the input, {3} not valid for their type, "
+          "{4} failed".format(summary['read'], summary['existing'], summary['duplicates'], summary['invalid'],
+                              summary['failed']))
+    for what, failure in summary['failures']:
+        print("\t{0}: {1}".format(what, failure))
+    if summary['failed']:
+        print("Run the same import again to retry; observables already added are skipped.")
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain request-level instrumentation of TheHive calls'''
+
+# standard imports
+import collections
+import contextlib
+import json
+import sys
+import threading
+import time
+
+# Most recent calls and commands kept in memory for the perf report
+MAX_RECORDS = 10000
+# Upper bounds (ms) of the latency histogram buckets; anything slower lands in the last one
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# Path segments that are part of an endpoint rather than an ID
+ENDPOINT_WORDS = {'api', 'case', 'task', 'log', 'artifact', 'alert', 'user', 'current', 'datastore', 'stream', '_search', '_stats'}
+
+CALLS = collections.deque(maxlen=MAX_RECORDS)
+COMMANDS = collections.deque(maxlen=MAX_RECORDS)
+# Commands in progress, innermost last; the shells nest (main > case > task)
+STACK = []
+LOCK = threading.Lock()
+# Lets a background thread (e.g. the spool flusher) attribute its calls to itself
+LOCAL = threading.local()
+
+def endpoint(method, path):
+    '''Group a request with others to the same endpoint, e.g. POST /api/case/task/{id}/log'''
+    segments = [segment if not segment or segment in ENDPOINT_WORDS else '{id}' for segment in path.split('?')[0].split('/')]
+    return '{0} {1}'.format(method, '/'.join(segments))
+
+def active_command():
+    '''Name of the command API calls are currently attributed to'''
+    name = getattr(LOCAL, 'command', None)
+    if name:
+        return name
+    return STACK[-1]['command'] if STACK else 'pollen'
+
+@contextlib.contextmanager
+def command(name):
+    """Attribute every API call made inside this block to a command, and time the command
+    :param name: Command name, e.g. 'case> tasks' or '--log'
+    :type name: string
+    """
+    frame = {'command': name, 'start': time.perf_counter(), 'excluded': 0.0, 'paused': False,
+             'requests': 0, 'api_ms': 0.0, 'decode_ms': 0.0, 'bytes_in': 0, 'bytes_out': 0, 'errors': 0}
+    STACK.append(frame)
+    try:
+        yield frame
+    finally:
+        STACK.remove(frame)
+        elapsed = time.perf_counter() - frame['start']
+        # Don't bill a parent command for a nested command (or a whole nested shell) a second time
+        if STACK and not STACK[-1]['paused']:
+            STACK[-1]['excluded'] += elapsed
+        wall_ms = (elapsed - frame['excluded']) * 1000.0
+        with LOCK:
+            COMMANDS.append({'timestamp': time.time(), 'command': name, 'wall_ms': wall_ms,
+                             'requests': frame['requests'], 'api_ms': frame['api_ms'],
+                             'decode_ms': frame['decode_ms'], 'bytes_in': frame['bytes_in'],
+                             'bytes_out': frame['bytes_out'], 'errors': frame['errors']})
+
+@contextlib.contextmanager
+def paused():
+    '''Leave the time spent in this block (e.g. a nested shell waiting on the user) out of the active command'''
+    frame = STACK[-1] if STACK else None
+    start = time.perf_counter()
+    if frame:
+        frame['paused'] = True
+    try:
+        yield
+    finally:
+        if frame:
+            frame['paused'] = False
+            frame['excluded'] += time.perf_counter() - start
+
+@contextlib.contextmanager
+def background(name):
+    '''Attribute calls made by the current thread to name, whatever the shell is doing'''
+    LOCAL.command = name
+    try:
+        yield
+    finally:
+        LOCAL.command = None
+
+def body_size(body):
+    '''Size in bytes of a request body, without reading it'''
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+def response_size(resp):
+    '''Size in bytes of a response body, without reading a streamed one'''
+    if resp is None:
+        return 0
+    # Streamed bodies (e.g. attachment downloads) have not been read yet; trust the header
+    if not resp._content_consumed:
+        return int(resp.headers.get('Content-Length', 0))
+    return len(resp.content)
+
+def record_call(method, path, start, resp=None, new_connection=False, error=None):
+    """Record one TheHive request against the active command
+    :param method: HTTP method
+    :type method: string
+    :param path: API path
+    :type path: string
+    :param start: time.perf_counter() taken just before the request was sent
+    :type start: float
+    :param resp: The response, or None if the request failed outright
+    :type resp: requests.Response
+    :param new_connection: Whether a fresh connection (DNS, TCP and TLS) had to be opened
+    :type new_connection: boolean
+    :param error: Short description of the failure, if the request failed
+    :type error: string
+    :return: the call record
+    :rtype: dict
+    """
+    total_ms = (time.perf_counter() - start) * 1000.0
+    name = active_command()
+    frame = next((frame for frame in reversed(STACK) if frame['command'] == name), None)
+    call = {'timestamp': time.time(), 'command': name, 'endpoint': endpoint(method, path),
+            'status': resp.status_code if resp is not None else None, 'total_ms': total_ms,
+            # Time to the response headers (connect + send + server time); the rest is the body download
+            'wait_ms': resp.elapsed.total_seconds() * 1000.0 if resp is not None else total_ms,
+            'decode_ms': 0.0, 'new_connection': new_connection,
+            'bytes_out': body_size(resp.request.body) if resp is not None else 0,
+            'bytes_in': response_size(resp), 'error': error}
+    with LOCK:
+        CALLS.append(call)
+        if frame:
+            frame['requests'] += 1
+            frame['api_ms'] += total_ms
+            frame['bytes_in'] += call['bytes_in']
+            frame['bytes_out'] += call['bytes_out']
+            frame['errors'] += 1 if error or call['status'] is None or call['status'] >= 400 else 0
+    if resp is not None:
+        time_decoding(resp, call, frame)
+    return call
+
+def time_decoding(resp, call, frame):
+    '''Wrap resp.json so the JSON decode time is added to the call and its command'''
+    decode = resp.json
+
+    def timed_json(**kwargs):
+        start = time.perf_counter()
+        try:
+            return decode(**kwargs)
+        finally:
+            decode_ms = (time.perf_counter() - start) * 1000.0
+            with LOCK:
+                call['decode_ms'] += decode_ms
+                if frame:
+                    frame['decode_ms'] += decode_ms
+    resp.json = timed_json
+
+def percentile(samples, pct):
+    '''Nearest-rank percentile of a sorted list of samples'''
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, int(round(pct / 100.0 * len(samples))) - 1))]
+
+def histogram(samples, width=40):
+    """Latency histogram as text lines
+    :param samples: Latencies in milliseconds
+    :type samples: list
+    :param width: Width of the longest bar
+    :type width: int
+    :return: one line per non-empty bucket
+    :rtype: list
+    """
+    counts = [0] * (len(BUCKETS) + 1)
+    for sample in samples:
+        counts[next((index for index, bound in enumerate(BUCKETS) if sample <= bound), len(BUCKETS))] += 1
+    most = max(counts) or 1
+    lines = []
+    for index, count in enumerate(counts):
+        if not count:
+            continue
+        label = '<= {0} ms'.format(BUCKETS[index]) if index < len(BUCKETS) else '> {0} ms'.format(BUCKETS[-1])
+        lines.append('\t{0:>12} | {1:<{2}} {3}'.format(label, '#' * max(1, int(width * count / most)), width, count))
+    return lines
+
+def report(stream=None):
+    """Print per-command and per-endpoint breakdowns with latency percentiles
+    :param stream: Where to print the report; defaults to stdout
+    """
+    stream = stream or sys.stdout
+    with LOCK:
+        commands = list(COMMANDS)
+        calls = list(CALLS)
+    if not calls and not commands:
+        stream.write("No TheHive requests recorded yet.\n")
+        return
+    by_command = collections.OrderedDict()
+    for run in commands:
+        by_command.setdefault(run['command'], []).append(run)
+    stream.write("***** Per Command *****\n")
+    stream.write("\t{0:<24} {1:>5} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9} {7:>6} {8:>10}\n".format(
+        'Command', 'Runs', 'p50 ms', 'p95 ms', 'API ms', 'JSON ms', 'Local ms', 'Reqs', 'KiB in'))
+    for name, runs in by_command.items():
+        walls = sorted(run['wall_ms'] for run in runs)
+        api_ms = sum(run['api_ms'] for run in runs)
+        decode_ms = sum(run['decode_ms'] for run in runs)
+        # Concurrent calls can add up to more than the wall time; local time is then just ~0
+        local_ms = max(sum(walls) - api_ms - decode_ms, 0.0)
+        stream.write("\t{0:<24} {1:>5} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f} {7:>6} {8:>10.1f}\n".format(
+            name[:24], len(runs), percentile(walls, 50), percentile(walls, 95), api_ms, decode_ms, local_ms,
+            sum(run['requests'] for run in runs), sum(run['bytes_in'] for run in runs) / 1024.0))
+    by_endpoint = collections.OrderedDict()
+    for call in calls:
+        by_endpoint.setdefault(call['endpoint'], []).append(call)
+    stream.write("\n***** Per Endpoint *****\n")
+    stream.write("\t{0:<34} {1:>5} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8} {7:>5} {8:>5}\n".format(
+        'Endpoint', 'Calls', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'wait %', 'new', 'errs'))
+    for name, endpoint_calls in by_endpoint.items():
+        totals = sorted(call['total_ms'] for call in endpoint_calls)
+        wait = sum(call['wait_ms'] for call in endpoint_calls)
+        stream.write("\t{0:<34} {1:>5} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.0f} {7:>5} {8:>5}\n".format(
+            name[:34], len(endpoint_calls), percentile(totals, 50), percentile(totals, 90), percentile(totals, 99),
+            totals[-1], 100.0 * wait / (sum(totals) or 1), sum(1 for call in endpoint_calls if call['new_connection']),
+            sum(1 for call in endpoint_calls if call['status'] is None or call['status'] >= 400)))
+    stream.write("\n***** Request Latency *****\n")
+    for line in histogram([call['total_ms'] for call in calls]):
+        stream.write(line + '\n')
+
+def export(path):
+    """Append every recorded command and call to a JSON lines file
+    :param path: File to append to
+    :type path: string
+    :return: number of lines written
+    :rtype: int
+    """
+    with LOCK:
+        rows = [dict(run, kind='command') for run in COMMANDS] + [dict(call, kind='call') for call in CALLS]
+    with open(path, 'a') as export_file:
+        for row in rows:
+            export_file.write(json.dumps(row) + '\n')
+    return len(rows)
+
+def reset():
+    '''Forget everything recorded so far'''
+    with LOCK:
+        CALLS.clear()
+        COMMANDS.clear()
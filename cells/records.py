@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain compact listing records and incremental JSON decoding of TheHive searches'''
+
+# standard imports
+import codecs
+import json
+import re
+import sys
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+
+# Bytes read off the socket at a time while decoding a search response
+CHUNK_SIZE = 64 * 1024
+# Whitespace and commas between array elements
+SEPARATOR = re.compile(r'[\s,]*')
+
+class ListingRecord(object):
+    '''One case or task of a listing: title, id, status and tags, and nothing else
+
+    Listings of open cases can run to tens of thousands of records, so these use __slots__ rather
+    than a dict per record, and share one copy of each status and tag string between records. They
+    still read like the dicts pollen used before (record['title'], record.get('tags'), dict(record)).
+    '''
+    __slots__ = ('title', 'id', 'status', 'tags')
+
+    def __init__(self, title, record_id, status, tags=()):
+        '''Class initialization'''
+        self.title = title
+        self.id = record_id
+        # A handful of distinct statuses and tags repeat across every record
+        self.status = sys.intern(status) if status else status
+        self.tags = tuple(sys.intern(tag) for tag in tags) if tags else ()
+
+    @classmethod
+    def from_doc(cls, doc):
+        '''Keep only the listing fields of a full TheHive case or task document'''
+        return cls(doc.get('title'), doc.get('id'), doc.get('status'), doc.get('tags'))
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default) if field in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def __eq__(self, other):
+        return isinstance(other, ListingRecord) and all(self[field] == other[field] for field in self.__slots__)
+
+    def __repr__(self):
+        return 'ListingRecord({0!r}, {1!r}, {2!r}, {3!r})'.format(self.title, self.id, self.status, self.tags)
+
+def iter_array(resp, chunk_size=CHUNK_SIZE):
+    """Decode a JSON array response one element at a time as it arrives, so neither the raw body nor
+    the full list of decoded documents is ever held in memory at once
+    :param resp: Response from a search made with stream=True
+    :type resp: requests.Response
+    :param chunk_size: Bytes read at a time
+    :type chunk_size: int
+    :return: one decoded element at a time
+    :rtype: generator
+    :raises ValueError: If the body is not a complete JSON array
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+    buffer = ''
+    position = 0
+    opened = False
+    closed = False
+    for chunk in resp.iter_content(chunk_size):
+        # Past the end of the array; read on to the end of the body so the connection goes back to the pool
+        if closed:
+            continue
+        buffer = buffer[position:] + text.decode(chunk)
+        position = 0
+        while True:
+            position = SEPARATOR.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if not opened:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a JSON array from TheHive")
+                opened = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                closed = True
+                break
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The element runs on into the next chunk
+                break
+            yield element
+    if not closed:
+        raise ValueError("Truncated JSON array from TheHive")
+
+def iter_search(resp):
+    """Decode the results of a streamed search one document at a time
+    :param resp: Response from a search made with stream=True
+    :type resp: requests.Response
+    :return: one document at a time
+    :rtype: generator
+    :raises TheHiveException: If the search failed
+    """
+    with resp:
+        if resp.status_code != 200:
+            raise TheHiveException("HTTP {0} from TheHive".format(resp.status_code))
+        for doc in iter_array(resp):
+            yield doc
+
+def search_records(resp):
+    """Compact listing records straight from a streamed search response
+    :param resp: Response from a search made with stream=True
+    :type resp: requests.Response
+    :return: listing records, in search order
+    :rtype: list
+    """
+    return [ListingRecord.from_doc(doc) for doc in iter_search(resp)]
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the timeout, retry and circuit breaker policy for TheHive calls'''
+
+# standard imports
+import email.utils
+import random
+import threading
+import time
+
+# third-party imports
+import requests
+from urllib3.exceptions import NewConnectionError
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+
+# Defaults, overridable from the [Network] section of .pollen_config
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# Consecutive failures before the breaker opens, and seconds before it lets a probe through
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30.0
+# Status codes worth another try; anything else is handed straight back
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Responses that mean the server itself is unwell, rather than unhappy with the request
+SERVER_DOWN_STATUS = (502, 503, 504)
+# A write answered with one of these plus a Retry-After was turned away untouched, so it can go again
+WRITE_RETRY_STATUS = (429, 503)
+
+class CircuitOpen(TheHiveException):
+    '''Raised without contacting TheHive while its circuit breaker is open'''
+
+def delay(attempt, backoff=DEFAULT_BACKOFF, retry_after=None, max_delay=MAX_BACKOFF):
+    """Seconds to wait before a retry: the server's Retry-After if it sent one, otherwise exponential
+    backoff with full jitter, so many clients retrying at once do not hit TheHive in lockstep
+    :param attempt: Retries made so far (0 before the first retry)
+    :type attempt: int
+    :param backoff: Base delay in seconds
+    :type backoff: float
+    :param retry_after: Retry-After header value, in seconds or as an HTTP date
+    :type retry_after: string
+    :param max_delay: Longest delay ever returned
+    :type max_delay: float
+    :return: seconds to sleep
+    :rtype: float
+    """
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                wait = None
+        if wait is not None:
+            return min(max(wait, 0.0), max_delay)
+    return random.uniform(0, min(max_delay, backoff * 2 ** attempt))
+
+def idempotent(method, path):
+    '''Whether a request can be sent twice safely; searches and stats are POSTs that only read'''
+    return method in ('GET', 'HEAD') or path.endswith('/_search') or path.endswith('/_stats')
+
+def never_sent(err):
+    '''Whether a request failed before reaching TheHive, so even a write can be retried'''
+    if isinstance(err, CircuitOpen):
+        return True
+    # PollenApi hands back requests errors wrapped in thehive4py ones
+    if isinstance(err, TheHiveException) and err.__cause__ is not None:
+        err = err.__cause__
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    return isinstance(reason, NewConnectionError)
+
+def write_turned_away(resp):
+    '''Whether TheHive refused a write without acting on it, and said when to send it again'''
+    return resp.status_code in WRITE_RETRY_STATUS and bool(resp.headers.get('Retry-After'))
+
+class RetryPolicy(object):
+    '''Timeouts and retry settings shared by every call to one server'''
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF,
+                 breaker_threshold=BREAKER_THRESHOLD, breaker_reset=BREAKER_RESET):
+        '''Class initialization'''
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+
+    def delay(self, attempt, retry_after=None):
+        '''Seconds to wait before retry number attempt + 1'''
+        return delay(attempt, self.backoff, retry_after, self.max_backoff)
+
+class CircuitBreaker(object):
+    '''Fails fast once a server is clearly down, instead of waiting out every timeout
+
+    After threshold consecutive failures (connection errors, timeouts or 502/503/504) the breaker
+    opens and calls fail straight away. Once reset_after seconds have passed a single probe call is
+    let through: if it succeeds the breaker closes, otherwise it stays open for another period.
+    '''
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_after=BREAKER_RESET):
+        '''Class initialization'''
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def check(self, url):
+        """Let a call through, or raise if the server is known to be down
+        :param url: Server URL, for the error message
+        :type url: string
+        :raises CircuitOpen: While the breaker is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_after - time.monotonic()
+            if remaining <= 0 and not self.probing:
+                self.probing = True
+                return
+        raise CircuitOpen("TheHive at {0} is not responding; not trying again for {1:.0f}s".format(
+            url, max(remaining, 0)))
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    @property
+    def state(self):
+        '''closed, open or half-open'''
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.probing else 'open'
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the in-memory fuzzy search index over case and task listings'''
+
+# standard imports
+import heapq
+
+# Most matches offered for a query
+MATCH_LIMIT = 10
+# Trigrams found in more than this share of records (e.g. 'cas' in every 'Case ...') are only checked
+# on candidates found through rarer trigrams, rather than walked in full
+COMMON_SHARE = 0.2
+# Built indexes, keyed by listing key, so a listing is only indexed again once it changes
+INDEXES = {}
+
+def trigrams(text):
+    '''Set of three-character chunks of a padded, lower-cased string'''
+    text = ' {0} '.format(text.lower())
+    return {text[index:index + 3] for index in range(len(text) - 2)}
+
+class TitleIndex(object):
+    '''Trigram index over the titles, IDs and tags of a case or task listing
+
+    Typos and partial words still find the right record: every record sharing trigrams with the
+    query is a candidate, ranked by the share of the query's trigrams it contains, with a boost for
+    exact, prefix and substring matches. Lookups only touch the candidates' posting lists, so they
+    stay in the millisecond range however many cases are open.
+    '''
+    def __init__(self, records):
+        """Class initialization
+        :param records: dicts with title, id and status, and optionally tags
+        :type records: list
+        """
+        self.records = list(records)
+        self.postings = {}
+        self.texts = []
+        self.titles = [record['title'].lower() for record in self.records]
+        for position, record in enumerate(self.records):
+            text = ' {0} '.format(' '.join([record['title'], record['id']] + list(record.get('tags') or [])).lower())
+            self.texts.append(text)
+            for gram in trigrams(text):
+                self.postings.setdefault(gram, []).append(position)
+
+    def __len__(self):
+        return len(self.records)
+
+    def search(self, query, limit=MATCH_LIMIT):
+        """Rank records against a query
+        :param query: Free text, e.g. part of a title, a tag or an ID
+        :type query: string
+        :param limit: Most records to return
+        :type limit: int
+        :return: best matching records, best first
+        :rtype: list
+        """
+        query = query.strip().lower()
+        if not query:
+            return self.records[:limit]
+        grams = trigrams(query)
+        common_size = max(1, int(len(self.records) * COMMON_SHARE))
+        rare = [gram for gram in grams if len(self.postings.get(gram, ())) <= common_size]
+        # Nothing but common trigrams; the rarest one still bounds the candidates
+        if not rare:
+            rare = [min(grams, key=lambda gram: len(self.postings.get(gram, ())))]
+        common = [gram for gram in grams if gram not in rare]
+        shared = {}
+        for gram in rare:
+            for position in self.postings.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+        for position in shared:
+            text = self.texts[position]
+            shared[position] += sum(1 for gram in common if gram in text)
+        scored = []
+        for position, count in shared.items():
+            title = self.titles[position]
+            score = float(count) / len(grams)
+            if query == title or query == self.records[position]['id'].lower():
+                score += 3.0
+            elif title.startswith(query):
+                score += 2.0
+            elif query in self.texts[position]:
+                score += 1.0
+            # Require a reasonable overlap, so one shared trigram does not drag in every record
+            if score >= 0.34:
+                scored.append((-score, title, position))
+        return [self.records[position] for _, _, position in heapq.nsmallest(limit, scored)]
+
+    def exact(self, query):
+        '''Record whose title or ID is exactly the query, if there is one'''
+        query = query.strip().lower()
+        for record in self.records:
+            if query in (record['title'].lower(), record['id'].lower()):
+                return record
+        return None
+
+    def complete(self, typed, text):
+        """Tab completion candidates for readline
+        :param typed: Everything typed after the command so far
+        :type typed: string
+        :param text: The word readline is completing (the tail end of typed)
+        :type text: string
+        :return: completions for text, so that typed + completion is a full title
+        :rtype: list
+        """
+        lowered = typed.lower()
+        # readline only replaces the current word, so hand back each title from that word onwards
+        offset = len(typed) - len(text)
+        matches = [record['title'][offset:] for record in self.records
+                   if record['title'].lower().startswith(lowered)]
+        # No title starts that way; offer fuzzy matches, but only while the first word is being typed
+        if not matches and typed.strip() and not offset:
+            matches = [record['title'] for record in self.search(typed)]
+        return matches
+
+def index_for(key, records):
+    """Fetch the index of a listing, rebuilding it only if the listing has changed
+    :param key: Listing key, e.g. config.listing_key()
+    :type key: string
+    :param records: Current records of the listing
+    :type records: list
+    :return: search index
+    :rtype: TitleIndex
+    """
+    fingerprint = hash(tuple((record['id'], record['title'], record['status']) for record in records))
+    cached = INDEXES.get(key)
+    if cached is None or cached[0] != fingerprint:
+        cached = (fingerprint, TitleIndex(records))
+        INDEXES[key] = cached
+    return cached[1]
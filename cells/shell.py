@@ -5,37 +5,130 @@
 import cmd
 import sys
 import os
-import configparser
 
 # thehive4py import(s)
-from thehive4py.models import Case, CaseTask, CaseTaskLog
+from thehive4py.exceptions import TheHiveException
+from thehive4py.models import Case, CaseTask
 
 # local imports
+from cells import background
 from cells import config
+from cells import hive
+from cells import perf
+from cells import search
+from cells import spool
 
-class PollenCaseTaskCmd(cmd.Cmd):
+# Most cases or tasks listed for selection when no search is given
+SELECT_LIMIT = 50
+
+def select_record(records, key, query, noun):
+    """Pick a case or task, by fuzzy search when a query is given or from a numbered listing otherwise
+    :param records: Listing records with title and id, e.g. from config.get_cases(output_format="records")
+    :type records: list
+    :param key: Listing key the search index is kept under
+    :type key: string
+    :param query: What the analyst typed after the command; may be empty
+    :type query: string
+    :param noun: What is being selected, for the prompts (e.g. 'open case')
+    :type noun: string
+    :return: the selected record, or None
+    :rtype: dict
+    """
+    query = query.strip() if query else ''
+    index = search.index_for(key, records)
+    if query:
+        exact = index.exact(query)
+        if exact:
+            return exact
+        matches = index.search(query)
+        if not matches:
+            print("No {0} matches '{1}'.".format(noun, query))
+            return None
+        if len(matches) == 1:
+            return matches[0]
+        print("Best matches for '{0}'. Please select a number:\n# - Title".format(query))
+    else:
+        matches = records[:SELECT_LIMIT]
+        if not matches:
+            print("There are no {0}s.".format(noun))
+            return None
+        print("There are {0} {1}s. Please select a number:\n# - Title".format(len(records), noun))
+    for number, record in enumerate(matches):
+        print("{0} - {1}".format(number, record['title']))
+    if len(records) > len(matches) and not query:
+        print("...and {0} more. Narrow them down with a search, e.g. '<command> phishing', or press Tab."
+              .format(len(records) - len(matches)))
+    try:
+        selected = int(input("Selection (0-{0}) (Press Ctrl+C to exit): ".format(len(matches) - 1)))
+    except KeyboardInterrupt:
+        return None
+    except ValueError:
+        selected = -1
+    if not 0 <= selected < len(matches):
+        print("\nThat is not a valid number!! Please select a proper value\n")
+        return None
+    return matches[selected]
+
+def complete_records(records, key, text, line):
+    """Tab completion of case or task titles from the search index
+    :return: readline completions
+    :rtype: list
+    """
+    typed = line.split(' ', 1)[1] if ' ' in line else ''
+    return search.index_for(key, records).complete(typed, text)
+
+class PollenShell(cmd.Cmd):
+    '''Common base for the pollen shells; times every command and the TheHive calls it makes'''
+    # Shell name used to label commands in the perf report, e.g. 'case> tasks'
+    scope = 'pollen'
+    def onecmd(self, line):
+        words = line.split()
+        with perf.command('{0}> {1}'.format(self.scope, words[0] if words else self.lastcmd.split(' ')[0])):
+            try:
+                return super(PollenShell, self).onecmd(line)
+            # Timeouts, retries and the circuit breaker all end here; the shell itself carries on
+            except TheHiveException as err:
+                print("**** TheHive did not answer: {0} ****".format(err))
+    def cmdloop(self, intro=None):
+        # A nested shell waits on the user; that time is not part of the command that opened it
+        with perf.paused():
+            return super(PollenShell, self).cmdloop(intro)
+    def postcmd(self, stop, line):
+        # Let the analyst know how background work (e.g. queued log entries) went before the next prompt
+        for notice in background.drain_notices():
+            print(notice)
+        return stop
+
+class PollenCaseTaskCmd(PollenShell):
     '''Case- and task-specific cmdloop'''
+    scope = 'task'
     def __init__(self, prompt, case_id, task_id):
         '''Class initialization'''
         # Bring in case and task variables. case_id isn't needed right now, but keeping just in case
         self.prompt = prompt
         self.case_id = case_id
         self.task_id = task_id
-        self.api = config.get_api()
         self.doc_header = '\x1b[1mDocumented pollen commands for the task shell. Type \'help <command>\' for context.\x1b[0m'
         # Initialize
         super(PollenCaseTaskCmd, self).__init__()
     def do_log(self, arg):
         '''Insert a log entry for this task!'''
         print("Inserting the following log entry:\n\n{0}".format(arg))
-        self.api.create_task_log(self.task_id, CaseTaskLog(message=arg))
+        # Spool locally and let the background flusher deal with TheHive
+        spool.append(self.task_id, arg, profile=config.CONFIG.profile)
+        spool.start_flusher().wake()
+        print("\nQueued; it will be sent to TheHive in the background.")
     def do_logfile(self, arg):
         '''Insert a log file and a supporting file'''
         log_details = arg.split('&&')
         print("Inserting the following log entry:\n\n{0}\n\nAnd attaching the following file: {1}"
               .format(log_details[0], log_details[1]))
-        self.api.create_task_log(self.task_id, CaseTaskLog(message=log_details[0],
-                                                           file=log_details[1].lstrip()))
+        spool.append(self.task_id, log_details[0], log_details[1].strip(), profile=config.CONFIG.profile)
+        spool.start_flusher().wake()
+        print("\nQueued; it will be sent to TheHive in the background.")
+    def do_flush(self, *_):
+        '''Send any queued log entries to TheHive now'''
+        spool.report(spool.flush())
     def do_exit(self, *_):
         '''Exit back to the Case Pollen Shell'''
         return True
@@ -46,8 +139,9 @@ class PollenCaseTaskCmd(cmd.Cmd):
         '''Clear screen'''
         os.system('clear')
 
-class PollenCaseCmd(cmd.Cmd):
+class PollenCaseCmd(PollenShell):
     '''Case-specific cmdloop'''
+    scope = 'case'
     def __init__(self, prompt, case_id, case_name):
         '''Class initialization'''
         self.prompt = prompt
@@ -56,8 +150,16 @@ class PollenCaseCmd(cmd.Cmd):
         self.doc_header = '\x1b[1mDocumented pollen commands for the case shell. Type \'help <command>\' for context.\x1b[0m'
         self.intro = '\nWelcome to the pollen case menu. Please type \x1b[1mhelp\x1b[0m to see what you can do here' 
         super(PollenCaseCmd, self).__init__()
-    def do_newtask(self, *_):
-        '''Create a new task within this case'''
+    def preloop(self):
+        '''Start fetching this case's tasks while the analyst reads the intro'''
+        if config.USE_CACHE:
+            background.prefetch(config.listing_key(self.case_id),
+                                lambda: config.get_tasks(self.case_id, output_format="name_list"), 'prefetch tasks')
+    def do_newtask(self, arg):
+        '''Create a new task within this case, or every task of a manifest. Usage: newtask [manifest]'''
+        if arg.strip():
+            self.apply_manifest(arg.strip())
+            return
         print("Let's create a new task within this case! The next few steps \
               will request some data from you: ")
         nt_title = input("Task Title: ")
@@ -68,37 +170,74 @@ class PollenCaseCmd(cmd.Cmd):
         if resp.status_code == 201:
             print("Successfully created task {0} with the case {1}.".format(nt_title,
                                                                             self.case_name))
+            config.get_cache().expire(config.listing_key(self.case_id))
+    def apply_manifest(self, path):
+        '''Add the tasks of a manifest or template to this case'''
+        from cells import manifest
+        try:
+            entries = manifest.read_manifest(path)
+        except (OSError, ValueError) as err:
+            print("Cannot read manifest {0}: {1}".format(path, err))
+            return
+        manifest.report(manifest.apply(config.get_api(), entries, case_id=self.case_id))
+    def do_export(self, arg):
+        '''Export this case with its tasks and logs. Usage: export <file.jsonl|.jsonl.gz|.parquet> [attachment dir]'''
+        words = arg.split()
+        if not words:
+            print("Please give a file to export to, e.g. export case.jsonl.gz attachments/")
+            return
+        from cells import export
+        try:
+            export.report(export.export_cases(words[0], case_ids=[self.case_id],
+                                              attachments=words[1] if len(words) > 1 else None), words[0])
+        except ImportError:
+            print("Parquet exports need pyarrow (pip3 install pyarrow); try .jsonl or .jsonl.gz instead.")
+    def do_observables(self, arg):
+        '''Add the observables of a CSV, STIX 2 bundle or plain list to this case, skipping those it already has. Usage: observables <file> [data type]'''
+        words = arg.split()
+        if not words:
+            print("Please give a file of observables, e.g. observables iocs.csv, or observables ips.txt ip")
+            return
+        from cells import observables
+        summary = observables.import_file(words[0], self.case_id, data_type=words[1] if len(words) > 1 else None)
+        if summary:
+            observables.report(summary, self.case_name)
+    def do_watch(self, arg):
+        '''Follow new tasks, task changes and new logs in this case until Ctrl+C. Usage: watch [poll]'''
+        from cells import watch
+        watch.watch_case(self.case_id, self.case_name, use_stream=arg.strip() != 'poll')
     def do_tasks(self, *_):
         '''List the tasks from this particular case'''
         print("***** Task Details for Case: {0} *****".format(self.case_name))
+        background.settle(config.listing_key(self.case_id))
         task_list = config.get_tasks(self.case_id, output_format="name_list")
         print("\nThere are currently {0} tasks.".format(len(task_list)))
         if task_list:
             print("\nTask Details:")
             for task in task_list:
                 print("\tTask Title: {0} | Status: {1}".format(task[0], task[1]))
-    def do_take(self, *_):
-        '''Take on a particular task'''
-        print("Please select a number to move to that task:\n# - Task Title")
-        task_list = config.get_tasks(self.case_id, output_format="name_list", task_id=True)
-        task_count = 0
-        for task in task_list:
-            print("{0} - {1}".format(task_count, task[0]))
-            task_count += 1
+    def do_take(self, arg):
+        '''Take on a particular task. Usage: take [search], e.g. take triage; Tab completes task titles'''
+        background.settle(config.listing_key(self.case_id))
+        task = select_record(config.get_tasks(self.case_id, output_format="records"),
+                             config.listing_key(self.case_id), arg, "task")
+        if not task:
+            return
         try:
-            selected_task = int(input("Please select a value from 0-{0}. (Press Ctrl+C to exit) "
-                                      .format(task_count-1)))
-            if selected_task > task_count-1:
-                print("\n{0} is not a valid number!! Please select a proper value\n"
-                      .format(selected_task))
-                self.do_take(None)
             PollenCaseTaskCmd(prompt=config.prompt_handler(which_prompt="task",
                                                            case=self.case_name,
-                                                           task=task_list[selected_task][0]),
+                                                           task=task['title']),
                               case_id=self.case_id,
-                              task_id=task_list[selected_task][1]).cmdloop()
+                              task_id=task['id']).cmdloop()
         except KeyboardInterrupt:
             pass
+    def complete_take(self, text, line, *_):
+        return complete_records(config.get_tasks(self.case_id, output_format="records"),
+                                config.listing_key(self.case_id), text, line)
+    def do_refresh(self, *_):
+        '''Drop cached case and task listings and fetch them fresh from TheHive'''
+        config.refresh_cache()
+        print("Cached listings cleared; the next listing will come straight from TheHive.")
     def do_exit(self, *_):
         '''Exit back to the initial Pollen Shell'''
         return True
@@ -109,14 +248,14 @@ class PollenCaseCmd(cmd.Cmd):
         '''Clear screen'''
         os.system('clear')
 
-class PollenConfigCmd(cmd.Cmd):
+class PollenConfigCmd(PollenShell):
     '''Sub-module to handle stats and TheHive configuration'''
+    scope = 'config'
     # Initialization; check for config file right at the beginning
     def __init__(self, prompt, config_found):
         '''Class initialization'''
         self.prompt = prompt
         self.config_found = config_found
-        self.configparser = configparser.ConfigParser()
         self.doc_header = '\x1b[1mDocumented pollen config commands. Type \'help <command>\' for context.\x1b[0m'
         self.intro = 'Welcome to the pollen configuration menu. Please type \x1b[1mhelp\x1b[0m to see what you can do here' 
         super(PollenConfigCmd, self).__init__()
@@ -128,66 +267,85 @@ class PollenConfigCmd(cmd.Cmd):
             else:
                 print("Unfortunately, I cannot do anything without a config\nExiting now...")
                 sys.exit()
-    def do_cmdline(self, *_):
-        '''Set the command-line case and task options'''
+    def do_cmdline(self, arg):
+        '''Set the command-line case and task options. Usage: cmdline [case search] [&& task search]'''
+        case_query, _, task_query = arg.partition('&&')
         # Start with case enumeration and selection
         print("Let's set predefined case details for the --log and --logfile options")
-        case_list = config.get_cases(output_format="name_list", case_id=True)
-        print("There are {0} open cases. Please select a number to move to that case:\n# - Case Title".format(len(case_list)))
-        dracula = 0
-        for case in case_list:
-            print("{0} - {1}".format(dracula, case[0]))
-            dracula += 1
-        try:
-            case_no = int(input("Case selection (0-{0}) (Press Ctrl+C to exit): "
-                                .format(dracula-1)))
-        except KeyboardInterrupt:
-            pass
-        selected_case_name = case_list[case_no][0]
-        selected_case_id = case_list[case_no][1]
+        background.settle(config.listing_key())
+        case = select_record(config.get_cases(output_format="records"), config.listing_key(), case_query, "open case")
+        if not case:
+            return
         # With case id selected, let's enumerate and select tasks
         print("\nNext, set predefined task details for the --log and --logfile options")
-        task_list = config.get_tasks(selected_case_id, output_format="name_list", task_id=True)
-        dracula = 0
-        for task in task_list:
-            print("{0} - {1}".format(dracula, task[0]))
-            dracula += 1
-        try:
-            task_no = int(input("Please select a value from 0-{0}. (Press Ctrl+C to exit) "
-                                .format(dracula-1)))
-        except KeyboardInterrupt:
-            pass
-        selected_task_name = task_list[task_no][0]
-        selected_task_id = task_list[task_no][1]
-        self.configparser.read('.pollen_config')
-        self.configparser.set('TheHive', 'case_name', selected_case_name)
-        self.configparser.set('TheHive', 'case_id', selected_case_id)
-        self.configparser.set('TheHive', 'task_name', selected_task_name)
-        self.configparser.set('TheHive', 'task_id', selected_task_id)
-        with open('.pollen_config', 'w') as configfile:
-            self.configparser.write(configfile)
+        task = select_record(config.get_tasks(case['id'], output_format="records"),
+                             config.listing_key(case['id']), task_query, "task")
+        if not task:
+            return
+        config.CONFIG.update(config.CONFIG.section, case_name=case['title'], case_id=case['id'],
+                             task_name=task['title'], task_id=task['id'])
+    def complete_cmdline(self, text, line, *_):
+        return complete_records(config.get_cases(output_format="records"), config.listing_key(), text, line)
 
     def do_status(self, *_):
         '''Print the current status'''
         server_details = config.get_config(config_format="basic")
         print("\x1b[1m***** Pollen Configuration *****\x1b[0m")
         print("Current TheHive Configuration Details:")
-        print("\tServer Address: {0}\n\tAPI Key: {1}"
-              .format(server_details[0], server_details[1]))
+        print("\tProfile: {0}\n\tServer Address: {1}\n\tAPI Key: {2}"
+              .format(config.CONFIG.profile or config.DEFAULT_PROFILE, server_details[0], server_details[1]))
         if len(server_details) == 4:
             print("\n\x1b[1mQuick insert command-line details:\x1b[0m")
             print("\tPre-configured case: {0}".format(server_details[2]))
             print("\tPre-configured task: {0}".format(server_details[3]))
-        cases = config.get_cases(output_format="json_full", case_id=False)
-        open_case_count = 0
-        closed_case_count = 0
-        for case in cases:
-            if case['status'] == 'Open':
-                open_case_count += 1
-            else:
-                closed_case_count += 1
+        case_stats = config.get_case_stats()
+        open_case_count = case_stats.get('Open', 0)
+        closed_case_count = sum(case_stats.values()) - open_case_count
         print("\n\x1b[1mCase Stats:\x1b[0m \n\t{0} Open Cases\n\t{1} Closed Cases"
               .format(open_case_count, closed_case_count))
+        print("\n\x1b[1mQueued Log Entries:\x1b[0m {0}".format(len(spool.pending())))
+        cache_stats = config.get_cache().stats()
+        print("\n\x1b[1mCache Stats:\x1b[0m \n\t{0} listings cached\n\t{1} hits, {2} misses, "
+              "{3} incremental refreshes".format(cache_stats['listings'], cache_stats['hit'],
+                                                  cache_stats['miss'], cache_stats['refresh']))
+        print("\n\x1b[1mConnection Stats:\x1b[0m")
+        for server, stats in hive.client_stats():
+            print("\t{0}: {1} requests over {2} connections ({3} reused), circuit breaker {4}"
+                  .format(server, stats['requests'], stats['connections'], stats['reused'], stats['breaker']))
+    def do_profile(self, arg):
+        '''Manage TheHive server profiles. Usage: profile [list | add <name> | use <name> | remove <name>]'''
+        words = arg.split()
+        action = words[0] if words else 'list'
+        name = words[1] if len(words) > 1 else None
+        if action == 'list':
+            for profile in config.CONFIG.profiles():
+                section = config.CONFIG.profile_section(profile)
+                active = '*' if config.CONFIG.section == section else ' '
+                print("\t{0} {1}: {2}".format(active, profile, config.CONFIG.get(section, 'server_url')))
+        elif not name:
+            print("Please name the profile, e.g. profile {0} client-a".format(action))
+        elif action == 'add':
+            hiveserver = input("Please enter the address for TheHive server of profile {0}: ".format(name))
+            hiveapi = input("Please enter the API key for that particular server: ")
+            if config.test_api(hiveserver, hiveapi):
+                config.CONFIG.update(config.CONFIG.profile_section(name), server_url=hiveserver, server_api=hiveapi)
+                print("Bzz Bzz Bzz...profile {0} saved. Switch to it with profile use {0}.".format(name))
+            else:
+                print("Uh-oh, I cannot reach that server or the API key doesn't work; profile not saved.")
+        elif action == 'use':
+            if config.use_profile(name):
+                print("Now using profile {0} for this session.".format(name))
+                self.prompt = config.prompt_handler(which_prompt="config")
+            else:
+                print("There is no profile called {0}.".format(name))
+        elif action == 'remove':
+            if name in (config.DEFAULT_PROFILE, config.CONFIG.profile):
+                print("The default profile and the profile in use cannot be removed.")
+            else:
+                config.CONFIG.remove(config.CONFIG.profile_section(name))
+                print("Profile {0} removed.".format(name))
+        else:
+            print("Unknown profile action {0}; try help profile".format(action))
     def do_stats(self, *_):
         '''Same thing as status; displays current stats'''
         self.do_status(None)
@@ -207,8 +365,9 @@ class PollenConfigCmd(cmd.Cmd):
         '''Clear screen'''
         os.system('clear')
 
-class PollenCmd(cmd.Cmd):
+class PollenCmd(PollenShell):
     '''Base Pollen Cmdloop'''
+    scope = 'main'
     def __init__(self, config_present=True):
         '''Class initialization'''
         self.prompt = config.prompt_handler()
@@ -220,8 +379,21 @@ class PollenCmd(cmd.Cmd):
         if not self.config_present:
             PollenConfigCmd(prompt=config.prompt_handler(which_prompt="config"),
                             config_found=False).cmdloop()
-    def do_newcase(self, *_):
-        '''Create a new case within TheHive'''
+        # Have the open cases ready (and cached) by the time the analyst asks for them
+        if config.USE_CACHE:
+            background.prefetch(config.listing_key(), lambda: config.get_cases(output_format="name_list"),
+                                'prefetch cases')
+    def do_newcase(self, arg):
+        '''Create a new case within TheHive, or every case and task of a manifest. Usage: newcase [manifest]'''
+        if arg.strip():
+            from cells import manifest
+            try:
+                entries = manifest.read_manifest(arg.strip())
+            except (OSError, ValueError) as err:
+                print("Cannot read manifest {0}: {1}".format(arg.strip(), err))
+                return
+            manifest.report(manifest.apply(config.get_api(), entries))
+            return
         print("Let's create a new case! The next few steps will request some data from you.")
         nc_title = input("Case Title: ")
         nc_description = input("Case Description: ")
@@ -230,29 +402,82 @@ class PollenCmd(cmd.Cmd):
         resp = api.create_case(new_case)
         if resp.status_code == 201:
             print("Successfully created case {0}!".format(nc_title))
+            config.get_cache().expire(config.listing_key())
     def do_config(self, *_):
         '''Switch into TheHive config mode'''
         PollenConfigCmd(prompt=config.prompt_handler(which_prompt="config"),
                         config_found=True).cmdloop()
-    def do_case(self, *_):
-        '''Switch to a case'''
-        cases = config.get_cases(output_format="name_list", case_id=True)
-        print("There are {0} open cases. Please select a number to move to that case:\n# - Case Title".format(len(cases)))
-        case_count = 0
-        for case in cases:
-            print("{0} - {1}".format(case_count, case[0]))
-            case_count += 1
+        # The profile may have been switched in the config menu
+        self.prompt = config.prompt_handler()
+    def do_case(self, arg):
+        '''Switch to a case. Usage: case [search], e.g. case phishing; Tab completes case titles'''
+        background.settle(config.listing_key())
+        case = select_record(config.get_cases(output_format="records"), config.listing_key(), arg, "open case")
+        if not case:
+            return
         try:
-            selected_case = int(input("Case selection (0-{0}) (Press Ctrl+C to exit): "
-                                      .format(case_count-1)))
-            PollenCaseCmd(prompt=config.prompt_handler(which_prompt="case", 
-                                                       case=cases[selected_case][0]),
-                          case_id=cases[selected_case][1],
-                          case_name=cases[selected_case][0]).cmdloop()
+            PollenCaseCmd(prompt=config.prompt_handler(which_prompt="case", case=case['title']),
+                          case_id=case['id'],
+                          case_name=case['title']).cmdloop()
         except KeyboardInterrupt:
             pass
+    def complete_case(self, text, line, *_):
+        return complete_records(config.get_cases(output_format="records"), config.listing_key(), text, line)
+    def do_tasks(self, arg):
+        '''List tasks across every open case. Usage: tasks [status] [mine], e.g. tasks Waiting mine'''
+        words = arg.split()
+        mine = 'mine' in words
+        status = [word for word in words if word != 'mine']
+        print("***** Tasks Across Open Cases *****")
+        config.task_overview(status=status[0] if status else None, mine=mine)
+    def do_export(self, arg):
+        '''Export every open case with its tasks and logs. Usage: export <file.jsonl|.jsonl.gz|.parquet> [attachment dir]'''
+        words = arg.split()
+        if not words:
+            print("Please give a file to export to, e.g. export cases.jsonl.gz attachments/")
+            return
+        from cells import export
+        try:
+            export.report(export.export_cases(words[0], attachments=words[1] if len(words) > 1 else None),
+                          words[0])
+        except ImportError:
+            print("Parquet exports need pyarrow (pip3 install pyarrow); try .jsonl or .jsonl.gz instead.")
+    def do_search(self, arg):
+        '''Search the task logs of every open case. Usage: search <words>, e.g. search lateral movement 10.1.2.3; end a word with * to match its prefix'''
+        from cells import logsearch
+        if not arg.strip():
+            index_stats = logsearch.get_index().stats(config.get_api().url)
+            print("Please give some words to search for, e.g. search lateral movement 10.1.2.3")
+            print("The local index holds {0} log entries from {1} cases.".format(index_stats['logs'], index_stats['cases']))
+            return
+        logsearch.report(*logsearch.search(arg))
+    def do_servers(self, arg):
+        '''Case stats from every configured TheHive server at once. Usage: servers [cases]'''
+        config.server_overview(list_cases=arg.strip() == 'cases')
+    def do_refresh(self, *_):
+        '''Drop cached case and task listings and fetch them fresh from TheHive'''
+        config.refresh_cache()
+        print("Cached listings cleared; the next listing will come straight from TheHive.")
+    def do_flush(self, *_):
+        '''Send any queued log entries to TheHive now'''
+        spool.report(spool.flush())
+    def do_perf(self, arg):
+        '''Show where this session's time went, per command and per TheHive endpoint.
+        Usage: perf [export <file>] [reset]'''
+        words = arg.split()
+        if words[:1] == ['export'] and len(words) == 2:
+            print("Bzz Bzz Bzz...{0} records appended to {1}".format(perf.export(words[1]), words[1]))
+        elif words[:1] == ['reset']:
+            perf.reset()
+            print("Performance records cleared.")
+        else:
+            perf.report()
     def do_exit(self, *_):
         '''Exit the Pollen Shell'''
+        # Last chance to deliver queued entries; anything that still fails stays spooled
+        if spool.pending():
+            print("Sending queued log entries before exiting...")
+            self.do_flush()
         return True
     def do_clear(self, *_):
         '''Clear screen'''
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the offline write-ahead spool for task log entries'''
+
+# standard imports
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# local imports
+from cells import background
+from cells import bulk
+from cells import config
+from cells import perf
+
+# Spooled entries, one JSON record per line, next to .pollen_config
+SPOOL_FILE = '.pollen_spool'
+# Keys of spooled entries that have made it to TheHive
+DONE_FILE = '.pollen_spool.done'
+# Held while flushing, so two pollen processes never send the same entries
+LOCK_FILE = '.pollen_spool.lock'
+# Tasks flushed side by side; entries within a task always go in order
+FLUSH_WORKERS = 4
+# Seconds between background flush attempts while entries are pending
+FLUSH_INTERVAL = 30
+
+FLUSHER = None
+
+def append(task_id, message, file_path=None, profile=None, **options):
+    """Write a log entry to the spool. This only touches local disk, so it returns right away
+    :param task_id: Task to log against
+    :type task_id: string
+    :param message: Log message
+    :type message: string
+    :param file_path: Optional attachment; only the path is spooled, not the file
+    :type file_path: string
+    :param profile: Server profile the task belongs to; None for the default one
+    :type profile: string
+    :param options: How to upload the attachment, e.g. compress=True, force=True
+    :return: idempotency key of the spooled entry
+    :rtype: string
+    """
+    record = {'key': uuid.uuid4().hex, 'task_id': task_id, 'message': message,
+              'file': os.path.abspath(file_path) if file_path else None, 'queued_at': time.time(),
+              'profile': profile}
+    record.update(options)
+    with open(SPOOL_FILE, 'a') as spool:
+        fcntl.flock(spool, fcntl.LOCK_EX)
+        spool.write(json.dumps(record) + '\n')
+        spool.flush()
+    return record['key']
+
+def done_keys():
+    '''Keys already delivered to TheHive'''
+    try:
+        with open(DONE_FILE) as done:
+            return set(line.strip() for line in done)
+    except FileNotFoundError:
+        return set()
+
+def pending():
+    """Spooled entries not yet delivered, oldest first
+    :return: spooled records
+    :rtype: list
+    """
+    delivered = done_keys()
+    records = []
+    try:
+        with open(SPOOL_FILE) as spool:
+            for line in spool:
+                # A torn final line (e.g. a crash mid-append) is skipped rather than fatal
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['key'] not in delivered:
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+    return records
+
+def compact():
+    '''Rewrite the spool without delivered entries, in place so concurrent appends are not lost'''
+    try:
+        spool = open(SPOOL_FILE, 'r+')
+    except FileNotFoundError:
+        return
+    with spool:
+        fcntl.flock(spool, fcntl.LOCK_EX)
+        delivered = done_keys()
+        keep = []
+        for line in spool:
+            try:
+                if json.loads(line)['key'] not in delivered:
+                    keep.append(line)
+            except ValueError:
+                continue
+        spool.seek(0)
+        spool.truncate()
+        spool.writelines(keep)
+        spool.flush()
+        open(DONE_FILE, 'w').close()
+
+def flush(workers=FLUSH_WORKERS, retries=bulk.DEFAULT_RETRIES):
+    """Send spooled entries to TheHive. Each entry goes to the server profile it was queued for,
+    whichever profile this pollen is using. Entries for the same task go in order, and a task stops
+    at its first failure that is worth retrying so nothing overtakes it; different tasks are flushed
+    concurrently. An entry TheHive refused, or may already have written, is dropped from the spool
+    rather than blocking its task (or being written twice)
+    :param workers: Number of tasks flushed at once
+    :type workers: int
+    :param retries: Retries per entry on throttling or server errors
+    :type retries: int
+    :return: summary with sent, failed and remaining counts plus failures, and the dropped entries
+    :rtype: dict
+    """
+    summary = {'sent': 0, 'failed': 0, 'failures': [], 'dropped': []}
+    with open(LOCK_FILE, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        by_task = {}
+        for record in pending():
+            # Entries spooled before profiles were recorded belong to the default server
+            by_task.setdefault((record.get('profile'), record['task_id']), []).append(record)
+        lock = threading.Lock()
+        configured = config.CONFIG.profiles()
+
+        def send_task(profile, records):
+            if profile not in (None, config.DEFAULT_PROFILE) and profile not in configured:
+                with lock:
+                    summary['failed'] += 1
+                    summary['failures'].append([records[0]['task_id'], "server profile {0} is not configured; "
+                                                "{1} entries stay queued".format(profile, len(records))])
+                return
+            api = config.profile_api(profile)
+            for record in records:
+                failure = bulk.post_entry(api, record['task_id'], record, retries=retries)
+                with lock:
+                    if failure and failure.kind == bulk.RETRY:
+                        summary['failed'] += 1
+                        summary['failures'].append([record['task_id'], failure])
+                        return
+                    # Record delivery (or giving up) straight away, so a crash cannot resend this entry
+                    with open(DONE_FILE, 'a') as done:
+                        done.write(record['key'] + '\n')
+                    if failure:
+                        summary['dropped'].append([record['task_id'], failure])
+                    else:
+                        summary['sent'] += 1
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(send_task, profile, records): task_id
+                       for (profile, task_id), records in by_task.items()}
+        for future, task_id in futures.items():
+            try:
+                future.result()
+            except Exception as err:
+                # Whatever this task had not recorded as done stays queued for the next flush
+                summary['failed'] += 1
+                summary['failures'].append([task_id, "flush stopped: {0}".format(err)])
+        compact()
+        summary['remaining'] = len(pending())
+    return summary
+
+def report(summary):
+    """Print a flush summary
+    :param summary: Summary returned by flush
+    :type summary: dict
+    """
+    print("Bzz Bzz Bzz...{0} queued entries sent, {1} failed, {2} still queued"
+          .format(summary['sent'], summary['failed'], summary['remaining']))
+    for task_id, failure in summary['failures']:
+        print("\tTask {0}: {1}".format(task_id, failure))
+    for task_id, failure in summary['dropped']:
+        print("\tTask {0}: {1}; dropped from the queue".format(task_id, failure))
+
+class Flusher(threading.Thread):
+    '''Background thread that flushes the spool whenever it is woken, and retries periodically'''
+    def __init__(self, interval=FLUSH_INTERVAL):
+        '''Class initialization'''
+        super(Flusher, self).__init__(daemon=True)
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.last_summary = None
+
+    def wake(self):
+        '''Ask for a flush as soon as possible'''
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not pending():
+                continue
+            try:
+                with perf.background('flush (background)'):
+                    self.last_summary = flush()
+            # The flusher must never die; whatever went wrong, the entries stay spooled
+            except Exception as err:
+                self.last_summary = {'sent': 0, 'failed': 0, 'failures': [[None, str(err)]], 'dropped': [],
+                                     'remaining': len(pending())}
+            self.announce(self.last_summary)
+
+    @staticmethod
+    def announce(summary):
+        '''Tell the shell user how a background flush went'''
+        if summary['sent']:
+            background.notify("Bzz Bzz Bzz...{0} queued log entries sent to TheHive.".format(summary['sent']))
+        for task_id, failure in summary['failures']:
+            background.notify("**** Could not send a queued log entry{0}: {1}. It stays queued; run flush to "
+                              "retry ****".format(' for task {0}'.format(task_id) if task_id else '', failure))
+        for task_id, failure in summary['dropped']:
+            background.notify("**** Dropped a queued log entry for task {0}: {1} ****".format(task_id, failure))
+
+def start_flusher():
+    """Start (once) the background flusher
+    :return: the running flusher
+    :rtype: Flusher
+    """
+    global FLUSHER
+    if FLUSHER is None:
+        FLUSHER = Flusher()
+        FLUSHER.start()
+    return FLUSHER
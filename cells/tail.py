@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain tail-and-ship: following a growing file or pipe into a task log'''
+
+# standard imports
+import os
+import queue
+import stat
+import sys
+import threading
+import time
+
+# local imports
+from cells import bulk
+from cells import config
+from cells import spool
+
+# An entry is sent once it reaches this many characters...
+MAX_ENTRY_CHARS = 32 * 1024
+# ...or once its first line has been waiting this many seconds
+DEFAULT_WINDOW = 5.0
+# Lines buffered between the reader and the sender. Once full, reading stalls until TheHive catches
+# up, so a burst never piles up in memory; longer lines are split to keep the buffer bounded
+QUEUE_LINES = 4096
+LINE_LIMIT = 4096
+# Seconds between checks for new data once the end of a followed file is reached
+READ_INTERVAL = 0.25
+
+def follow_file(path, stop, from_start=False):
+    """Yield lines appended to a file, like tail -f, until stop is set. Truncated files are read again
+    from the top and rotated files (a new file at the same path) are reopened. Pipes and '-' (stdin)
+    are read until they close instead.
+    :param path: File or named pipe to follow, or '-' for stdin
+    :type path: string
+    :param stop: threading.Event that ends the follow
+    :param from_start: Ship what is already in the file too, rather than only new lines
+    :type from_start: boolean
+    :return: one line at a time, without its newline
+    :rtype: generator
+    """
+    if path == '-' or stat.S_ISFIFO(os.stat(path).st_mode):
+        handle = sys.stdin if path == '-' else open(path, errors='replace')
+        try:
+            for line in handle:
+                yield line.rstrip('\n')
+                if stop.is_set():
+                    return
+        finally:
+            if handle is not sys.stdin:
+                handle.close()
+        return
+    handle = open(path, errors='replace')
+    if not from_start:
+        handle.seek(0, os.SEEK_END)
+    partial = ''
+    try:
+        while not stop.is_set():
+            line = handle.readline()
+            if line.endswith('\n'):
+                yield partial + line[:-1]
+                partial = ''
+                continue
+            # Half-written line; keep it until the writer finishes it
+            partial += line
+            if stop.wait(READ_INTERVAL):
+                break
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if current.st_ino != os.fstat(handle.fileno()).st_ino:
+                handle.close()
+                handle = open(path, errors='replace')
+                partial = ''
+            elif current.st_size < handle.tell():
+                handle.seek(0)
+                partial = ''
+        if partial:
+            yield partial
+    finally:
+        handle.close()
+
+class LogShipper(threading.Thread):
+    '''Coalesces lines into task log entries and posts them one at a time
+
+    Lines are joined into one entry until it reaches max_chars or its first line is window seconds
+    old, so a burst of thousands of lines a second becomes a handful of requests. Only one request is
+    in flight and the line buffer is bounded, so a slow or throttling TheHive slows the reader down
+    rather than being flooded. Entries that still fail after retries are spooled for --flush.
+    '''
+    def __init__(self, api, task_id, window=DEFAULT_WINDOW, max_chars=MAX_ENTRY_CHARS, retries=bulk.DEFAULT_RETRIES):
+        '''Class initialization'''
+        super(LogShipper, self).__init__(daemon=True)
+        self.api = api
+        self.task_id = task_id
+        self.window = window
+        self.max_chars = max_chars
+        self.retries = retries
+        self.lines = queue.Queue(maxsize=QUEUE_LINES)
+        self.stats = {'lines': 0, 'entries': 0, 'spooled': 0, 'lost': 0, 'chars': 0, 'failure': None,
+                      'lost_failure': None}
+
+    def put(self, line):
+        '''Queue a line for shipping; blocks while the buffer is full'''
+        for start in range(0, max(len(line), 1), LINE_LIMIT):
+            self.lines.put(line[start:start + LINE_LIMIT])
+        self.stats['lines'] += 1
+
+    def close(self):
+        '''Ship whatever is still buffered and wait for the sender to finish'''
+        self.lines.put(None)
+        self.join()
+
+    def ship(self, batch):
+        # Tool output is shown verbatim rather than rendered as markdown
+        message = '```\n{0}\n```'.format('\n'.join(batch))
+        failure = bulk.post_entry(self.api, self.task_id, {'message': message}, retries=self.retries)
+        if failure and failure.kind == bulk.RETRY:
+            spool.append(self.task_id, message, profile=config.CONFIG.profile)
+            self.stats['spooled'] += 1
+            self.stats['failure'] = failure
+        elif failure:
+            # TheHive may already have it, or will never take it; queueing it would only duplicate or block
+            self.stats['lost'] += 1
+            self.stats['lost_failure'] = failure
+        else:
+            self.stats['entries'] += 1
+        self.stats['chars'] += len(message)
+
+    def run(self):
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.monotonic(), 0) if batch else None)
+            except queue.Empty:
+                self.ship(batch)
+                batch, size = [], 0
+                continue
+            if line is None:
+                break
+            if batch and size + len(line) + 1 > self.max_chars:
+                self.ship(batch)
+                batch, size = [], 0
+            if not batch:
+                deadline = time.monotonic() + self.window
+            batch.append(line)
+            size += len(line) + 1
+        if batch:
+            self.ship(batch)
+
+def tail_and_ship(api, task_id, path, window=DEFAULT_WINDOW, from_start=False, retries=bulk.DEFAULT_RETRIES):
+    """Follow a file or pipe into a task log until it closes or Ctrl+C
+    :param api: thehive api connector
+    :param task_id: Task to log against
+    :type task_id: string
+    :param path: File or named pipe to follow, or '-' for stdin
+    :type path: string
+    :param window: Longest a line waits before its entry is sent, in seconds
+    :type window: float
+    :param from_start: Ship what is already in the file too
+    :type from_start: boolean
+    :return: lines read, entries sent and entries spooled
+    :rtype: dict
+    """
+    stop = threading.Event()
+    shipper = LogShipper(api, task_id, window=window, retries=retries)
+    shipper.start()
+    start = time.time()
+    try:
+        for line in follow_file(path, stop, from_start=from_start):
+            shipper.put(line)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        shipper.close()
+    shipper.stats['elapsed'] = time.time() - start
+    return shipper.stats
+
+def report(summary, path):
+    """Print a tail-and-ship summary
+    :param summary: Summary returned by tail_and_ship
+    :type summary: dict
+    :param path: What was followed
+    :type path: string
+    """
+    print("\nBzz Bzz Bzz...shipped {0} lines from {1} as {2} log entries in {3:.1f}s".format(
+        summary['lines'], 'stdin' if path == '-' else path, summary['entries'], summary['elapsed']))
+    if summary['spooled']:
+        print("\t{0} entries could not be sent ({1}) and were queued; run pollen with --flush to send them."
+              .format(summary['spooled'], summary['failure']))
+    if summary['lost']:
+        print("\t{0} entries were not queued ({1}); check the task log for them."
+              .format(summary['lost'], summary['lost_failure']))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain streaming attachment uploads'''
+
+# standard imports
+import io
+import mimetypes
+import os
+import sys
+import time
+import uuid
+
+# Largest piece of the attachment held in memory at any one time
+CHUNK_SIZE = 1024 * 1024
+# Minimum seconds between progress line updates
+PROGRESS_INTERVAL = 0.2
+
+class MultipartFile(object):
+    '''File-like multipart/form-data body that streams its attachment from disk
+
+    thehive4py (and requests' files= option) build the whole multipart body in memory, which does
+    not end well for multi-GB memory dumps. This body is read by requests a chunk at a time, so
+    memory use stays flat however large the file is, and the exact Content-Length is known up front.
+    '''
+    def __init__(self, path, fields, progress=None, chunk_size=CHUNK_SIZE, filename=None):
+        """Class initialization
+        :param path: File to attach
+        :type path: string
+        :param filename: Name to give the attachment; the file's own name by default
+        :type filename: string
+        :param fields: Plain form fields to send ahead of the attachment
+        :type fields: dict
+        :param progress: Optional callable taking (bytes sent, total bytes)
+        :param chunk_size: Largest read from the file at once
+        :type chunk_size: int
+        """
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self.chunk_size = chunk_size
+        filename = filename or os.path.basename(path)
+        mime, encoding = mimetypes.guess_type(filename)
+        # e.g. timeline.csv.gz is a gzip file, not a CSV
+        if encoding:
+            mime = 'application/{0}'.format(encoding)
+        mime = mime or 'application/octet-stream'
+        head = ''
+        for name, value in fields.items():
+            head += '--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'.format(
+                self.boundary, name, value)
+        head += ('--{0}\r\nContent-Disposition: form-data; name="attachment"; filename="{1}"\r\n'
+                 'Content-Type: {2}\r\n\r\n').format(self.boundary, filename, mime)
+        head = head.encode('utf-8')
+        tail = '\r\n--{0}--\r\n'.format(self.boundary).encode('utf-8')
+        self.size = len(head) + os.path.getsize(path) + len(tail)
+        self.parts = [io.BytesIO(head), open(path, 'rb'), io.BytesIO(tail)]
+        self.sent = 0
+
+    @property
+    def content_type(self):
+        '''Content-Type header value, including the boundary'''
+        return 'multipart/form-data; boundary={0}'.format(self.boundary)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        '''Read up to size bytes (never more than chunk_size) of the body'''
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        while self.parts:
+            chunk = self.parts[0].read(size)
+            if chunk:
+                self.sent += len(chunk)
+                if self.progress:
+                    self.progress(self.sent, self.size)
+                return chunk
+            self.parts.pop(0).close()
+        return b''
+
+    def __iter__(self):
+        chunk = self.read()
+        while chunk:
+            yield chunk
+            chunk = self.read()
+
+    def close(self):
+        '''Close the attachment, e.g. if the upload was abandoned part way'''
+        for part in self.parts:
+            part.close()
+        self.parts = []
+
+def human_size(num_bytes):
+    '''Bytes as a short human readable string'''
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if num_bytes < 1024:
+            return '{0:.1f} {1}'.format(num_bytes, unit)
+        num_bytes /= 1024.0
+    return '{0:.1f} TiB'.format(num_bytes)
+
+def progress_printer(stream=sys.stdout):
+    """Build a progress callback for MultipartFile that prints size, percentage and throughput
+    :param stream: Where to print the progress line
+    :return: progress callback
+    :rtype: function
+    """
+    # Timed from the first chunk sent, not from when the printer was built (e.g. before compressing)
+    start = [None]
+    last = [None]
+
+    def progress(sent, total):
+        now = time.time()
+        if start[0] is None:
+            start[0] = last[0] = now
+        if sent < total and now - last[0] < PROGRESS_INTERVAL:
+            return
+        last[0] = now
+        elapsed = max(now - start[0], 1e-6)
+        stream.write('\r\tUploaded {0} of {1} ({2:.0f}%) at {3}/s '.format(
+            human_size(sent), human_size(total), 100.0 * sent / total, human_size(sent / elapsed)))
+        if sent >= total:
+            stream.write('\n')
+        stream.flush()
+    return progress
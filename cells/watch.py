@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+'''Python module to contain the case change feed (watch mode)'''
+
+# standard imports
+import threading
+import time
+
+# thehive4py imports
+from thehive4py.exceptions import TheHiveException
+from thehive4py.query import And, Gt, Id, Parent
+
+# local imports
+from cells import config
+
+# Polling starts this often (seconds), and goes back to it whenever something changes...
+MIN_INTERVAL = 2
+# ...and slows down by BACKOFF on every quiet poll, up to MAX_INTERVAL
+MAX_INTERVAL = 60
+BACKOFF = 1.5
+# Longest a stream read may be held open; TheHive answers empty-handed well before this
+STREAM_WAIT = 90
+# Task fields whose changes are reported
+TASK_FIELDS = ('title', 'status', 'owner', 'flag')
+# Log messages are cut down to this for the feed
+MESSAGE_WIDTH = 100
+
+def stamp():
+    '''Wall-clock prefix for a feed line'''
+    return time.strftime('%H:%M:%S')
+
+def rows(resp):
+    '''Records of a search response, or TheHiveException if the search failed'''
+    if resp.status_code != 200:
+        raise TheHiveException("HTTP {0} from TheHive".format(resp.status_code))
+    return resp.json()
+
+class CaseWatcher(object):
+    '''Follows one case and reports only what has changed: new tasks, task updates and new logs
+
+    Where TheHive offers its audit stream (/api/stream), events are read from it as they happen.
+    Otherwise the case is polled for tasks and logs created or updated since the last poll, at an
+    interval that shortens while the case is busy and backs off while it is quiet. Records seen in
+    the overlap between two polls are recognised and not reported twice.
+    '''
+    def __init__(self, api, case_id, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+        '''Class initialization'''
+        self.api = api
+        self.case_id = case_id
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.tasks = {}
+        self.seen_logs = set()
+        self.since = None
+        self.stream_id = None
+
+    def logs_query(self, since):
+        '''Logs of any task in this case, created after since (epoch milliseconds)'''
+        return And(Parent('case_task', Parent('case', Id(self.case_id))), Gt('createdAt', since))
+
+    def snapshot(self):
+        """Record the current state of the case, so that only later changes are reported
+        :return: number of tasks in the case
+        :rtype: int
+        """
+        self.since = int(time.time() * 1000)
+        tasks = rows(self.api.get_case_tasks(self.case_id))
+        for task in tasks:
+            self.tasks[task['id']] = task
+        overlap = self.since - config.SYNC_OVERLAP * 1000
+        for log in rows(self.api.find_task_logs(query=self.logs_query(overlap))):
+            self.seen_logs.add(log['id'])
+        if config.USE_CACHE:
+            config.get_cache().store(config.listing_key(self.case_id), config.trim_tasks(tasks), self.since / 1000.0)
+        return len(tasks)
+
+    def task_change(self, task):
+        """Describe how a task differs from when it was last seen
+        :param task: Full task document
+        :type task: dict
+        :return: feed line, or None if nothing reported has changed
+        :rtype: string
+        """
+        before = self.tasks.get(task['id'])
+        self.tasks[task['id']] = task
+        if before is None:
+            return "New task: {0} ({1})".format(task.get('title'), task.get('status'))
+        changes = ["{0} {1} -> {2}".format(field, before.get(field), task.get(field))
+                   for field in TASK_FIELDS if before.get(field) != task.get(field)]
+        if not changes:
+            return None
+        return "Task {0}: {1}".format(task.get('title'), ', '.join(changes))
+
+    def log_change(self, log):
+        '''Describe a task log, unless it has been reported already'''
+        if log['id'] in self.seen_logs:
+            return None
+        self.seen_logs.add(log['id'])
+        task = self.tasks.get(log.get('_parent'), {})
+        message = ' '.join((log.get('message') or '').split())
+        if len(message) > MESSAGE_WIDTH:
+            message = message[:MESSAGE_WIDTH - 3] + '...'
+        line = "Log on {0} by {1}: {2}".format(task.get('title', 'a task'), log.get('createdBy', 'someone'), message)
+        if log.get('attachment'):
+            line += " [{0}]".format(log['attachment'].get('name', 'attachment'))
+        return line
+
+    def poll(self):
+        """Fetch tasks and logs changed since the last poll
+        :return: feed lines, oldest first
+        :rtype: list
+        """
+        polled_at = int(time.time() * 1000)
+        # A little overlap guards against clock skew between pollen and TheHive
+        since = self.since - config.SYNC_OVERLAP * 1000
+        tasks = rows(self.api.get_case_tasks(self.case_id, query=config.changed_since(since), sort=['+updatedAt']))
+        logs = rows(self.api.find_task_logs(query=self.logs_query(since), sort=['+createdAt']))
+        self.since = polled_at
+        lines = [self.task_change(task) for task in tasks]
+        changed = [task for task, line in zip(tasks, lines) if line]
+        lines += [self.log_change(log) for log in logs]
+        if changed and config.USE_CACHE:
+            config.get_cache().store(config.listing_key(self.case_id), config.trim_tasks(changed),
+                                     polled_at / 1000.0, replace=False)
+        return [line for line in lines if line]
+
+    def adapt(self, changed):
+        '''Poll again quickly after a change, and less and less often while nothing happens'''
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * BACKOFF, self.max_interval)
+        return self.interval
+
+    def open_stream(self):
+        """Try to follow the case through TheHive's audit stream
+        :return: whether a stream is available
+        :rtype: boolean
+        """
+        try:
+            resp = self.api.open_stream()
+        except TheHiveException:
+            return False
+        if resp.status_code != 200 or not resp.text.strip():
+            return False
+        self.stream_id = resp.text.strip().strip('"')
+        return True
+
+    def read_stream(self):
+        """Wait for the next batch of audit events and keep the ones about this case
+        :return: feed lines, oldest first
+        :rtype: list
+        :raises TheHiveException: If the stream has gone away
+        """
+        resp = self.api.read_stream(self.stream_id, STREAM_WAIT)
+        if resp.status_code != 200:
+            raise TheHiveException("HTTP {0} from the audit stream".format(resp.status_code))
+        lines = []
+        changed = []
+        for event in resp.json():
+            # TheHive 3 groups events as {"base": event, "summary": ..., "count": ...}
+            event = event.get('base', event)
+            if event.get('rootId') != self.case_id:
+                continue
+            record = dict(event.get('object') or {})
+            if event.get('objectType') == 'case_task':
+                record.setdefault('id', event.get('objectId'))
+                if not record.get('title') and record['id'] in self.tasks:
+                    record = dict(self.tasks[record['id']], **(event.get('details') or {}))
+                line = self.task_change(record)
+                if line:
+                    changed.append(record)
+            elif event.get('objectType') == 'case_task_log' and event.get('operation') == 'Creation':
+                record.setdefault('id', event.get('objectId'))
+                line = self.log_change(record)
+            else:
+                continue
+            if line:
+                lines.append(line)
+        if changed and config.USE_CACHE:
+            config.get_cache().store(config.listing_key(self.case_id), config.trim_tasks(changed), time.time(),
+                                     replace=False)
+        return lines
+
+    def follow(self, emit=print, stop=None, use_stream=True):
+        """Report changes until stopped (Ctrl+C, or stop being set)
+        :param emit: Callable taking each feed line
+        :param stop: Optional threading.Event that ends the watch
+        :param use_stream: Try TheHive's audit stream before falling back to polling
+        :type use_stream: boolean
+        """
+        stop = stop or threading.Event()
+        streaming = use_stream and self.open_stream()
+        emit("[{0}] Watching {1} tasks {2}. Press Ctrl+C to stop.".format(
+            stamp(), self.snapshot(), 'through the audit stream' if streaming else 'by polling'))
+        while not stop.is_set():
+            try:
+                lines = self.read_stream() if streaming else self.poll()
+            except (TheHiveException, ValueError) as err:
+                if streaming:
+                    # The stream is gone (or was never really there); polling picks up from here
+                    streaming = False
+                    emit("[{0}] Audit stream unavailable ({1}); polling instead.".format(stamp(), err))
+                    continue
+                emit("[{0}] Could not reach TheHive ({1}); retrying.".format(stamp(), err))
+                lines = []
+            for line in lines:
+                emit("[{0}] {1}".format(stamp(), line))
+            if not streaming:
+                stop.wait(self.adapt(bool(lines)))
+
+def watch_case(case_id, case_name=None, use_stream=True):
+    """Follow a case on the configured server until Ctrl+C
+    :param case_id: TheHive case ID
+    :type case_id: string
+    :param case_name: Case title, for the banner
+    :type case_name: string
+    :param use_stream: Try TheHive's audit stream before falling back to polling
+    :type use_stream: boolean
+    """
+    print("***** Watching Case: {0} *****".format(case_name or case_id))
+    try:
+        CaseWatcher(config.get_api(), case_id).follow(use_stream=use_stream)
+    except KeyboardInterrupt:
+        print("\nBzz Bzz Bzz...stopped watching.")
+    except TheHiveException as err:
+        config.sneeze(error_message="Watch the case {0} ({1})".format(case_name or case_id, err),
+                      error_fix="Check the server is reachable and the case ID is right, then try again.")
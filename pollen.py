@@ -20,16 +20,15 @@ project-related details.
 
 # Standard imports
 import argparse
+import os
 import sys
-import configparser
 import importlib.util as util
 
-# thehive4py imports
-from thehive4py.models import CaseTaskLog
-
-# Local imports
+# Local imports; the shell, bulk, spool and upload modules (and thehive4py) are only imported by the
+# code paths that need them, so one-shot --log calls start as quickly as possible
+from cells import agent
 from cells import config
-from cells import shell
+from cells import perf
 
 __author__ = "Matt Bromiley (@mbromileyDFIR)"
 __license__ = "GNU Affero GPL3"
@@ -52,9 +51,13 @@ def dat_ascii():
 Keeping the busy analysis bees busy!
 """)
 
-def cli_entry(entry=False, logfile=False):
+def cli_entry(entry=False, logfile=False, queue=False, compress=False, force=False):
     """Quick function to perform easy cmd insertions
     :param entry: Log entry to be inserted
+    :param logfile: File to attach to the log entry
+    :param queue: Spool the entry locally for a later --flush instead of sending it now
+    :param compress: gzip the attachment before upload if that saves much
+    :param force: Upload the attachment even if the same content has been uploaded before
     """
     task_id = config.get_config(config_format="cmdline")
     if not task_id:
@@ -63,15 +66,280 @@ def cli_entry(entry=False, logfile=False):
     if task_id:
         # Combine entry together
         entry = ' '.join(entry)
-        # Logic to handle entries with or without file attachments
-        if logfile:
-            task_entry = CaseTaskLog(message=entry, file=str(logfile))
-        else:
-            task_entry = CaseTaskLog(message=entry)
+        # Attachment options only when asked for, so the [Uploads] settings apply otherwise
+        options = {name: True for name, value in (('compress', compress), ('force', force)) if value}
+        # Hand the entry to a running pollen agent, which already has a warm connection to TheHive
+        if agent_entry(task_id, entry, logfile, queue, options):
+            return
+        if queue:
+            from cells import spool
+            spool.append(task_id, entry, logfile, profile=config.CONFIG.profile, **options)
+            print("Bzz Bzz Bzz...queued locally. Run pollen with --flush to send it to TheHive.")
+            return
+        from thehive4py.exceptions import TheHiveException
         api = config.get_api()
-        resp = api.create_task_log(task_id, task_entry)
-        if resp.status_code == 201:
+        # Logic to handle entries with or without file attachments; attachments are streamed, and
+        # content uploaded before is only referenced
+        outcome = None
+        error = None
+        try:
+            if logfile:
+                from cells import attachments
+                from cells import upload
+                resp, outcome = attachments.attach(api, task_id, entry, str(logfile),
+                                                   progress=upload.progress_printer(),
+                                                   compress_upload=options.get('compress'), force=force)
+            else:
+                resp = api.add_task_log(task_id, entry)
+        except TheHiveException as err:
+            resp, error = None, err
+        from cells import resilience
+        # Only worth queueing if TheHive never got it, or turned it away for now (429/503); a 500/502/504
+        # may have been applied upstream
+        retry_later = resilience.never_sent(error) if resp is None else resp.status_code in resilience.WRITE_RETRY_STATUS
+        if resp is not None and resp.status_code == 201:
             print("Bzz Bzz Bzz...successfully inserted into task log. Happy analyzing!")
+            if outcome and attachments.describe(outcome):
+                print("\t{0}".format(attachments.describe(outcome)))
+        elif retry_later:
+            # Don't lose the entry; keep it for the next --flush
+            from cells import spool
+            spool.append(task_id, entry, logfile, profile=config.CONFIG.profile, **options)
+            config.sneeze(error_message="Insert a log entry while TheHive is unreachable or refusing it.",
+                          error_fix="Run pollen with --flush once TheHive is back; the entry has been queued.")
+        elif resp is None or resp.status_code >= 500:
+            # It may well have been written; queueing it would add it a second time
+            config.sneeze(error_message="Insert a log entry, but TheHive did not confirm it ({0}).".format(
+                              error if resp is None else "HTTP {0}".format(resp.status_code)),
+                          error_fix="Check the task log before adding it again; the entry may already be there.")
+        else:
+            config.sneeze(error_message="Insert a log entry that TheHive refused (HTTP {0}).".format(resp.status_code),
+                          error_fix="Check the active task still exists (pollen --cmd); the entry was not queued.")
+
+def agent_entry(task_id, entry, logfile, queue, options):
+    """Pass a log entry to the pollen agent, if one is running here
+    :param task_id: Task to log against
+    :type task_id: string
+    :param entry: Log message
+    :type entry: string
+    :param logfile: File to attach, if any
+    :param queue: Let the agent spool the entry and send it in the background
+    :type queue: boolean
+    :param options: How to upload the attachment, e.g. compress=True
+    :type options: dict
+    :return: whether an agent took the entry
+    :rtype: boolean
+    """
+    reply = agent.request(dict(options, op='log', task_id=task_id, message=entry, queue=queue,
+                               file=os.path.abspath(logfile) if logfile else None, profile=config.CONFIG.profile))
+    if reply is None:
+        return False
+    if reply['ok'] and reply.get('queued'):
+        print("Bzz Bzz Bzz...handed to the pollen agent, which will send it to TheHive shortly.")
+    elif reply['ok']:
+        print("Bzz Bzz Bzz...successfully inserted into task log. Happy analyzing!")
+    elif reply.get('queued'):
+        config.sneeze(error_message="Insert a log entry while TheHive is unreachable or refusing it ({0}).".format(
+                          reply['error']),
+                      error_fix="Nothing to do; the pollen agent has queued the entry and keeps retrying it.")
+    else:
+        config.sneeze(error_message="Insert a log entry through the pollen agent ({0}).".format(reply['error']),
+                      error_fix="Check the task log before trying again, or stop the agent with pollen --agent stop.")
+    return True
+
+def agent_control(action):
+    """Run, stop or check on the pollen agent
+    :param action: run, stop or status
+    :type action: string
+    """
+    if action == "run":
+        agent.serve()
+        return
+    reply = agent.request({'op': 'stop' if action == "stop" else 'ping'}, timeout=agent.CONNECT_TIMEOUT * 10)
+    if reply is None:
+        print("No pollen agent is running here. Start one with pollen --agent run.")
+    elif action == "stop":
+        print("Bzz Bzz Bzz...pollen agent stopped.")
+    else:
+        print("Bzz Bzz Bzz...pollen agent {0} up for {1:.0f}s, {2} requests answered, {3} entries queued."
+              .format(reply['pid'], reply['uptime'], sum(reply['requests'].values()), reply['queued']))
+        for server, stats in reply['clients']:
+            print("\t{0}: {1} requests over {2} connections, circuit breaker {3}".format(
+                server, stats['requests'], stats['connections'], stats['breaker']))
+
+def flush_entry():
+    """Send every queued log entry to TheHive"""
+    from cells import spool
+    spool.report(spool.flush())
+
+def bulk_entry(source, workers, retries):
+    """Ingest many log entries in one process and one pooled session
+    :param source: File of entries (plain text or JSON lines), or '-' for stdin
+    :type source: string
+    :param workers: Number of concurrent requests
+    :type workers: int
+    :param retries: Retries per entry on throttling or server errors
+    :type retries: int
+    """
+    from cells import bulk
+    task_id = config.get_config(config_format="cmdline")
+    if not task_id:
+        config.sneeze(error_message="Bulk insert log entries using the --bulk option, without an active case or task.",
+                      error_fix="Run pollen with the --cmd option to set an active case and task.")
+        return
+    summary = bulk.ingest(config.get_api(), task_id, bulk.read_entries(source),
+                          workers=workers or bulk.DEFAULT_WORKERS,
+                          retries=bulk.DEFAULT_RETRIES if retries is None else retries)
+    print("Bzz Bzz Bzz...{0} entries inserted, {1} failed in {2:.2f}s ({3:.1f} entries/s)"
+          .format(summary['posted'], summary['failed'], summary['elapsed'], summary['rate']))
+    for line_no, failure in summary['failures']:
+        print("\tEntry {0}: {1}".format(line_no, failure))
+
+def follow_entry(path, window, from_start, retries):
+    """Tail a file or pipe into the active task's log, a batch of lines per entry
+    :param path: File or named pipe to follow, or '-' for stdin
+    :type path: string
+    :param window: Longest a line waits before its entry is sent, in seconds
+    :type window: float
+    :param from_start: Ship what is already in the file too, rather than only new lines
+    :type from_start: boolean
+    :param retries: Retries per entry on throttling or server errors
+    :type retries: int
+    """
+    from cells import bulk, tail
+    task_id = config.get_config(config_format="cmdline")
+    if not task_id:
+        config.sneeze(error_message="Follow a file into a task log using the --follow option, without an active case or task.",
+                      error_fix="Run pollen with the --cmd option to set an active case and task.")
+        return
+    if path != '-' and not os.path.exists(path):
+        config.sneeze(error_message="Follow {0}, which does not exist.".format(path),
+                      error_fix="Check the path, or pipe the tool's output in with --follow -.")
+        return
+    print("Bzz Bzz Bzz...shipping {0} to the active task. Press Ctrl+C to stop.".format(
+        'stdin' if path == '-' else path))
+    summary = tail.tail_and_ship(config.get_api(), task_id, path, window=window or tail.DEFAULT_WINDOW,
+                                 from_start=from_start, retries=bulk.DEFAULT_RETRIES if retries is None else retries)
+    tail.report(summary, path)
+
+def manifest_entry(path, variables, workers, retries):
+    """Create the cases and tasks of a manifest, filling in any template variables
+    :param path: JSON template or CSV manifest
+    :type path: string
+    :param variables: name=value strings for the template's {placeholders}
+    :type variables: list
+    :param workers: Number of concurrent task creations
+    :type workers: int
+    :param retries: Retries per request on throttling or server errors
+    :type retries: int
+    """
+    from cells import bulk, manifest
+    try:
+        entries = manifest.read_manifest(path, dict(variable.split('=', 1) for variable in variables))
+    except (OSError, ValueError) as err:
+        config.sneeze(error_message="Create cases and tasks from the manifest {0} ({1})".format(path, err),
+                      error_fix="Check the file exists, is valid JSON or CSV, and --var values are name=value.")
+        return
+    manifest.report(manifest.apply(config.get_api(), entries, workers=workers or bulk.DEFAULT_WORKERS,
+                                   retries=bulk.DEFAULT_RETRIES if retries is None else retries))
+
+def export_entry(path, case_ids, all_cases, attachments, workers):
+    """Export cases, their tasks and logs (and optionally attachments) to a local file
+    :param path: Output file; .jsonl, .jsonl.gz or .parquet
+    :type path: string
+    :param case_ids: Only export these case IDs
+    :type case_ids: list
+    :param all_cases: Export every case rather than only open ones
+    :type all_cases: boolean
+    :param attachments: Directory to download attachments into, if any
+    :type attachments: string
+    :param workers: Number of cases fetched at once
+    :type workers: int
+    """
+    from cells import export
+    if path.endswith('.parquet') and util.find_spec("pyarrow") is None:
+        config.sneeze(error_message="Export to Parquet without pyarrow installed.",
+                      error_fix="Install pyarrow (pip3 install pyarrow), or export to .jsonl or .jsonl.gz instead.")
+        return
+    summary = export.export_cases(path, case_ids=case_ids, status=None if all_cases else 'Open',
+                                  workers=workers or export.EXPORT_WORKERS, attachments=attachments)
+    export.report(summary, path)
+
+def observables_entry(path, case_ids, data_type, tlp, ioc, tags, workers, retries):
+    """Add the observables of a CSV, STIX 2 bundle or plain list to a case, skipping those it already has
+    :param path: File of observables, or '-' for a plain list on stdin
+    :type path: string
+    :param case_ids: Case to add them to (the first one given); the active case by default
+    :type case_ids: list
+    :param data_type: Data type of every value, rather than the file's or a guessed one
+    :type data_type: string
+    :param tlp: TLP of the new observables
+    :type tlp: int
+    :param ioc: Flag the new observables as IOCs
+    :type ioc: boolean
+    :param tags: Tags for every new observable
+    :type tags: list
+    :param workers: Number of concurrent create calls
+    :type workers: int
+    :param retries: Retries per batch on throttling or server errors
+    :type retries: int
+    """
+    from cells import bulk, observables
+    case_id = case_ids[0] if case_ids else config.CONFIG.case_id
+    if not case_id:
+        config.sneeze(error_message="Import observables without a case ID or an active case.",
+                      error_fix="Give a case ID (--case <case id>), or set an active case with pollen --cmd.")
+        return
+    summary = observables.import_file(path, case_id, data_type=data_type, workers=workers or bulk.DEFAULT_WORKERS,
+                                      retries=bulk.DEFAULT_RETRIES if retries is None else retries,
+                                      tlp=observables.DEFAULT_TLP if tlp is None else tlp, ioc=ioc, tags=tags)
+    if summary:
+        observables.report(summary, config.CONFIG.case_name if case_id == config.CONFIG.case_id else case_id)
+
+def watch_entry(case_id, poll):
+    """Follow a case's new tasks, task changes and new logs until Ctrl+C
+    :param case_id: Case to watch; the active case by default
+    :type case_id: string
+    :param poll: Skip TheHive's audit stream and poll for changes
+    :type poll: boolean
+    """
+    from cells import watch
+    case_id = case_id or config.CONFIG.case_id
+    if not case_id:
+        config.sneeze(error_message="Watch a case without a case ID or an active case.",
+                      error_fix="Give a case ID (--watch <case id>), or set an active case with pollen --cmd.")
+        return
+    case_name = config.CONFIG.case_name if case_id == config.CONFIG.case_id else None
+    watch.watch_case(case_id, case_name, use_stream=not poll)
+
+def batch_entry(source, workers, keep_going, results):
+    """Run a script of pollen commands in this process, over one session to TheHive
+    :param source: Batch script, or '-' for stdin
+    :type source: string
+    :param workers: Number of steps run side by side
+    :type workers: int
+    :param keep_going: Carry on after a failed step
+    :type keep_going: boolean
+    :param results: File to write per-step results to as JSON lines, if any
+    :type results: string
+    :return: exit code; 0 when every step succeeded
+    :rtype: int
+    """
+    from cells import batch
+    try:
+        steps = batch.read_script(source)
+    except OSError as err:
+        config.sneeze(error_message="Run the batch script {0} ({1})".format(source, err),
+                      error_fix="Check the path, or pipe the script in with --batch -.")
+        return batch.EXIT_USAGE
+    problems = batch.check_script(steps)
+    if problems:
+        config.sneeze(error_message="Run a batch script with commands pollen does not know ({0})".format(
+                          '; '.join(problems)),
+                      error_fix="Fix those lines; nothing has been run. See cells/batch.py for the commands.")
+        return batch.EXIT_USAGE
+    steps, elapsed = batch.run(steps, workers=workers or batch.BATCH_WORKERS, keep_going=keep_going)
+    return batch.report(steps, elapsed, results)
 
 def check_config():
     """Quick function to check whether config is valid or not
@@ -79,12 +347,19 @@ def check_config():
     :rtype: boolean
     """
     # Very primitive but extremely crucial function
-    # TODO: There's a lot of scenarios where config files are read; might distill these down
-    config_check = configparser.ConfigParser()
-    config_read = config_check.read('.pollen_config')
-    if config_read:
-        return True
-    return False
+    return config.CONFIG.exists()
+
+def command_name(args):
+    """Name a pollen.py run after its first option, for the profile
+    :param args: Parsed command-line arguments
+    :return: option name, e.g. --log
+    :rtype: string
+    """
+    for option in ('cmd', 'log', 'flush', 'tasks', 'bulk', 'follow', 'manifest', 'export', 'observables', 'watch',
+                   'servers', 'agent', 'batch'):
+        if getattr(args, option):
+            return '--{0}'.format(option)
+    return 'pollen.py'
 
 def main():
     """Main Function. Includes argument parsing and config checker"""
@@ -96,11 +371,73 @@ def main():
     group.add_argument("-c", "--cmd", help="Pollen Command-Line Module", action="store_true")
     group.add_argument("-l", "--log", help="Add log entry for configured case and task", nargs="+")
     group.add_argument("-lf", "--logfile", help="Attach a file to the corresponding log entry.")
+    group.add_argument("--compress", help="With --logfile, gzip the attachment first if that saves much",
+                       action="store_true")
+    group.add_argument("--force-upload", help="With --logfile, upload the attachment even if the same file "
+                       "has been uploaded before", action="store_true")
+    group.add_argument("-q", "--queue", help="Queue the --log entry locally instead of waiting on TheHive",
+                       action="store_true")
+    group.add_argument("--flush", help="Send all queued log entries to TheHive", action="store_true")
+    group.add_argument("-t", "--tasks", help="List tasks across all open cases, optionally only those "
+                       "with a given status (e.g. Waiting)", nargs="?", const="all")
+    group.add_argument("--mine", help="With --tasks, only list tasks assigned to you", action="store_true")
+    group.add_argument("-b", "--bulk", help="Add many log entries, one per line (text or JSON), "
+                       "from a file or '-' for stdin")
+    group.add_argument("-f", "--follow", help="Tail a growing file (or '-' for stdin) into the active task's log, "
+                       "batching lines into entries, until Ctrl+C or the pipe closes")
+    group.add_argument("--window", help="With --follow, longest a line waits before it is sent, in seconds "
+                       "(default: 5)", type=float)
+    group.add_argument("--from-start", help="With --follow, ship what is already in the file too",
+                       action="store_true")
+    group.add_argument("-m", "--manifest", help="Create the cases and tasks of a JSON template or CSV manifest; "
+                       "cases and tasks that already exist are skipped")
+    group.add_argument("--var", help="Fill a {placeholder} in the --manifest template, e.g. --var client=ACME",
+                       action="append", default=[])
+    group.add_argument("-e", "--export", help="Stream cases with their tasks and logs to a .jsonl, .jsonl.gz "
+                       "or .parquet file (open cases unless --case or --all-cases is given)")
+    group.add_argument("--case", help="With --export, only export this case ID (repeatable); with --observables, "
+                       "the case to add to instead of the active one", action="append")
+    group.add_argument("--all-cases", help="With --export, export every case, not just open ones",
+                       action="store_true")
+    group.add_argument("--attachments", help="With --export, download log attachments into this directory")
+    group.add_argument("-O", "--observables", help="Add the observables (IPs, hashes, domains...) of a CSV, "
+                       "STIX 2 JSON bundle or plain list ('-' for stdin) to the active case, skipping duplicates")
+    group.add_argument("--data-type", help="With --observables, the data type of every value (e.g. ip), "
+                       "rather than the file's or a guessed one")
+    group.add_argument("--tlp", help="With --observables, TLP of the new observables (default: 2)", type=int)
+    group.add_argument("--ioc", help="With --observables, flag the new observables as IOCs", action="store_true")
+    group.add_argument("--tag", help="With --observables, tag every new observable (repeatable)",
+                       action="append", default=[])
+    group.add_argument("-W", "--watch", help="Follow new tasks, task changes and new logs of a case until "
+                       "Ctrl+C (the active case unless a case ID is given)", nargs="?", const="active")
+    group.add_argument("--poll", help="With --watch, poll for changes rather than use TheHive's audit stream",
+                       action="store_true")
+    group.add_argument("--agent", help="Run a resident pollen agent in this directory that --log hands its "
+                       "entries to, stop it, or show its status", choices=["run", "stop", "status"])
+    group.add_argument("-B", "--batch", help="Run a script of pollen commands (or '-' for stdin) in one "
+                       "process and session, picking cases and tasks by ID or title; exits non-zero if a step fails")
+    group.add_argument("--keep-going", help="With --batch, carry on after a failed step", action="store_true")
+    group.add_argument("--batch-results", help="With --batch, write per-step timings and exit codes to this "
+                       "file as JSON lines")
+    group.add_argument("-w", "--workers", help="Concurrent requests for --bulk, --manifest, --export and "
+                       "--observables, or steps for --batch (default: 4)", type=int)
+    group.add_argument("--retries", help="Retries per request for --bulk, --follow, --manifest and --observables "
+                       "(default: 3); a write is only sent again if it never reached TheHive, or TheHive "
+                       "answered 429/503 with a Retry-After", type=int)
+    group.add_argument("-s", "--server", help="Use the named server profile instead of the default one")
+    group.add_argument("--servers", help="Show case stats from every configured server at once; "
+                       "'--servers cases' also lists their open cases", nargs="?", const="stats")
+    group.add_argument("--no-cache", help="Skip the local case/task cache and always ask TheHive",
+                       action="store_true")
+    group.add_argument("--profile", help="Print per-command and per-endpoint timings of TheHive calls "
+                       "when done", action="store_true")
+    group.add_argument("--profile-output", help="Append TheHive call timings as JSON lines to this file")
     # Standard options override
     group = parser.add_argument_group('Standard Options')
     group.add_argument('-h', '--help', action="help", help="Show this help message and quit")
-    # Display ascii art no matter what
-    dat_ascii()
+    # Display ascii art, unless we are being driven by a script or pipe
+    if sys.stdout.isatty():
+        dat_ascii()
     # Much cleaner and more pythonic way to check if primary library exists
     if util.find_spec("thehive4py") is not None:
         args = parser.parse_args()
@@ -112,21 +449,61 @@ def main():
     if len(sys.argv) == 1:
         print("No options provided!\nTry running me with a -h option to see what I can do.")
 
-    # Option to hop into cmdloop
-    if args.cmd:
-        if not check_config():
-            shell.PollenCmd(config_present=False).cmdloop()
-        shell.PollenCmd().cmdloop()
-    # Option to insert log entry or log entry with a file
-    if args.log:
-        if args.logfile:
-            cli_entry(entry=args.log, logfile=args.logfile)
-        else:
-            cli_entry(entry=args.log)
-    # log files require log entries; the following ensures we have both
-    if args.logfile and not args.log:
-        config.sneeze(error_message="Upload a log file without a log entry",
-                      error_fix="Retry your command with a -l or --log option")
+    if args.no_cache:
+        config.USE_CACHE = False
+    if args.server and not config.use_profile(args.server):
+        config.sneeze(error_message="Use the server profile {0}, which is not configured.".format(args.server),
+                      error_fix="Add it with 'profile add {0}' in the config menu of pollen --cmd.".format(args.server))
+        return
+    exit_code = 0
+    # Everything below is timed as one command, named after the first option given
+    with perf.command(command_name(args)):
+        # Option to hop into cmdloop
+        if args.cmd:
+            from cells import shell
+            if not check_config():
+                shell.PollenCmd(config_present=False).cmdloop()
+            shell.PollenCmd().cmdloop()
+        # Option to insert log entry or log entry with a file
+        if args.log:
+            if args.logfile:
+                cli_entry(entry=args.log, logfile=args.logfile, queue=args.queue, compress=args.compress,
+                          force=args.force_upload)
+            else:
+                cli_entry(entry=args.log, queue=args.queue)
+        if args.flush:
+            flush_entry()
+        if args.tasks:
+            config.task_overview(status=None if args.tasks == "all" else args.tasks, mine=args.mine)
+        if args.bulk:
+            bulk_entry(args.bulk, workers=args.workers, retries=args.retries)
+        if args.follow:
+            follow_entry(args.follow, args.window, args.from_start, retries=args.retries)
+        if args.manifest:
+            manifest_entry(args.manifest, args.var, workers=args.workers, retries=args.retries)
+        if args.export:
+            export_entry(args.export, args.case, args.all_cases, args.attachments, workers=args.workers)
+        if args.observables:
+            observables_entry(args.observables, args.case, args.data_type, args.tlp, args.ioc, args.tag,
+                              workers=args.workers, retries=args.retries)
+        if args.watch:
+            watch_entry(None if args.watch == "active" else args.watch, args.poll)
+        if args.servers:
+            config.server_overview(list_cases=args.servers == "cases")
+        if args.agent:
+            agent_control(args.agent)
+        if args.batch:
+            exit_code = batch_entry(args.batch, args.workers, args.keep_going, args.batch_results)
+        # log files require log entries; the following ensures we have both
+        if args.logfile and not args.log:
+            config.sneeze(error_message="Upload a log file without a log entry",
+                          error_fix="Retry your command with a -l or --log option")
+    if args.profile:
+        perf.report(stream=sys.stderr)
+    if args.profile_output:
+        perf.export(args.profile_output)
+    if exit_code:
+        sys.exit(exit_code)
 
 if __name__ == "__main__":
     main()
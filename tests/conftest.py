@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+'''Shared fixtures: every test runs in its own directory, against mock TheHive servers'''
+
+# standard imports
+import os
+import sys
+
+# third party imports
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'bench'))
+
+# local imports
+import mockhive
+from cells import config
+from cells import hive
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    '''Keep .pollen_config, the spool and the caches of each test apart'''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, 'CONFIG', config.PollenConfig())
+    monkeypatch.setattr(config, 'LISTING_CACHE', None)
+    monkeypatch.setattr(config, 'NETWORK_POLICY', None)
+    hive.reset_clients()
+    yield tmp_path
+    hive.reset_clients()
+
+
+@pytest.fixture
+def mock_servers():
+    '''Start mock TheHive servers on demand; mock_servers(**options) returns (hive, url)'''
+    servers = []
+
+    def start(**options):
+        server, mock, url = mockhive.start(**options)
+        servers.append(server)
+        return mock, url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def write_config(profiles):
+    """Write a .pollen_config with a [TheHive] section for 'default' and a profile section for the rest
+    :param profiles: profile name to server URL
+    :type profiles: dict
+    """
+    with open(config.CONFIG_FILE, 'w') as config_file:
+        for name, url in profiles.items():
+            config_file.write("[{0}]\nserver_url = {1}\nserver_api = test-key\n\n".format(
+                config.CONFIG.profile_section(name), url))
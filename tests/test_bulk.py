@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''Log entry writes: an entry that may have reached TheHive is never sent twice'''
+
+# standard imports
+import socket
+import time
+
+# local imports
+from cells import bulk
+from cells import hive
+from cells import resilience
+
+
+def test_read_timeout_is_not_resent(mock_servers):
+    # TheHive takes longer than the client waits, but still writes the entry
+    mock, url = mock_servers(cases=1, tasks=1, latency_ms=600)
+    api = hive.get_client(url, 'test-key', policy=resilience.RetryPolicy(read_timeout=0.2, backoff=0.01))
+    failure = bulk.post_entry(api, 'task-0-0', {'message': 'written once'}, retries=3, backoff=0.01)
+    assert failure.kind == bulk.UNKNOWN
+    time.sleep(1.5)
+    assert [log['message'] for log in mock.logs.get('task-0-0', [])] == ['written once']
+
+
+def test_refused_connection_can_be_retried():
+    # Nothing listens on a port that was just released, so the entry never left
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    url = 'http://127.0.0.1:{0}'.format(probe.getsockname()[1])
+    probe.close()
+    api = hive.get_client(url, 'test-key', policy=resilience.RetryPolicy(retries=0, breaker_threshold=100))
+    failure = bulk.post_entry(api, 'task-0-0', {'message': 'never sent'}, retries=0)
+    assert failure.kind == bulk.RETRY
+
+
+def test_missing_task_is_rejected(mock_servers):
+    mock, url = mock_servers(cases=1, tasks=1)
+    api = hive.get_client(url, 'test-key')
+    failure = bulk.post_entry(api, 'task-9-9', {'message': 'nowhere to go'})
+    assert failure.kind == bulk.REJECTED
+    assert 'task-9-9' not in mock.logs
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''Task log search: what the analyst types always becomes a valid FTS5 query'''
+
+# third party imports
+import pytest
+
+# local imports
+from cells import logsearch
+
+SERVER = 'http://thehive.test'
+
+
+@pytest.mark.parametrize('text, query', [
+    ('lateral movement', '"lateral" "movement"'),
+    ('10.1.2.3', '"10.1.2.3"'),
+    ('cmd.exe /c', '"cmd.exe" "/c"'),
+    ('say "hi"', '"say" """hi"""'),
+    ('admin*', '"admin"*'),
+    ('* **', ''),
+    ('OR NOT', '"OR" "NOT"'),
+])
+def test_fts_query_quotes_every_word(text, query):
+    assert logsearch.fts_query(text) == query
+
+
+@pytest.fixture
+def index(tmp_path):
+    log_index = logsearch.LogIndex(str(tmp_path / 'logs'))
+    logs = [{'id': 'log-1', '_parent': 'task-1', 'message': 'Beacon to 10.1.2.3 over "port 443"'},
+            {'id': 'log-2', '_parent': 'task-1', 'message': 'Ran cmd.exe /c whoami as administrator'},
+            {'id': 'log-3', '_parent': 'task-1', 'message': 'Host 10.1.2.4 and 3 others'}]
+    log_index.store(SERVER, 'case-1', logs, {'case-1': 'Case', 'task-1': 'Task'}, 0)
+    return log_index
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('10.1.2.3', ['Beacon']),
+    ('"port', ['Beacon']),
+    ('cmd.exe', ['whoami']),
+    ('admin*', ['whoami']),
+    ('NOT', []),
+])
+def test_search_takes_words_literally(index, text, expected):
+    hits = index.search(SERVER, text)
+    assert len(hits) == len(expected)
+    for hit, word in zip(hits, expected):
+        assert word in hit['snippet']
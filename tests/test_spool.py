@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+'''Queued log entries: each one is flushed to the server profile it was queued for'''
+
+# local imports
+from cells import spool
+
+from conftest import write_config
+
+
+def messages(mock, task_id):
+    return [log['message'] for log in mock.logs.get(task_id, [])]
+
+
+def test_flush_sends_each_entry_to_its_profile(mock_servers):
+    default, default_url = mock_servers(cases=1, tasks=1)
+    other, other_url = mock_servers(cases=1, tasks=1)
+    write_config({'default': default_url, 'other': other_url})
+    spool.append('task-0-0', 'for the default server')
+    spool.append('task-0-0', 'for the other server', profile='other')
+    summary = spool.flush()
+    assert (summary['sent'], summary['failed'], summary['remaining']) == (2, 0, 0)
+    assert messages(default, 'task-0-0') == ['for the default server']
+    assert messages(other, 'task-0-0') == ['for the other server']
+
+
+def test_flush_keeps_entries_for_a_removed_profile(mock_servers):
+    default, default_url = mock_servers(cases=1, tasks=1)
+    write_config({'default': default_url})
+    spool.append('task-0-0', 'for a server that is gone', profile='gone')
+    summary = spool.flush()
+    assert (summary['sent'], summary['failed'], summary['remaining']) == (0, 1, 1)
+    assert messages(default, 'task-0-0') == []
+
+
+def test_flush_drops_refused_entries(mock_servers):
+    default, default_url = mock_servers(cases=1, tasks=1)
+    write_config({'default': default_url})
+    spool.append('task-9-9', 'for a task that does not exist')
+    summary = spool.flush()
+    assert (summary['sent'], summary['remaining']) == (0, 0)
+    assert [task_id for task_id, _ in summary['dropped']] == ['task-9-9']